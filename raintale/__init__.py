@@ -1,6 +1,3 @@
-from .storytellers import storytellers
-
 import os
 
 package_directory = os.path.dirname(os.path.abspath(__file__))
-
@@ -0,0 +1,133 @@
+import os
+import logging
+
+import requests_cache
+
+module_logger = logging.getLogger('raintale.httpcache')
+
+default_cache_directory = os.path.join(
+    os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "raintale"
+)
+
+# one week
+default_expire_after = 7 * 24 * 60 * 60
+
+# 512 MB
+default_max_cache_size = 512 * 1024 * 1024
+
+# the cache of MementoEmbed responses shared by story runs and tellstory prefetch
+surrogate_cache_name = "mementoembed-surrogates"
+
+# how long, in milliseconds, a process waits for another process to release the SQLite database
+sqlite_busy_timeout = 30000
+
+def get_cache_directory(cache_directory=None):
+
+    if cache_directory is None:
+        cache_directory = os.getenv("RAINTALE_CACHE_DIR", default_cache_directory)
+
+    if not os.path.exists(cache_directory):
+        os.makedirs(cache_directory, exist_ok=True)
+
+    return cache_directory
+
+def get_cache_size(session):
+    """
+        Returns the size of the cache of `session` in bytes, including
+        any write-ahead log that has not yet been checkpointed.
+    """
+
+    db_path = str(session.cache.responses.db_path)
+    size = 0
+
+    for filename in [ db_path, "{}-wal".format(db_path) ]:
+        if os.path.exists(filename):
+            size += os.path.getsize(filename)
+
+    return size
+
+def prune_cache(session, max_cache_size):
+    """
+        Removes expired responses from the cache of `session`. If the cache
+        is still larger than `max_cache_size` bytes, the responses closest
+        to expiring are removed until it fits.
+    """
+
+    cache = session.cache
+
+    cache.delete(expired=True)
+
+    while get_cache_size(session) > max_cache_size:
+
+        response_count = len(cache.responses)
+
+        if response_count == 0:
+            break
+
+        oldest_keys = [
+            response.cache_key for response in cache.sorted(
+                key='expires', limit=max(1, response_count // 2)
+            )
+        ]
+
+        module_logger.info("cache at {} exceeds {} bytes, removing {} responses".format(
+            cache.responses.db_path, max_cache_size, len(oldest_keys)
+        ))
+
+        cache.delete(*oldest_keys)
+
+        # deleted pages stay in the write-ahead log until it is checkpointed
+        with cache.responses.connection() as connection:
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        if len(oldest_keys) == response_count:
+            break
+
+def get_cached_session(cache_name, cache_directory=None,
+    expire_after=default_expire_after, max_cache_size=default_max_cache_size, match_headers=False):
+    """
+        Returns a requests_cache CachedSession backed by the SQLite database
+        `cache_name` in `cache_directory`. Unlike `requests_cache.install_cache`,
+        this does not patch `requests` for the whole process.
+
+        The database uses write-ahead logging and a busy timeout so that
+        several raintale processes can share the same cache. Responses are
+        cached separately for each value of the request headers listed in
+        `match_headers`.
+    """
+
+    cache_directory = get_cache_directory(cache_directory)
+    db_path = os.path.join(cache_directory, "{}.sqlite".format(cache_name))
+
+    module_logger.info("using HTTP cache at {} with expiration of {} seconds and size limit of {} bytes".format(
+        db_path, expire_after, max_cache_size
+    ))
+
+    backend = requests_cache.SQLiteCache(
+        db_path, wal=True, busy_timeout=sqlite_busy_timeout
+    )
+
+    session = requests_cache.CachedSession(
+        backend=backend, expire_after=expire_after, match_headers=match_headers
+    )
+
+    if max_cache_size is not None:
+        prune_cache(session, max_cache_size)
+
+    return session
+
+def get_surrogate_session(cache_directory=None,
+    expire_after=default_expire_after, max_cache_size=default_max_cache_size):
+    """
+        Returns the cached session through which stories consult
+        MementoEmbed, so that surrogates fetched by an earlier run, or by
+        `tellstory prefetch`, are not requested again.
+
+        MementoEmbed answers the same URL differently depending on the
+        preferences a request asks for, so each Prefer header is cached
+        separately.
+    """
+
+    return get_cached_session(surrogate_cache_name, cache_directory=cache_directory,
+        expire_after=expire_after, max_cache_size=max_cache_size, match_headers=['Prefer'])
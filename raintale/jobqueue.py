@@ -0,0 +1,608 @@
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import ipaddress
+import sqlite3
+import threading
+import contextlib
+
+from http.server import ThreadingHTTPServer
+
+import requests
+
+from .server import JSONRequestHandler, JobRequestError, StoryService
+
+module_logger = logging.getLogger('raintale.jobqueue')
+
+default_broker_port = 8551
+
+# a claimed job returns to the queue if its worker does not renew the claim within this many seconds
+default_lease_seconds = 60
+
+# jobs whose worker failed, or stopped answering, this many times are not tried again
+default_max_attempts = 3
+
+# how often, in seconds, an idle worker checks the queue for jobs
+default_poll_interval = 1
+
+# how long, in seconds, a process waits for another process to release the SQLite database
+sqlite_busy_timeout = 30
+
+job_statuses = [ "queued", "running", "succeeded", "failed" ]
+
+class JobQueueError(Exception):
+
+    def __init__(self, message):
+        super(JobQueueError, self).__init__(message)
+        self.message = message
+
+def make_worker_id():
+    return "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[0:8])
+
+def is_loopback_host(host):
+    """
+        Returns True if `host` only accepts connections from this host.
+    """
+
+    if host == "localhost":
+        return True
+
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class JobQueue:
+    """
+        A queue of story jobs kept in the SQLite database `filename`, which
+        worker processes on the same host share.
+
+        A worker claims a job for `lease_seconds` and must renew its claim
+        until it records the result. Jobs whose worker stops renewing are
+        claimed again by another worker, so every job is told at least once,
+        and jobs that fail or lose their worker `max_attempts` times are
+        marked as failed. Only the worker holding the claim may record the
+        result of a job.
+    """
+
+    def __init__(self, filename, max_attempts=default_max_attempts):
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+
+        with self.transaction() as db:
+
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                request TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_expires REAL,
+                result TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )""")
+
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created)")
+
+    @property
+    def db(self):
+
+        # SQLite connections cannot be shared between threads
+        if getattr(self._local, 'db', None) is None:
+
+            db = sqlite3.connect(self.filename, timeout=sqlite_busy_timeout, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+
+            self._local.db = db
+
+        return self._local.db
+
+    @contextlib.contextmanager
+    def transaction(self):
+
+        db = self.db
+
+        # taking the write lock up front, so that two workers never claim the same job
+        db.execute("BEGIN IMMEDIATE")
+
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        else:
+            db.execute("COMMIT")
+
+    def job_to_dict(self, row):
+
+        if row is None:
+            return None
+
+        return {
+            "id": row["id"],
+            "request": json.loads(row["request"]),
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "worker": row["worker"],
+            "lease_expires": row["lease_expires"],
+            "result": None if row["result"] is None else json.loads(row["result"]),
+            "error": row["error"],
+            "created": row["created"],
+            "updated": row["updated"]
+        }
+
+    def submit(self, job_request):
+        """
+            Adds a job telling the story of `job_request`, in the format of
+            the story service, and returns it.
+        """
+
+        job_id = uuid.uuid4().hex
+        now = time.time()
+
+        with self.transaction() as db:
+            db.execute("INSERT INTO jobs (id, request, status, created, updated) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, json.dumps(job_request), now, now))
+
+        return self.get(job_id)
+
+    def get(self, job_id):
+        return self.job_to_dict(self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def list_jobs(self, status=None):
+
+        if status is None:
+            rows = self.db.execute("SELECT * FROM jobs ORDER BY created")
+        else:
+            rows = self.db.execute("SELECT * FROM jobs WHERE status = ? ORDER BY created", (status,))
+
+        return [ self.job_to_dict(row) for row in rows ]
+
+    def claim(self, worker_id, lease_seconds=default_lease_seconds):
+        """
+            Claims the oldest job that is queued, or whose worker stopped
+            renewing its claim, for `worker_id`, returning it or None if
+            there is no such job.
+        """
+
+        with self.transaction() as db:
+
+            while True:
+
+                now = time.time()
+
+                row = db.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?) "
+                    "ORDER BY created LIMIT 1", (now,)).fetchone()
+
+                if row is None:
+                    return None
+
+                if row["status"] == "running":
+                    module_logger.warning("worker {} stopped renewing its claim on job {}".format(row["worker"], row["id"]))
+
+                    if row["attempts"] >= self.max_attempts:
+                        db.execute("UPDATE jobs SET status = 'failed', error = ?, worker = NULL, updated = ? WHERE id = ?",
+                            ("abandoned after {} attempts, the last worker stopped answering".format(row["attempts"]),
+                                now, row["id"]))
+                        continue
+
+                db.execute("UPDATE jobs SET status = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                    "updated = ? WHERE id = ?", (worker_id, now + lease_seconds, now, row["id"]))
+
+                return self.job_to_dict(db.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+
+    def renew(self, job_id, worker_id, lease_seconds=default_lease_seconds):
+        """
+            Extends the claim of `worker_id` on job `job_id`, returning
+            False if the worker no longer holds it.
+        """
+
+        now = time.time()
+
+        with self.transaction() as db:
+            cursor = db.execute("UPDATE jobs SET lease_expires = ?, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'", (now + lease_seconds, now, job_id, worker_id))
+
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker_id, result=None):
+        """
+            Records that `worker_id` told the story of job `job_id`,
+            returning False if the worker no longer holds the job.
+        """
+
+        with self.transaction() as db:
+            cursor = db.execute("UPDATE jobs SET status = 'succeeded', result = ?, error = NULL, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'", (json.dumps(result), time.time(), job_id, worker_id))
+
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker_id, error, retry=True):
+        """
+            Records that `worker_id` failed to tell the story of job
+            `job_id`, returning it to the queue if `retry` is True and it
+            has attempts left. Returns False if the worker no longer holds
+            the job.
+        """
+
+        with self.transaction() as db:
+            cursor = db.execute("UPDATE jobs SET "
+                "status = CASE WHEN ? AND attempts < ? THEN 'queued' ELSE 'failed' END, "
+                "error = ?, worker = NULL, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (retry is True, self.max_attempts, error, time.time(), job_id, worker_id))
+
+        return cursor.rowcount == 1
+
+    def release(self, job_id, worker_id):
+        """
+            Returns job `job_id` to the queue without counting the attempt,
+            for a worker that is stopping.
+        """
+
+        with self.transaction() as db:
+            cursor = db.execute("UPDATE jobs SET status = 'queued', worker = NULL, attempts = attempts - 1, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'", (time.time(), job_id, worker_id))
+
+        return cursor.rowcount == 1
+
+class RemoteJobQueue:
+    """
+        A JobQueue served by a job broker at `broker_uri`, so that workers
+        on several hosts share it, sending `token` with each request if the
+        broker requires one.
+    """
+
+    def __init__(self, broker_uri, session=None, timeout=30, token=None):
+        self.broker_uri = broker_uri.rstrip('/')
+        self.session = requests.Session() if session is None else session
+        self.timeout = timeout
+
+        if token is not None:
+            self.session.headers["Authorization"] = "Bearer {}".format(token)
+
+    def request(self, method, path, body=None, allowed_statuses=(200,)):
+
+        try:
+            r = self.session.request(method, "{}{}".format(self.broker_uri, path), json=body, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise JobQueueError("cannot reach the job broker at {}: {}".format(self.broker_uri, e))
+
+        if r.status_code not in allowed_statuses:
+
+            try:
+                error = r.json()["error"]
+            except (ValueError, KeyError, TypeError):
+                error = "status {}".format(r.status_code)
+
+            raise JobQueueError("job broker at {} answered {} {}: {}".format(self.broker_uri, method, path, error))
+
+        return r
+
+    def submit(self, job_request):
+        return self.request("POST", "/jobs", job_request, allowed_statuses=(201,)).json()
+
+    def get(self, job_id):
+
+        r = self.request("GET", "/jobs/{}".format(job_id), allowed_statuses=(200, 404))
+
+        if r.status_code == 404:
+            return None
+
+        return r.json()
+
+    def list_jobs(self, status=None):
+        return self.request("GET", "/jobs" if status is None else "/jobs?status={}".format(status)).json()["jobs"]
+
+    def claim(self, worker_id, lease_seconds=default_lease_seconds):
+
+        r = self.request("POST", "/claims", { "worker": worker_id, "lease_seconds": lease_seconds },
+            allowed_statuses=(200, 204))
+
+        if r.status_code == 204:
+            return None
+
+        return r.json()
+
+    def update(self, job_id, action, body):
+        r = self.request("POST", "/jobs/{}/{}".format(job_id, action), body, allowed_statuses=(200, 409))
+        return r.status_code == 200
+
+    def renew(self, job_id, worker_id, lease_seconds=default_lease_seconds):
+        return self.update(job_id, "renew", { "worker": worker_id, "lease_seconds": lease_seconds })
+
+    def complete(self, job_id, worker_id, result=None):
+        return self.update(job_id, "complete", { "worker": worker_id, "result": result })
+
+    def fail(self, job_id, worker_id, error, retry=True):
+        return self.update(job_id, "fail", { "worker": worker_id, "error": error, "retry": retry })
+
+    def release(self, job_id, worker_id):
+        return self.update(job_id, "release", { "worker": worker_id })
+
+def open_job_queue(location, token=None):
+    """
+        Returns the job queue at `location`, either the URI of a job broker,
+        which is sent `token`, or the filename of a SQLite database.
+    """
+
+    if location.startswith("http://") or location.startswith("https://"):
+        return RemoteJobQueue(location, token=token)
+
+    return JobQueue(location)
+
+class JobBrokerRequestHandler(JSONRequestHandler):
+    """
+        The HTTP API through which a job broker serves its job queue:
+
+            POST /jobs                  submits a job request
+            GET /jobs                   lists the jobs, optionally ?status=<status>
+            GET /jobs/<id>              a job
+            POST /claims                claims a job for {"worker", "lease_seconds"}
+            POST /jobs/<id>/renew       renews a claim, {"worker", "lease_seconds"}
+            POST /jobs/<id>/complete    records a story, {"worker", "result"}
+            POST /jobs/<id>/fail        records a failure, {"worker", "error", "retry"}
+            POST /jobs/<id>/release     returns a job to the queue, {"worker"}
+            GET /health                 answers while the broker is running
+
+        A broker given a token only answers requests, other than for
+        /health, that carry it as "Authorization: Bearer <token>".
+    """
+
+    @property
+    def job_queue(self):
+        return self.server.job_queue
+
+    def do_GET(self):
+
+        route = self.get_route()
+
+        if route == [ "health" ]:
+            self.send_json(200, { "status": "ok" })
+
+        elif not self.check_token():
+            return
+
+        elif route == [ "jobs" ]:
+
+            query = dict( part.split('=', 1) for part in self.path.partition('?')[2].split('&') if '=' in part )
+            status = query.get("status")
+
+            if status is not None and status not in job_statuses:
+                self.send_error_json(400, "status must be one of {}".format(", ".join(job_statuses)))
+                return
+
+            self.send_json(200, { "jobs": self.job_queue.list_jobs(status=status) })
+
+        elif len(route) == 2 and route[0] == "jobs":
+
+            job = self.job_queue.get(route[1])
+
+            if job is None:
+                self.send_error_json(404, "no job {}".format(route[1]))
+            else:
+                self.send_json(200, job)
+
+        else:
+            self.send_error_json(404, "no such resource {}".format(self.path))
+
+    def do_POST(self):
+
+        if not self.check_token():
+            return
+
+        route = self.get_route()
+
+        try:
+            body = self.read_json()
+        except ValueError:
+            return
+
+        if route == [ "jobs" ]:
+            job = self.job_queue.submit(body)
+            self.send_json(201, job, headers={ "Location": "/jobs/{}".format(job["id"]) })
+            return
+
+        if type(body) != dict or type(body.get("worker")) != str:
+            self.send_error_json(400, "a request requires the worker making it")
+            return
+
+        worker_id = body["worker"]
+        lease_seconds = body.get("lease_seconds", default_lease_seconds)
+
+        if route == [ "claims" ]:
+
+            job = self.job_queue.claim(worker_id, lease_seconds=lease_seconds)
+
+            if job is None:
+                self.send_response(204)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                self.send_json(200, job)
+
+            return
+
+        if len(route) != 3 or route[0] != "jobs" or route[2] not in ("renew", "complete", "fail", "release"):
+            self.send_error_json(404, "no such resource {}".format(self.path))
+            return
+
+        job_id, action = route[1], route[2]
+
+        if action == "renew":
+            held = self.job_queue.renew(job_id, worker_id, lease_seconds=lease_seconds)
+        elif action == "complete":
+            held = self.job_queue.complete(job_id, worker_id, result=body.get("result"))
+        elif action == "fail":
+            held = self.job_queue.fail(job_id, worker_id, str(body.get("error")), retry=body.get("retry", True) is True)
+        else:
+            held = self.job_queue.release(job_id, worker_id)
+
+        if held is True:
+            self.send_json(200, self.job_queue.get(job_id))
+        else:
+            self.send_error_json(409, "worker {} does not hold job {}".format(worker_id, job_id))
+
+class JobBroker(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, server_address, job_queue, token=None):
+        self.job_queue = job_queue
+        self.token = token
+        super(JobBroker, self).__init__(server_address, JobBrokerRequestHandler)
+
+class StoryWorker:
+    """
+        Claims jobs from `job_queue` one at a time and tells their stories
+        with `story_service`, whose caches stay warm between jobs.
+
+        While a story is told, the claim on its job is renewed every third
+        of `lease_seconds`. A service storyteller whose worker loses the
+        claim stops publishing before its next post, since the worker that
+        claimed the job again resumes from the same publish journal. A job claimed again after its worker stopped
+        keeps the job directory of the earlier attempt, so service
+        storytellers resume publishing from their publish journal and
+        posts are not published twice.
+    """
+
+    def __init__(self, job_queue, story_service, worker_id=None, lease_seconds=default_lease_seconds,
+        poll_interval=default_poll_interval):
+
+        self.job_queue = job_queue
+        self.story_service = story_service
+        self.worker_id = make_worker_id() if worker_id is None else worker_id
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+
+    def renew_claim(self, job_id, finished, lost_claim):
+
+        while not finished.wait(self.lease_seconds / 3):
+
+            try:
+                if self.job_queue.renew(job_id, self.worker_id, lease_seconds=self.lease_seconds) is False:
+                    module_logger.error("worker {} lost its claim on job {}".format(self.worker_id, job_id))
+                    lost_claim.set()
+                    return
+            except JobQueueError as e:
+                module_logger.warning("cannot renew the claim on job {}: {}".format(job_id, e.message))
+
+    def tell_job(self, queued_job):
+        """
+            Tells the story of `queued_job` and records the result in the
+            queue, returning the StoryJob or None if the request is invalid.
+        """
+
+        job_id = queued_job["id"]
+
+        module_logger.info("worker {} claimed job {}, attempt {}".format(self.worker_id, job_id, queued_job["attempts"]))
+
+        try:
+            job, storyteller, story_template, surrogate_template, story_data = \
+                self.story_service.prepare_job(queued_job["request"], job_id=job_id)
+        except JobRequestError as e:
+            module_logger.error("job {} is invalid: {}".format(job_id, e.message))
+            self.job_queue.fail(job_id, self.worker_id, e.message, retry=False)
+            return None
+
+        finished = threading.Event()
+        lost_claim = threading.Event()
+
+        if hasattr(storyteller, 'stop_publishing'):
+            storyteller.stop_publishing = lost_claim
+
+        renewer = threading.Thread(target=self.renew_claim, args=(job_id, finished, lost_claim), daemon=True)
+        renewer.start()
+
+        try:
+            self.story_service.run_job(job, storyteller, story_template, surrogate_template, story_data)
+        except BaseException:
+            finished.set()
+            self.job_queue.release(job_id, self.worker_id)
+            raise
+        finally:
+            finished.set()
+            renewer.join()
+
+        if job.status == "succeeded":
+            result = { "location": job.location, "worker": self.worker_id }
+            recorded = self.job_queue.complete(job_id, self.worker_id, result=result)
+        else:
+            recorded = self.job_queue.fail(job_id, self.worker_id, job.error)
+
+        if recorded is False:
+            module_logger.warning("job {} was claimed by another worker before worker {} recorded its result".format(
+                job_id, self.worker_id))
+
+        return job
+
+    def work(self, stop_event=None, max_jobs=None):
+        """
+            Tells the stories of queued jobs until `stop_event` is set or
+            `max_jobs` jobs have been told, returning the number told.
+        """
+
+        if stop_event is None:
+            stop_event = threading.Event()
+
+        told = 0
+
+        while not stop_event.is_set() and (max_jobs is None or told < max_jobs):
+
+            try:
+                queued_job = self.job_queue.claim(self.worker_id, lease_seconds=self.lease_seconds)
+            except JobQueueError as e:
+                module_logger.warning("cannot claim a job: {}".format(e.message))
+                queued_job = None
+
+            if queued_job is None:
+                stop_event.wait(self.poll_interval)
+                continue
+
+            self.tell_job(queued_job)
+            told += 1
+
+        return told
+
+def run_worker(queue_location, mementoembed_api, jobs_directory, storyteller_options=None, service_credentials=None,
+    lease_seconds=default_lease_seconds, token=None):
+    """
+        Tells the stories of the jobs in the queue at `queue_location`,
+        sending `token` to a job broker, until interrupted. Each worker process started by `tellstory worker` runs
+        this, consulting MementoEmbed through the surrogate cache shared by
+        every process using the same cache directory.
+    """
+
+    # the HTTP cache imports requests_cache, which the parent process does not need
+    from .httpcache import get_surrogate_session, default_expire_after, default_max_cache_size
+
+    expire_after = getattr(storyteller_options, 'cache_expire_after', None)
+    max_cache_size = getattr(storyteller_options, 'cache_max_size', None)
+
+    session = get_surrogate_session(
+        cache_directory=getattr(storyteller_options, 'cache_directory', None),
+        expire_after=default_expire_after if expire_after is None else expire_after,
+        max_cache_size=default_max_cache_size if max_cache_size is None else max_cache_size
+    )
+
+    service = StoryService(mementoembed_api, jobs_directory=jobs_directory, max_jobs=1,
+        storyteller_options=storyteller_options, session=session, service_credentials=service_credentials)
+
+    worker = StoryWorker(open_job_queue(queue_location, token=token), service, lease_seconds=lease_seconds)
+
+    module_logger.info("worker {} is telling the stories of the jobs in {}".format(worker.worker_id, queue_location))
+
+    try:
+        worker.work()
+    except KeyboardInterrupt:
+        module_logger.info("worker {} is stopping".format(worker.worker_id))
+    finally:
+        service.shutdown()
@@ -0,0 +1,363 @@
+import os
+import io
+import logging
+import hashlib
+import mimetypes
+import time
+import threading
+
+import requests_cache
+
+from PIL import Image
+
+from .httpcache import get_cached_session, get_cache_directory, default_expire_after, default_max_cache_size
+from .surrogatedata import datauri_to_data, DataURIParseError
+
+module_logger = logging.getLogger('raintale.mediacache')
+
+# media beyond this size is skipped rather than downloaded, callers may lower it
+max_media_bytes = 64 * 1024 * 1024
+
+download_chunk_size = 64 * 1024
+
+# media types identified by the first bytes of the content, servers often send the wrong Content-Type
+media_signatures = [
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'BM', 'image/bmp'),
+    (0, b'\x00\x00\x01\x00', 'image/x-icon'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (4, b'ftypqt', 'video/quicktime'),
+    (4, b'ftyp', 'video/mp4')
+]
+
+image_media_types = ( 'image/', )
+
+def sniff_media_type(data):
+    """
+        Returns the media type of `data` from its first bytes, or None if
+        it is not recognized.
+    """
+
+    if data[0:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+
+    for offset, signature, media_type in media_signatures:
+        if data[offset:offset + len(signature)] == signature:
+            return media_type
+
+    return None
+
+def is_media_type(media_type, media_types):
+    return media_types is None or media_type.startswith(tuple(media_types))
+
+def convert_to_png(im):
+    """
+        Converts the first frame of `im`, such as an animated GIF, to PNG.
+    """
+
+    im.seek(0)
+
+    return im, "PNG"
+
+def convert_to_fit(im, width, height):
+    """
+        Downscales `im` to fit within `width` x `height`, keeping its
+        aspect ratio and, where possible, its format.
+    """
+
+    image_format = im.format if im.format in ('PNG', 'JPEG', 'WEBP') else 'PNG'
+
+    im.draft('RGB', (width, height))
+
+    if image_format == 'JPEG' and im.mode not in ('L', 'RGB', 'CMYK'):
+        im = im.convert('RGB')
+    elif im.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        im = im.convert('RGBA')
+
+    im.thumbnail((width, height))
+
+    return im, image_format
+
+# the conversions that MediaCache.convert can apply, each returns the converted image and its format
+media_conversions = {
+    "png": convert_to_png,
+    "fit": convert_to_fit
+}
+
+class Media:
+    """
+        The content of a downloaded or decoded media URI and its media type.
+    """
+
+    def __init__(self, data, mimetype, uri=None):
+        self.data = data
+        self.mimetype = mimetype
+        self.uri = uri
+
+    def __repr__(self):
+        return "<Media {} {} bytes from {}>".format(self.mimetype, len(self.data), self.uri)
+
+class MediaCache:
+    """
+        Downloads media for storytellers through a shared, size limited HTTP
+        cache, so that the same archived images are only downloaded once no
+        matter how many storytellers or runs use them. Media types are
+        taken from the content itself rather than the URI or the server.
+
+        Converted media, such as the first frame of an animated GIF or a
+        downscaled image, are cached on disk by the digest of the original
+        content and the conversion applied.
+    """
+
+    def __init__(self, cache_directory=None, expire_after=default_expire_after,
+        max_cache_size=default_max_cache_size, session=None):
+
+        self.cache_directory = cache_directory
+        self.expire_after = expire_after
+        self.max_cache_size = max_cache_size
+        self._session = session
+        self._conversion_directory = None
+
+        # threads fetching the same URI wait for the first download rather than repeating it
+        self._fetch_locks = {}
+        self._fetch_locks_lock = threading.Lock()
+
+    @property
+    def session(self):
+
+        if self._session is None:
+            self._session = get_cached_session(
+                'media',
+                cache_directory=self.cache_directory,
+                expire_after=self.expire_after,
+                max_cache_size=self.max_cache_size
+            )
+
+        return self._session
+
+    def fetch(self, uri, max_bytes=max_media_bytes, media_types=None):
+        """
+            Returns the Media at `uri`, which may be a data URI, or None if
+            it is unavailable, larger than `max_bytes`, or its type does not
+            start with one of `media_types`. The body is streamed so that
+            an oversized download stops at the cap.
+        """
+
+        if uri[0:5] == 'data:':
+            return self.decode_datauri(uri, max_bytes, media_types)
+
+        with self._fetch_locks_lock:
+            fetch_lock = self._fetch_locks.setdefault(uri, threading.Lock())
+
+        with fetch_lock:
+            return self.download(uri, max_bytes, media_types)
+
+    def download(self, uri, max_bytes, media_types):
+
+        session = self.session
+
+        # only a fresh cached response is used, an expired one is downloaded again below
+        r = session.get(uri, only_if_cached=True)
+
+        if r.status_code != 504:
+
+            if r.status_code != 200 or len(r.content) > max_bytes:
+                return None
+
+            media = self.get_media(r.content, r.headers.get('Content-Type', ''), uri)
+
+            if not is_media_type(media.mimetype, media_types):
+                return None
+
+            return media
+
+        # requests_cache reads the whole body before returning, so stream without it
+        with session.cache_disabled():
+            r = session.get(uri, stream=True)
+
+        try:
+
+            if r.status_code != 200:
+                module_logger.warning("got a status code of {} for media at {}, skipping...".format(r.status_code, uri))
+                return None
+
+            content_type = r.headers.get('Content-Type', '')
+
+            if media_types is not None and content_type != '' and not is_media_type(content_type, media_types) and \
+                not content_type.startswith('application/octet-stream'):
+                module_logger.warning("content at {} has type {} instead of {}, skipping...".format(
+                    uri, content_type, " or ".join(media_types)))
+                return None
+
+            if int(r.headers.get('Content-Length', 0)) > max_bytes:
+                module_logger.warning("media at {} is {} bytes, larger than the limit of {}, skipping...".format(
+                    uri, r.headers['Content-Length'], max_bytes))
+                return None
+
+            chunks = []
+            size = 0
+
+            for chunk in r.iter_content(chunk_size=download_chunk_size):
+
+                size += len(chunk)
+
+                if size > max_bytes:
+                    module_logger.warning("media at {} is larger than the limit of {} bytes, skipping...".format(uri, max_bytes))
+                    return None
+
+                chunks.append(chunk)
+
+            data = b''.join(chunks)
+
+        finally:
+            r.close()
+
+        media = self.get_media(data, content_type, uri)
+
+        if not is_media_type(media.mimetype, media_types):
+            module_logger.warning("content at {} is {} instead of {}, skipping...".format(
+                uri, media.mimetype, " or ".join(media_types)))
+            return None
+
+        # store the complete body so that later runs and other storytellers are served from the cache
+        cached_response = requests_cache.CachedResponse(
+            content=data,
+            status_code=r.status_code,
+            reason=r.reason,
+            headers=r.headers,
+            url=r.url,
+            encoding=r.encoding,
+            request=requests_cache.CachedRequest.from_request(r.request)
+        )
+
+        session.cache.save_response(
+            cached_response, expires=requests_cache.get_expiration_datetime(session.settings.expire_after))
+
+        return media
+
+    def decode_datauri(self, uri, max_bytes, media_types):
+
+        try:
+            mimetype, data = datauri_to_data(uri)
+        except (DataURIParseError, ValueError):
+            module_logger.warning("cannot decode data URI {}..., skipping...".format(uri[0:40]))
+            return None
+
+        if len(data) > max_bytes:
+            return None
+
+        media = self.get_media(data, mimetype, None)
+
+        if not is_media_type(media.mimetype, media_types):
+            return None
+
+        return media
+
+    def get_media(self, data, content_type, uri):
+        """
+            Identifies the type of `data` from its content, falling back to
+            `content_type` and then the extension of `uri`.
+        """
+
+        mimetype = sniff_media_type(data)
+
+        if mimetype is not None:
+            return Media(data, mimetype, uri=uri)
+
+        mimetype = content_type.split(';')[0].strip()
+
+        if mimetype in ('', 'application/octet-stream') and uri is not None:
+            mimetype = mimetypes.guess_type(uri)[0] or 'application/octet-stream'
+
+        # every raster image type that storytellers use is recognized above, so the claim is wrong
+        if mimetype.startswith('image/') and mimetype != 'image/svg+xml':
+            mimetype = 'application/octet-stream'
+
+        return Media(data, mimetype, uri=uri)
+
+    @property
+    def conversion_directory(self):
+
+        if self._conversion_directory is None:
+
+            self._conversion_directory = os.path.join(get_cache_directory(self.cache_directory), "media-conversions")
+
+            if not os.path.exists(self._conversion_directory):
+                os.makedirs(self._conversion_directory, exist_ok=True)
+
+            self.prune_conversions()
+
+        return self._conversion_directory
+
+    def prune_conversions(self):
+        """
+            Removes converted media that has not been used for longer than
+            the cache expiration time, unless the cache never expires.
+        """
+
+        if self.expire_after is None or self.expire_after < 0:
+            return
+
+        now = time.time()
+
+        for filename in os.listdir(self.conversion_directory):
+
+            path = os.path.join(self.conversion_directory, filename)
+
+            try:
+                if now - os.path.getmtime(path) > self.expire_after:
+                    os.remove(path)
+            except FileNotFoundError:
+                # another raintale process removed it first
+                pass
+
+    def convert(self, media, conversion, *args):
+        """
+            Returns `media` converted by the named `conversion` from
+            `media_conversions` with `args`, reusing an earlier conversion
+            of the same content. Returns None if `media` cannot be decoded.
+        """
+
+        key = hashlib.sha256(media.data).hexdigest()
+        options = "-".join([ conversion ] + [ str(arg) for arg in args ])
+
+        path = os.path.join(self.conversion_directory, "{}.{}".format(key, options))
+
+        try:
+
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            # mark it as recently used so that it is not pruned
+            os.utime(path)
+
+            return self.get_media(data, '', media.uri)
+
+        except FileNotFoundError:
+            pass
+
+        try:
+            im = Image.open(io.BytesIO(media.data))
+            im, image_format = media_conversions[conversion](im, *args)
+
+            converted = io.BytesIO()
+            im.save(converted, image_format)
+        except (IOError, SyntaxError, Image.DecompressionBombError):
+            module_logger.warning("cannot convert {} to {}, skipping...".format(media, options))
+            return None
+
+        data = converted.getvalue()
+
+        partial_path = "{}.{}.partial".format(path, os.getpid())
+
+        # write under a unique name first so other processes never read a partial conversion
+        with open(partial_path, 'wb') as f:
+            f.write(data)
+
+        os.replace(partial_path, path)
+
+        return self.get_media(data, '', media.uri)
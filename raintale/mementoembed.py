@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+
+import requests
+
+module_logger = logging.getLogger('raintale.mementoembed')
+
+default_mementoembed_candidates = [
+    "http://localhost:5550",
+    "http://mementoembed:5550",
+    "http://localhost:5000"
+]
+
+# how long, in seconds, a candidate has to answer before it is considered down
+probe_timeout = 3
+
+# MementoEmbed may still be starting, such as within docker-compose, so discovery is retried
+discovery_attempts = 4
+discovery_retry_delay = 1
+
+# how long, in seconds, back-to-back runs reuse the endpoint found by an earlier run
+endpoint_cache_expire_after = 120
+
+endpoint_cache_filename = "mementoembed-endpoint.json"
+
+def probe_mementoembed_endpoint(url, timeout=probe_timeout, session=None):
+    """
+        Returns True if the MementoEmbed instance at `url` answers within
+        `timeout` seconds without a server error.
+    """
+
+    if session is None:
+        session = requests
+
+    try:
+        r = session.get(url, timeout=timeout)
+    except requests.RequestException as e:
+        module_logger.info("MementoEmbed endpoint at {} is unavailable: {}".format(url, e))
+        return False
+
+    if r.status_code >= 500:
+        module_logger.info("MementoEmbed endpoint at {} answered with status {}".format(url, r.status_code))
+        return False
+
+    return True
+
+def probe_candidates(candidates, timeout=probe_timeout, session=None):
+    """
+        Probes every candidate in `candidates` concurrently and returns the
+        first healthy one in the order given, or None.
+
+        A healthy candidate is chosen as soon as every candidate before it
+        has failed, so a live endpoint does not wait on slower ones behind
+        it. Candidates still unanswered after `timeout` are considered down,
+        even if they are stuck resolving their hostname.
+    """
+
+    results = queue.Queue()
+
+    def probe(index, url):
+        results.put( (index, probe_mementoembed_endpoint(url, timeout=timeout, session=session)) )
+
+    for index, url in enumerate(candidates):
+        # daemon threads, so that a probe stuck in name resolution does not hold up the process
+        threading.Thread(target=probe, args=(index, url), daemon=True).start()
+
+    health = [ None ] * len(candidates)
+    deadline = time.monotonic() + timeout
+
+    while True:
+
+        for index, healthy in enumerate(health):
+
+            if healthy is None:
+                break
+
+            if healthy is True:
+                return candidates[index]
+
+        else:
+            return None
+
+        remaining = deadline - time.monotonic()
+
+        try:
+            index, healthy = results.get(timeout=max(remaining, 0))
+        except queue.Empty:
+            break
+
+        health[index] = healthy
+
+    for index, healthy in enumerate(health):
+        if healthy is True:
+            return candidates[index]
+
+    return None
+
+def read_cached_endpoint(cache_filename, candidates):
+
+    try:
+        with open(cache_filename) as f:
+            cached = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if cached.get("candidates") != candidates or cached.get("expires", 0) < time.time():
+        return None
+
+    return cached.get("endpoint")
+
+def write_cached_endpoint(cache_filename, candidates, endpoint, expire_after):
+
+    partial_filename = "{}.{}.partial".format(cache_filename, os.getpid())
+
+    with open(partial_filename, 'w') as f:
+        json.dump({
+            "candidates": candidates,
+            "endpoint": endpoint,
+            "expires": time.time() + expire_after
+        }, f)
+
+    # other raintale processes only ever see a complete file
+    os.replace(partial_filename, cache_filename)
+
+def discover_mementoembed_api(candidates, cache_directory=None, expire_after=endpoint_cache_expire_after,
+    timeout=probe_timeout, attempts=discovery_attempts, session=None):
+    """
+        Returns the first healthy MementoEmbed endpoint in `candidates`, or
+        None if none of them answers after `attempts` rounds of probing.
+
+        The endpoint found is remembered in the cache directory for
+        `expire_after` seconds, during which runs with the same candidates
+        use it without probing. An `expire_after` of 0 disables this.
+    """
+
+    # the HTTP cache module imports requests_cache, which tellstory does not otherwise need before discovery
+    from .httpcache import get_cache_directory
+
+    cache_filename = os.path.join(get_cache_directory(cache_directory), endpoint_cache_filename)
+
+    if expire_after > 0:
+
+        endpoint = read_cached_endpoint(cache_filename, candidates)
+
+        if endpoint is not None:
+            module_logger.info("using MementoEmbed endpoint {} discovered by a recent run".format(endpoint))
+            return endpoint
+
+    for attempt in range(0, attempts):
+
+        if attempt > 0:
+            retry_time = attempt * discovery_retry_delay
+            module_logger.error("Failed to connect to any MementoEmbed endpoint of {}, "
+                "sleeping for {} seconds to try again".format(", ".join(candidates), retry_time))
+            time.sleep(retry_time)
+
+        module_logger.info("testing MementoEmbed endpoints {}".format(", ".join(candidates)))
+
+        endpoint = probe_candidates(candidates, timeout=timeout, session=session)
+
+        if endpoint is not None:
+
+            if expire_after > 0:
+                write_cached_endpoint(cache_filename, candidates, endpoint, expire_after)
+
+            return endpoint
+
+    return None
@@ -0,0 +1,152 @@
+import time
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from .surrogatedata import MementoData
+from .storytellers.scheduler import TokenBucket
+
+module_logger = logging.getLogger('raintale.prefetch')
+
+# the number of MementoEmbed requests in flight at once
+default_prefetch_workers = 8
+
+# how many completed requests pass between progress reports
+progress_report_interval = 25
+
+def get_surrogate_requests(urims, story_templates, mementoembed_api):
+    """
+        Returns the (endpoint, MementoEmbed preferences) pairs that telling
+        a story of `urims` with each of `story_templates` requests from
+        MementoEmbed, in story order and without duplicates.
+    """
+
+    surrogate_requests = {}
+
+    for story_template in story_templates:
+
+        md = MementoData(story_template, mementoembed_api)
+
+        for urim in urims:
+            md.add(urim)
+
+        for endpoint, me_preferences in md.get_endpoints_and_preferences_with_fields():
+            surrogate_requests.setdefault( (endpoint, me_preferences), None )
+
+    # a dictionary keeps the order in which the requests were first needed
+    return list(surrogate_requests)
+
+def is_cached(session, endpoint, headers):
+
+    cache = getattr(session, 'cache', None)
+
+    if cache is None:
+        return False
+
+    return cache.contains(request=requests.Request('GET', endpoint, headers=headers))
+
+def prefetch_surrogates(surrogate_requests, session, max_workers=default_prefetch_workers,
+    requests_per_second=None, on_progress=None, progress=None):
+    """
+        Requests each of `surrogate_requests` from MementoEmbed through
+        `session`, which caches the responses so that later stories are
+        told from the cache. Up to `max_workers` requests are in flight at
+        once and, if `requests_per_second` is given, no more than that many
+        are sent each second. Requests already in the cache are not sent.
+
+        `on_progress` is called with the report after each request, and
+        `progress`, a FetchProgress, if given, follows the requests.
+        Returns a report of the number of requests `fetched`, found
+        `cached`, and the (endpoint, reason) of each that `failed`.
+    """
+
+    report = {
+        "requests": len(surrogate_requests),
+        "fetched": 0,
+        "cached": 0,
+        "failed": []
+    }
+
+    if requests_per_second is not None:
+        bucket = TokenBucket(max(1, requests_per_second), requests_per_second, clock=time.monotonic)
+    else:
+        bucket = None
+
+    bucket_lock = threading.Lock()
+
+    def wait_for_slot():
+
+        while True:
+
+            with bucket_lock:
+
+                delay = bucket.get_delay()
+
+                if delay <= 0:
+                    bucket.consume()
+                    return
+
+            time.sleep(delay)
+
+    def prefetch(endpoint, me_preferences):
+
+        headers = {}
+
+        if len(me_preferences) > 0:
+            headers['Prefer'] = ','.join(me_preferences)
+
+        if is_cached(session, endpoint, headers):
+            return "cached", None, 0
+
+        if bucket is not None:
+            wait_for_slot()
+
+        try:
+            r = session.get(endpoint, headers=headers)
+        except requests.RequestException as e:
+            return "failed", str(e), 0
+
+        if r.status_code != 200:
+            return "failed", "MementoEmbed answered with status {}".format(r.status_code), len(r.content)
+
+        return "fetched", None, len(r.content)
+
+    if progress is not None:
+        for endpoint, me_preferences in surrogate_requests:
+            progress.add_requests(1, endpoint=endpoint)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+
+        futures = {
+            executor.submit(prefetch, endpoint, me_preferences): endpoint
+                for endpoint, me_preferences in surrogate_requests
+        }
+
+        for future in as_completed(futures):
+
+            endpoint = futures[future]
+            outcome, reason, byte_count = future.result()
+
+            if progress is not None:
+                progress.record_completion(endpoint=endpoint, byte_count=byte_count,
+                    failed=outcome == "failed", cached=outcome == "cached")
+
+            if outcome == "failed":
+                module_logger.warning("failed to prefetch {}: {}".format(endpoint, reason))
+                report["failed"].append( (endpoint, reason) )
+            else:
+                report[outcome] += 1
+
+            completed = report["fetched"] + report["cached"] + len(report["failed"])
+
+            if completed % progress_report_interval == 0 or completed == report["requests"]:
+                module_logger.info("prefetched {} of {} surrogate requests, {} already cached, {} failed".format(
+                    completed, report["requests"], report["cached"], len(report["failed"])))
+
+            if on_progress is not None:
+                on_progress(report)
+
+    return report
@@ -0,0 +1,327 @@
+import sys
+import json
+import time
+import logging
+import threading
+
+from collections import deque
+from urllib.parse import urlparse
+
+module_logger = logging.getLogger('raintale.progress')
+
+# how often, in seconds, progress is reported while requests are outstanding
+default_report_interval = 0.5
+
+# throughput is measured over the requests completed within this many seconds
+default_rate_window = 10
+
+# MementoEmbed is reported as stalled once no response has arrived for this many seconds
+default_stall_after = 15
+
+def format_duration(seconds):
+
+    seconds = int(round(seconds))
+
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+def format_bytes(count):
+
+    if count < 1024:
+        return "{} B".format(count)
+
+    for unit in [ "KB", "MB", "GB" ]:
+
+        count /= 1024
+
+        if count < 1024 or unit == "GB":
+            return "{:.1f} {}".format(count, unit)
+
+class FetchProgress:
+    """
+        Follows the requests made to MementoEmbed while surrogates are
+        fetched, measuring the requests completed, the bytes received,
+        the requests completed per second, and the time left at that rate.
+
+        Requests are counted as they are issued with `add_requests` and as
+        they complete with `record_response` or `record_completion`.
+        While started, every reporter is called
+        with a snapshot of the progress each `interval` seconds, so that a
+        MementoEmbed instance that stops answering shows up as a growing
+        `stalled_seconds` rather than as silence. A FetchProgress may be
+        shared by several threads.
+    """
+
+    def __init__(self, reporters=None, interval=default_report_interval, rate_window=default_rate_window,
+        stall_after=default_stall_after, clock=time.monotonic):
+
+        self.reporters = list(reporters or [])
+        self.interval = interval
+        self.rate_window = rate_window
+        self.stall_after = stall_after
+        self.clock = clock
+
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.cached = 0
+        self.bytes_received = 0
+
+        self._lock = threading.Lock()
+        self._completion_times = deque()
+        self._outstanding_hosts = {}
+        self._started = None
+        self._last_activity = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._stalled_hosts = set()
+        self._last_reported = None
+
+    def add_requests(self, count=1, endpoint=None):
+
+        with self._lock:
+
+            now = self.clock()
+
+            if self._started is None:
+                self._started = now
+
+            if self.completed == self.total:
+                # idle time between batches of requests is not a stall
+                self._last_activity = now
+
+            self.total += count
+
+            if endpoint is not None:
+                host = urlparse(endpoint).netloc
+                self._outstanding_hosts[host] = self._outstanding_hosts.get(host, 0) + count
+
+    def record_response(self, response, *args, **kwargs):
+        """
+            Counts `response` as a completed request.
+        """
+
+        self.record_completion(
+            endpoint=response.url,
+            byte_count=len(response.content or b''),
+            failed=response.status_code != 200,
+            cached=getattr(response, 'from_cache', False) is True
+        )
+
+    def record_completion(self, endpoint=None, byte_count=0, failed=False, cached=False):
+
+        with self._lock:
+
+            now = self.clock()
+
+            self.completed += 1
+            self.bytes_received += byte_count
+            self._last_activity = now
+            self._completion_times.append(now)
+
+            if failed is True:
+                self.failed += 1
+
+            if cached is True:
+                self.cached += 1
+
+            if endpoint is not None:
+
+                host = urlparse(endpoint).netloc
+
+                if self._outstanding_hosts.get(host, 0) > 0:
+                    self._outstanding_hosts[host] -= 1
+
+                self._stalled_hosts.discard(host)
+
+    def snapshot(self):
+        """
+            Returns the progress so far as a dictionary that is also the
+            machine-readable progress event.
+        """
+
+        with self._lock:
+
+            now = self.clock()
+
+            while len(self._completion_times) > 0 and self._completion_times[0] < now - self.rate_window:
+                self._completion_times.popleft()
+
+            if self._started is None:
+                elapsed = 0
+            else:
+                elapsed = now - self._started
+
+            window = min(self.rate_window, elapsed)
+
+            if window > 0:
+                requests_per_second = len(self._completion_times) / window
+            else:
+                requests_per_second = 0
+
+            remaining = self.total - self.completed
+
+            if remaining == 0:
+                eta_seconds = 0
+            elif requests_per_second > 0:
+                eta_seconds = remaining / requests_per_second
+            else:
+                eta_seconds = None
+
+            if remaining > 0 and self._last_activity is not None:
+                stalled_seconds = now - self._last_activity
+            else:
+                stalled_seconds = 0
+
+            return {
+                "event": "progress",
+                "completed": self.completed,
+                "total": self.total,
+                "failed": self.failed,
+                "cached": self.cached,
+                "bytes": self.bytes_received,
+                "requests_per_second": round(requests_per_second, 2),
+                "eta_seconds": None if eta_seconds is None else round(eta_seconds, 1),
+                "elapsed_seconds": round(elapsed, 1),
+                "stalled_seconds": round(stalled_seconds, 1),
+                "waiting_on": sorted( host for host, count in self._outstanding_hosts.items() if count > 0 )
+            }
+
+    def report(self, final=False):
+
+        snapshot = self.snapshot()
+
+        if snapshot["total"] == 0:
+            return
+
+        counts = (snapshot["completed"], snapshot["total"])
+
+        # once every request is answered there is nothing new to report until more are issued
+        if final is False and counts[0] == counts[1] and counts == self._last_reported:
+            return
+
+        self._last_reported = counts
+
+        snapshot["final"] = final
+        snapshot["stalled"] = snapshot["stalled_seconds"] >= self.stall_after
+
+        if snapshot["stalled"] is True:
+
+            with self._lock:
+                stalled_hosts = set(snapshot["waiting_on"]) - self._stalled_hosts
+                self._stalled_hosts.update(stalled_hosts)
+
+            # warned once for each host, until it answers again
+            if len(stalled_hosts) > 0:
+                module_logger.warning("no response from MementoEmbed at {} for {:.0f} seconds, "
+                    "{} requests outstanding".format(", ".join(sorted(stalled_hosts)), snapshot["stalled_seconds"],
+                        snapshot["total"] - snapshot["completed"]))
+
+        for reporter in self.reporters:
+            reporter(snapshot)
+
+    def run(self):
+
+        while not self._stop_event.wait(self.interval):
+            self.report()
+
+    def start(self):
+
+        if self._thread is None and len(self.reporters) > 0:
+            self._thread = threading.Thread(target=self.run, name="raintale-progress", daemon=True)
+            self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+        self.report(final=True)
+
+class TerminalProgressReporter:
+    """
+        Shows progress as a single line that is rewritten in place on a
+        terminal, or as one line per report elsewhere.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = sys.stderr if stream is None else stream
+        self.interactive = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self._last_length = 0
+
+    def format(self, snapshot):
+
+        line = "fetched {} of {} surrogate requests".format(snapshot["completed"], snapshot["total"])
+
+        if snapshot["failed"] > 0:
+            line += ", {} failed".format(snapshot["failed"])
+
+        line += ", {}, {:.1f} requests/s".format(format_bytes(snapshot["bytes"]), snapshot["requests_per_second"])
+
+        if snapshot["final"] is True:
+            line += ", in {}".format(format_duration(snapshot["elapsed_seconds"]))
+        elif snapshot["eta_seconds"] is not None:
+            line += ", ETA {}".format(format_duration(snapshot["eta_seconds"]))
+
+        if snapshot["stalled"] is True:
+            line += ", no response from {} for {:.0f}s".format(", ".join(snapshot["waiting_on"]) or "MementoEmbed",
+                snapshot["stalled_seconds"])
+
+        return line
+
+    def __call__(self, snapshot):
+
+        line = self.format(snapshot)
+
+        if self.interactive is True:
+            # padded, so that a shorter line covers all of the one before it
+            self.stream.write("\r" + line.ljust(self._last_length))
+            self._last_length = len(line)
+
+            if snapshot["final"] is True:
+                self.stream.write("\n")
+                self._last_length = 0
+
+        else:
+            self.stream.write(line + "\n")
+
+        self.stream.flush()
+
+class JSONProgressReporter:
+    """
+        Writes each progress snapshot to `stream` as a line of JSON, for
+        tools that follow the progress of a story.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = sys.stderr if stream is None else stream
+
+    def __call__(self, snapshot):
+        self.stream.write(json.dumps(snapshot) + "\n")
+        self.stream.flush()
+
+progress_modes = [ "auto", "terminal", "json", "none" ]
+
+def make_fetch_progress(mode="auto", stream=None):
+    """
+        Returns a FetchProgress reporting in `mode`: "terminal", "json",
+        "none", or "auto", which reports on the terminal only if `stream`
+        is one.
+    """
+
+    stream = sys.stderr if stream is None else stream
+
+    if mode == "auto":
+        mode = "terminal" if hasattr(stream, 'isatty') and stream.isatty() else "none"
+
+    if mode == "terminal":
+        reporters = [ TerminalProgressReporter(stream) ]
+    elif mode == "json":
+        reporters = [ JSONProgressReporter(stream) ]
+    else:
+        reporters = []
+
+    return FetchProgress(reporters=reporters)
@@ -0,0 +1,671 @@
+import os
+import re
+import hmac
+import json
+import time
+import uuid
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import mimetypes
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from . import package_directory
+from .storydata import complete_story_data, make_link_story_data, StoryDataError
+from .surrogatedataset import SurrogateCache, default_max_cached_urims
+from .storytellers.storytellers import storytellers, storytellers_without_templates, get_template_index
+from .storytellers.storyteller import StoryTellerException
+
+module_logger = logging.getLogger('raintale.server')
+
+default_host = "127.0.0.1"
+default_port = 8550
+
+# stories told at once, each fetches its surrogates with several requests of its own
+default_max_jobs = 4
+
+# finished jobs whose status and output are kept, the oldest are removed first
+default_max_finished_jobs = 1000
+
+# the largest story a job request may contain
+max_request_bytes = 64 * 1024 * 1024
+
+output_chunk_size = 64 * 1024
+
+# how often, in seconds, streamed output checks for more of the story
+output_poll_interval = 0.1
+
+output_content_types = {
+    "html": "text/html; charset=utf-8",
+    "jekyll-html": "text/html; charset=utf-8",
+    "markdown": "text/markdown; charset=utf-8",
+    "jekyll-markdown": "text/markdown; charset=utf-8",
+    "mediawiki": "text/plain; charset=utf-8",
+    "template": "text/plain; charset=utf-8"
+}
+
+generation_date_format = '%Y-%m-%dT%H:%M:%S'
+
+class JobRequestError(Exception):
+
+    def __init__(self, message):
+        super(JobRequestError, self).__init__(message)
+        self.message = message
+
+def make_mementoembed_session(pool_size):
+    """
+        Returns a session whose connection pool keeps up to `pool_size`
+        connections to MementoEmbed open between stories.
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+class StoryJob:
+    """
+        A story told by the service, from the time it is submitted until
+        it is removed. The story is written to `output_filename`.
+    """
+
+    def __init__(self, job_id, storyteller, preset, output_filename, content_type):
+        self.id = job_id
+        self.storyteller = storyteller
+        self.preset = preset
+        self.output_filename = output_filename
+        self.content_type = content_type
+        self.status = "queued"
+        self.error = None
+        # where the storyteller told the story, such as the URL of a thread
+        self.location = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._done = threading.Event()
+
+    def is_finished(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def start(self):
+        self.status = "running"
+        self.started = time.time()
+
+    def finish(self, error=None, location=None):
+
+        self.location = location
+
+        if error is None:
+            self.status = "succeeded"
+        else:
+            self.status = "failed"
+            self.error = error
+
+        self.finished = time.time()
+        self._done.set()
+
+    def to_dict(self):
+
+        return {
+            "id": self.id,
+            "status": self.status,
+            "storyteller": self.storyteller,
+            "preset": self.preset,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+            "output": "/jobs/{}/output".format(self.id)
+        }
+
+class StoryService:
+    """
+        Tells stories submitted as jobs with file storytellers, keeping what
+        a single run of tellstory would have to build again warm between
+        jobs: the connection pool to MementoEmbed, the surrogate data of
+        URI-Ms already seen, the media cache, and the story templates,
+        whose compiled forms storytellers already share within a process.
+
+        Service storytellers are only available to jobs if the credentials
+        they publish with are given in `service_credentials`, which maps
+        storyteller names to credentials files.
+    """
+
+    def __init__(self, mementoembed_api, jobs_directory=None, max_jobs=default_max_jobs,
+        max_cached_urims=default_max_cached_urims, max_finished_jobs=default_max_finished_jobs,
+        storyteller_options=None, session=None, service_credentials=None):
+
+        self.mementoembed_api = mementoembed_api
+        self.max_finished_jobs = max_finished_jobs
+        self.service_credentials = dict(service_credentials or {})
+
+        # the options a storyteller would have been given on the command line
+        if storyteller_options is None:
+            storyteller_options = argparse.Namespace()
+
+        self.storyteller_options = storyteller_options
+
+        if session is None:
+            session = make_mementoembed_session(pool_size=max(10, max_jobs * 8))
+
+        self.session = session
+        self.surrogate_cache = SurrogateCache(mementoembed_api, session=self.session, max_urims=max_cached_urims)
+
+        # the media cache imports Pillow and requests_cache, which tellstory otherwise loads only when it needs them
+        from .mediacache import MediaCache
+
+        media_cache_options = {}
+
+        if getattr(storyteller_options, 'cache_expire_after', None) is not None:
+            media_cache_options['expire_after'] = storyteller_options.cache_expire_after
+
+        if getattr(storyteller_options, 'cache_max_size', None) is not None:
+            media_cache_options['max_cache_size'] = storyteller_options.cache_max_size
+
+        self.media_cache = MediaCache(
+            cache_directory=getattr(storyteller_options, 'cache_directory', None), **media_cache_options)
+
+        if jobs_directory is None:
+            self.jobs_directory = tempfile.mkdtemp(prefix="raintale-jobs-")
+            self._remove_jobs_directory = True
+        else:
+            os.makedirs(jobs_directory, exist_ok=True)
+            self.jobs_directory = jobs_directory
+            self._remove_jobs_directory = False
+
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="raintale-job")
+        self._jobs = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._templates = {}
+
+    def get_preset_template(self, storyteller, preset):
+
+        key = (storyteller, preset)
+
+        if key not in self._templates:
+
+            template_filename = os.path.join(package_directory, "templates", "{}.{}".format(preset, storyteller))
+
+            try:
+                with open(template_filename) as f:
+                    self._templates[key] = f.read()
+            except FileNotFoundError:
+                raise JobRequestError("Unsupported preset {} for storyteller {}".format(preset, storyteller))
+
+        return self._templates[key]
+
+    def get_storyteller_class(self, storyteller):
+
+        template_storytellers, presets = get_template_index()
+
+        if storyteller in storytellers:
+            storyteller_class = storytellers[storyteller]
+        elif storyteller in template_storytellers:
+            storyteller_class = storytellers["template"]
+        else:
+            raise JobRequestError("Unknown storyteller {}".format(storyteller))
+
+        if storyteller_class.requires_file is not True and storyteller not in self.service_credentials:
+            raise JobRequestError(
+                "storyteller {} publishes to a service, only storytellers that write files "
+                "are available from the story service".format(storyteller))
+
+        return storyteller_class
+
+    def parse_job_request(self, job_request):
+        """
+            Returns the storyteller, preset, story template, and story data
+            of `job_request`, whose story is either in the raintale JSON
+            input format under "story" or a list of memento URLs under
+            "urims".
+        """
+
+        if type(job_request) != dict:
+            raise JobRequestError("a job must be a JSON object")
+
+        storyteller = job_request.get("storyteller")
+
+        if type(storyteller) != str:
+            raise JobRequestError("a job requires a storyteller")
+
+        self.get_storyteller_class(storyteller)
+
+        preset = job_request.get("preset", "default")
+        story_template = job_request.get("template")
+
+        if storyteller in storytellers_without_templates:
+            story_template = ""
+        elif story_template is None:
+
+            if storyteller == "template":
+                raise JobRequestError("storyteller template requires a template")
+
+            story_template = self.get_preset_template(storyteller, preset)
+
+        elif type(story_template) != str:
+            raise JobRequestError("a job template must be a string")
+
+        if re.match(r'^\.[A-Za-z0-9]+$', str(job_request.get("extension", ".mp4"))) is None:
+            raise JobRequestError("extension must be a filename extension such as .mp4")
+
+        try:
+            generation_date = job_request.get("generation_date")
+
+            if generation_date is None:
+                generation_date = datetime.now()
+            else:
+                generation_date = datetime.strptime(generation_date, generation_date_format)
+
+        except (TypeError, ValueError):
+            raise JobRequestError("generation_date must be formatted as {}".format(generation_date_format))
+
+        story_options = dict(
+            title=job_request.get("title"),
+            collection_url=job_request.get("collection_url"),
+            generated_by=job_request.get("generated_by"),
+            generation_date=generation_date
+        )
+
+        try:
+
+            if "story" in job_request:
+                story_data = complete_story_data(job_request["story"], source="the job request", **story_options)
+
+            elif type(job_request.get("urims")) == list:
+                story_data = make_link_story_data(job_request["urims"], **story_options)
+
+            else:
+                raise JobRequestError("a job requires either a story or a list of urims")
+
+        except StoryDataError as e:
+            raise JobRequestError(e.message)
+
+        if type(story_data.get('elements')) != list:
+            raise JobRequestError("the story of a job requires a list of elements")
+
+        return storyteller, preset, story_template, story_data
+
+    def prepare_job(self, job_request, job_id=None):
+        """
+            Returns the StoryJob of `job_request`, along with the arguments
+            that `run_job` tells its story with, raising JobRequestError if
+            the request is invalid.
+
+            A job given the `job_id` of an earlier attempt keeps its
+            directory, so that a service storyteller resumes publishing from
+            the publish journal there instead of publishing again.
+        """
+
+        storyteller, preset, story_template, story_data = self.parse_job_request(job_request)
+
+        storyteller_class = self.get_storyteller_class(storyteller)
+
+        if job_id is None:
+            job_id = uuid.uuid4().hex
+
+        job_directory = os.path.join(self.jobs_directory, job_id)
+        os.makedirs(job_directory, exist_ok=True)
+
+        if storyteller in storytellers_without_templates:
+            surrogate_template = storyteller_class.surrogate_template
+            extension = job_request.get("extension", ".mp4")
+        else:
+            surrogate_template = story_template
+            extension = ".txt"
+
+        output_filename = os.path.join(job_directory, "story{}".format(extension))
+
+        content_type = output_content_types.get(storyteller,
+            mimetypes.guess_type(output_filename)[0] or "application/octet-stream")
+
+        storyteller_options = argparse.Namespace(**vars(self.storyteller_options))
+
+        if "video_profile" in job_request:
+            storyteller_options.video_profile = job_request["video_profile"]
+
+        if storyteller_class.requires_file is True:
+            storyteller_argument = output_filename
+        else:
+            storyteller_argument = self.service_credentials[storyteller]
+            storyteller_options.journal_filename = os.path.join(job_directory, "publish-journal.jsonl")
+            storyteller_options.resume = True
+
+        try:
+            storyteller_object = storyteller_class(storyteller_argument,
+                **storyteller_class.get_options_from_arguments(storyteller_options))
+        except StoryTellerException as e:
+            shutil.rmtree(job_directory, ignore_errors=True)
+            raise JobRequestError(str(e))
+
+        if hasattr(storyteller_object, 'media_cache'):
+            storyteller_object.media_cache = self.media_cache
+
+        if job_request.get("template") is not None:
+            storyteller_object.sandboxed_templates = True
+
+        job = StoryJob(job_id, storyteller, preset, output_filename, content_type)
+
+        module_logger.info("job {} tells story '{}' with storyteller {}".format(job_id, story_data['title'], storyteller))
+
+        return job, storyteller_object, story_template, surrogate_template, story_data
+
+    def submit(self, job_request):
+        """
+            Starts telling the story of `job_request` and returns its
+            StoryJob, raising JobRequestError if the request is invalid.
+        """
+
+        job, storyteller, story_template, surrogate_template, story_data = self.prepare_job(job_request)
+
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+
+        self.remove_old_jobs()
+
+        self._executor.submit(self.run_job, job, storyteller, story_template, surrogate_template, story_data)
+
+        return job
+
+    def run_job(self, job, storyteller, story_template, surrogate_template, story_data):
+
+        job.start()
+
+        try:
+            storyteller.surrogate_dataset = self.surrogate_cache.get_dataset(story_data, [ surrogate_template ])
+            location = storyteller.tell_story(story_data, self.mementoembed_api, story_template)
+
+        except Exception as e:
+            module_logger.exception("job {} failed to tell its story".format(job.id))
+            job.finish(error=str(e) or e.__class__.__name__)
+
+        else:
+            module_logger.info("job {} has told its story".format(job.id))
+            job.finish(location=location)
+
+    def get_job(self, job_id):
+
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self):
+
+        with self._jobs_lock:
+            return list(self._jobs.values())
+
+    def remove_job(self, job_id):
+        """
+            Removes the finished job `job_id` and its output, returning
+            False if it is still being told.
+        """
+
+        with self._jobs_lock:
+
+            job = self._jobs.get(job_id)
+
+            if job is None or not job.is_finished():
+                return False
+
+            del self._jobs[job_id]
+
+        shutil.rmtree(os.path.dirname(job.output_filename), ignore_errors=True)
+
+        return True
+
+    def remove_old_jobs(self):
+
+        with self._jobs_lock:
+            finished_jobs = [ job.id for job in self._jobs.values() if job.is_finished() ]
+
+        for job_id in finished_jobs[0:max(0, len(finished_jobs) - self.max_finished_jobs)]:
+            self.remove_job(job_id)
+
+    def shutdown(self):
+        """
+            Waits for the submitted jobs to be told and removes the jobs
+            directory if the service created it.
+        """
+
+        self._executor.shutdown(wait=True)
+
+        if self._remove_jobs_directory is True:
+            shutil.rmtree(self.jobs_directory, ignore_errors=True)
+
+class JSONRequestHandler(BaseHTTPRequestHandler):
+    """
+        Answers requests of an HTTP API that speaks JSON.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    server_version = "raintale"
+
+    def log_message(self, format, *args):
+        module_logger.info("{} {}".format(self.address_string(), format % args))
+
+    def send_json(self, status, body, headers=None):
+
+        content = json.dumps(body).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, { "error": message })
+
+    def check_token(self):
+        """
+            Returns True if the request carries the bearer token of the
+            server, or if the server has none, otherwise answers with an
+            error and returns False.
+        """
+
+        token = getattr(self.server, 'token', None)
+
+        if token is None:
+            return True
+
+        authorization = self.headers.get("Authorization", "")
+
+        if hmac.compare_digest(authorization.encode('utf-8'), "Bearer {}".format(token).encode('utf-8')):
+            return True
+
+        self.close_connection = True
+        self.send_error_json(401, "a request requires the token of this server")
+
+        return False
+
+    def get_route(self):
+        return [ part for part in urlparse(self.path).path.split('/') if part != '' ]
+
+    def read_json(self):
+        """
+            Returns the JSON body of the request, or answers with an error
+            and raises ValueError if there is none.
+        """
+
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            self.send_error_json(411, "a request requires a Content-Length")
+            raise ValueError("no Content-Length")
+
+        if length > max_request_bytes:
+            self.close_connection = True
+            self.send_error_json(413, "a request may be at most {} bytes".format(max_request_bytes))
+            raise ValueError("request too large")
+
+        try:
+            return json.loads(self.rfile.read(length).decode('utf-8'))
+        except (ValueError, UnicodeDecodeError):
+            self.send_error_json(400, "a request must be JSON")
+            raise ValueError("request is not JSON")
+
+class StoryRequestHandler(JSONRequestHandler):
+    """
+        The HTTP job API of the story service:
+
+            POST /jobs                  submits a job, answering with its status
+            GET /jobs                   lists the jobs
+            GET /jobs/<id>              the status of a job
+            GET /jobs/<id>/output       the story, streamed as it is written
+            DELETE /jobs/<id>           removes a finished job and its story
+            GET /health                 answers while the service is running
+    """
+
+    @property
+    def service(self):
+        return self.server.story_service
+
+    def get_route_job(self, route):
+
+        job = self.service.get_job(route[1])
+
+        if job is None:
+            self.send_error_json(404, "no job {}".format(route[1]))
+
+        return job
+
+    def do_GET(self):
+
+        route = self.get_route()
+
+        if route == [ "health" ]:
+            self.send_json(200, { "status": "ok", "mementoembed_api": self.service.mementoembed_api })
+
+        elif route == [ "jobs" ]:
+            self.send_json(200, { "jobs": [ job.to_dict() for job in self.service.list_jobs() ] })
+
+        elif len(route) == 2 and route[0] == "jobs":
+
+            job = self.get_route_job(route)
+
+            if job is not None:
+                self.send_json(200, job.to_dict())
+
+        elif len(route) == 3 and route[0] == "jobs" and route[2] == "output":
+
+            job = self.get_route_job(route)
+
+            if job is not None:
+                self.stream_output(job)
+
+        else:
+            self.send_error_json(404, "no such resource {}".format(self.path))
+
+    def do_POST(self):
+
+        if self.get_route() != [ "jobs" ]:
+            self.send_error_json(404, "no such resource {}".format(self.path))
+            return
+
+        try:
+            job_request = self.read_json()
+        except ValueError:
+            return
+
+        try:
+            job = self.service.submit(job_request)
+        except JobRequestError as e:
+            self.send_error_json(400, e.message)
+        else:
+            self.send_json(202, job.to_dict(), headers={ "Location": "/jobs/{}".format(job.id) })
+
+    def do_DELETE(self):
+
+        route = self.get_route()
+
+        if len(route) != 2 or route[0] != "jobs":
+            self.send_error_json(404, "no such resource {}".format(self.path))
+            return
+
+        job = self.get_route_job(route)
+
+        if job is None:
+            return
+
+        if self.service.remove_job(job.id) is True:
+            self.send_json(200, job.to_dict())
+        else:
+            self.send_error_json(409, "job {} is still being told".format(job.id))
+
+    def send_chunk(self, data):
+        self.wfile.write("{:x}\r\n".format(len(data)).encode('ascii') + data + b"\r\n")
+
+    def stream_output(self, job):
+        """
+            Sends the story of `job` as it is written, waiting for it if
+            the job has not yet started writing. If the job fails after
+            part of the story was sent, the response ends without its final
+            chunk so that clients see it as incomplete.
+        """
+
+        while not job.is_finished() and not os.path.exists(job.output_filename):
+            job.wait(output_poll_interval)
+
+        if job.status == "failed":
+            self.send_json(500, job.to_dict())
+            return
+
+        try:
+            f = open(job.output_filename, 'rb')
+        except FileNotFoundError:
+            self.send_error_json(500, "job {} wrote no story".format(job.id))
+            return
+
+        with f:
+
+            self.send_response(200)
+            self.send_header("Content-Type", job.content_type)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            while True:
+
+                # checked before reading, so that the last read sees everything the job wrote
+                finished = job.is_finished()
+                data = f.read(output_chunk_size)
+
+                if len(data) > 0:
+                    self.send_chunk(data)
+                elif finished:
+                    break
+                else:
+                    job.wait(output_poll_interval)
+
+        if job.status == "failed":
+            self.close_connection = True
+            return
+
+        self.wfile.write(b"0\r\n\r\n")
+
+class StoryServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, server_address, story_service):
+        self.story_service = story_service
+        super(StoryServer, self).__init__(server_address, StoryRequestHandler)
@@ -0,0 +1,249 @@
+import sys
+import json
+import logging
+import itertools
+
+from urllib.parse import urlparse
+
+module_logger = logging.getLogger('raintale.storydata')
+
+# a black square, used by templates that show a story image when the story does not supply one
+default_story_image = "data:image/jpeg;base64,/9j/4AAQSkZJRgABAQEASABIAAD//gBHRmlsZSBzb3VyY2U6IGh0dHBzOi8vY29tbW9ucy53aWtpbWVkaWEub3JnL3dpa2kvRmlsZTpCbGFja19jb2xvdXIuanBn/9sAQwAGBAUGBQQGBgUGBwcGCAoQCgoJCQoUDg8MEBcUGBgXFBYWGh0lHxobIxwWFiAsICMmJykqKRkfLTAtKDAlKCko/9sAQwEHBwcKCAoTCgoTKBoWGigoKCgoKCgoKCgoKCgoKCgoKCgoKCgoKCgoKCgoKCgoKCgoKCgoKCgoKCgoKCgoKCgo/8AAEQgA8AC0AwEiAAIRAQMRAf/EABcAAQEBAQAAAAAAAAAAAAAAAAABAgj/xAAbEAEBAAEFAAAAAAAAAAAAAAAAAUEhMWFxgf/EABUBAQEAAAAAAAAAAAAAAAAAAAAB/8QAFBEBAAAAAAAAAAAAAAAAAAAAAP/aAAwDAQACEQMRAD8A5WAAAAAAAAAAAAAAAAAAABQBQBRAAAEAAAAAAAAAAAARQFUEVEABQBRAAAABUAAAAAAQAAFBQAAAQAFAAEAAAAAAARAAAAAAAAFAFBFEAFVZqIAgAAAAAgAgAAAAAAAAKgKKAgAqgCCAAAKACIAAAAAAAAAAAAKgCiKKAKIRUAAAARAAAAAAAAAAAABUAURVUABBUAAAARAAAAAAAAAAAFBAUARVUAQEVFBRAAEQAAAAAAAAAAVAFEUABVAEABQABBUAARAAAAAAAABQVQBAAUABAAUAAABBUAAEAUEBQQFRQBQAAAAFnYCAAAAAAAAIoAAAAAAAAAAgAKAAAAAAACAAoAAAAAIACgAAAACggALQAAAQFBBUAFQAUBAAAABQEBQRQA9ABUau6CoKCIBgAAAAAAAAAMHAAKKgKImFCCqAD//Z"
+
+class StoryDataError(Exception):
+
+    def __init__(self, message):
+        super(StoryDataError, self).__init__(message)
+        self.message = message
+
+def iter_link_elements(lines):
+    """
+        Yields a link story element for each memento URL in `lines`,
+        skipping those that are not HTTP or HTTPS URLs.
+    """
+
+    for line in lines:
+
+        line = line.strip()
+
+        if line == '':
+            continue
+
+        o = urlparse(line)
+
+        if o.scheme in ['http', 'https']:
+
+            module_logger.debug("adding link {} to story".format(line))
+
+            yield {
+                'type': 'link',
+                'value': line
+            }
+
+        else:
+            module_logger.warning(
+                "Skipping URL with unsupported scheme: {}".format(line)
+            )
+
+def complete_story_data(story_data, title=None, collection_url=None, generated_by=None, generation_date=None,
+    source="JSON input"):
+    """
+        Fills in the keys that templates expect but that story data in the
+        JSON input format may leave out, and applies the overrides given.
+    """
+
+    if type(story_data) != dict or 'title' not in story_data:
+        msg = "No story title found in {}, a title is required.".format(source)
+        module_logger.critical(msg)
+        raise StoryDataError(msg)
+
+    if title is not None:
+        module_logger.warning("overriding title of '{}' from {} with "
+            "title '{}' supplied as argument".format(
+                story_data['title'], source, title
+            ))
+        story_data['title'] = title
+
+    if 'generated_by' not in story_data:
+        story_data['generated_by'] = generated_by
+
+    if 'collection_url' not in story_data:
+        story_data['collection_url'] = collection_url
+
+    if 'story image' not in story_data:
+        story_data['story image'] = default_story_image
+
+    story_data['generation_date'] = generation_date
+
+    return story_data
+
+def iter_json_lines_elements(lines, source, first_linenumber=1):
+    """
+        Yields the story element on each line of `lines`, a story in the
+        JSON Lines format.
+    """
+
+    for linenumber, line in enumerate(lines, start=first_linenumber):
+
+        if line.strip() == '':
+            continue
+
+        try:
+            element = json.loads(line)
+        except ValueError:
+            msg = "story element at line {} of {} is not JSON, cannot continue...".format(linenumber, source)
+            module_logger.critical(msg)
+            raise StoryDataError(msg)
+
+        yield element
+
+def make_link_story_data(lines, title, collection_url=None, generated_by=None, generation_date=None,
+    streamed=False):
+    """
+        Returns the story data of a story made of the memento URLs in
+        `lines`, such as the lines of a text file. If `streamed` is True,
+        the elements are an iterator that reads `lines` as it goes.
+    """
+
+    if title is None:
+        msg = "Text file format requires a title be supplied on the command line."
+        module_logger.critical(msg)
+        raise StoryDataError(msg)
+
+    story_data = {
+        'title': title,
+        'collection_url': collection_url,
+        'generated_by': generated_by,
+        'story image': default_story_image,
+        'metadata': {}
+    }
+
+    module_logger.info("set story title to {}".format(
+        story_data['title']
+    ))
+
+    if streamed is True:
+        story_data['elements'] = iter_link_elements(lines)
+    else:
+        module_logger.info("creating story elements")
+
+        story_data['elements'] = list(iter_link_elements(lines))
+
+        module_logger.info("list of memento URLs has been built successfully")
+
+    story_data['generation_date'] = generation_date
+
+    return story_data
+
+def parse_story_input(f, title=None, collection_url=None, generated_by=None, generation_date=None,
+    source="the input", streamed=False):
+    """
+        Returns the story data read from `f`, which holds a story in the
+        raintale JSON format, a story in the JSON Lines format, or a list of
+        memento URLs, one per line, in which case `title` is required.
+
+        A JSON Lines story has a story element on each line, optionally
+        preceded by a line holding the rest of the story data, such as its
+        title. For JSON Lines and lists of memento URLs, if `streamed` is
+        True, the elements are an iterator that reads the rest of `f` as
+        the story is told, so that even very large stories are never held
+        in memory at once. `f` need not be seekable.
+    """
+
+    first_line = ''
+    first_linenumber = 0
+
+    for first_linenumber, first_line in enumerate(f, start=1):
+        if first_line.strip() != '':
+            break
+
+    if first_line.lstrip()[0:1] in ('{', '['):
+
+        try:
+            first_record = json.loads(first_line)
+        except ValueError:
+            first_record = None
+
+        if type(first_record) == dict and 'elements' not in first_record:
+
+            module_logger.info("reading {} as a story in the JSON Lines format".format(source))
+
+            if 'type' in first_record:
+                story_data = {}
+                first_elements = [ first_record ]
+            else:
+                story_data = first_record
+                first_elements = []
+
+            if 'title' not in story_data and title is not None:
+                story_data['title'] = title
+                title = None
+
+            story_data = complete_story_data(story_data, title, collection_url, generated_by, generation_date,
+                source=source)
+            story_data.setdefault('metadata', {})
+
+            elements = itertools.chain(first_elements,
+                iter_json_lines_elements(f, source, first_linenumber=first_linenumber + 1))
+
+            story_data['elements'] = elements if streamed is True else list(elements)
+
+            return story_data
+
+        try:
+            story_data = json.loads(first_line + f.read())
+        except ValueError:
+            msg = "{} is neither a JSON nor a JSON Lines story, cannot continue...".format(source)
+            module_logger.critical(msg)
+            raise StoryDataError(msg)
+
+        return complete_story_data(story_data, title, collection_url, generated_by, generation_date,
+            source=source)
+
+    module_logger.warning("story data is not JSON, attempting to read as "
+        "a list of memento URLs in a text file")
+
+    return make_link_story_data(itertools.chain([ first_line ], f), title, collection_url, generated_by,
+        generation_date, streamed=streamed)
+
+def iter_and_close(elements, f):
+
+    try:
+        for element in elements:
+            yield element
+    finally:
+        f.close()
+
+def read_story_data(input_filename, title=None, collection_url=None, generated_by=None, generation_date=None,
+    streamed=False):
+    """
+        Reads the story data from `input_filename`, or from standard input
+        if it is '-', as described in parse_story_input.
+    """
+
+    if input_filename == '-':
+        module_logger.info("reading story data from standard input")
+        return parse_story_input(sys.stdin, title, collection_url, generated_by, generation_date,
+            source="standard input", streamed=streamed)
+
+    module_logger.info("reading story data from file {}".format(input_filename))
+
+    f = open(input_filename)
+    keep_open = False
+
+    try:
+        story_data = parse_story_input(f, title, collection_url, generated_by, generation_date,
+            source=input_filename, streamed=streamed)
+
+        if streamed is True and type(story_data.get('elements', [])) != list:
+            # the file is closed once the story has read the last element
+            story_data['elements'] = iter_and_close(story_data['elements'], f)
+            keep_open = True
+
+    finally:
+        if keep_open is False:
+            f.close()
+
+    module_logger.info("data loaded for story with title {}".format(story_data['title']))
+
+    return story_data
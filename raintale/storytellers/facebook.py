@@ -2,21 +2,69 @@ import logging
 import mimetypes
 import tempfile
 import os
-import time
+import json
 import sys # for debugging
 
+from urllib.parse import urlencode
+
 import facebook
 
+from requests.structures import CaseInsensitiveDict
+
 from jinja2 import Template
 
 from .storyteller import ServiceStoryteller, get_story_elements, StoryTellerCredentialParseError, split_multipart_template
+from .poststream import get_posts, get_post_count
 
 module_logger = logging.getLogger('raintale.storytellers.facebook')
 
+# Graph API error codes for application, user, and page rate limits
+facebook_rate_limit_error_codes = [ 4, 17, 32, 613, 80001 ]
+
+def is_facebook_rate_limit_error(exception):
+
+    if not isinstance(exception, facebook.GraphAPIError):
+        return False
+
+    try:
+        return int(exception.code) in facebook_rate_limit_error_codes
+    except (TypeError, ValueError):
+        return False
+
+def get_batch_error(batch_response):
+    """
+        Returns the GraphAPIError for a failed operation in the result of
+        a Graph API batch request, or None if the operation succeeded.
+    """
+
+    if batch_response is None:
+        # Facebook did not run the operation because one it depends on failed
+        return facebook.GraphAPIError("operation was not run because an earlier operation failed")
+
+    if batch_response.get("code") == 200:
+        return None
+
+    try:
+        body = json.loads(batch_response.get("body") or "{}")
+    except ValueError:
+        body = {}
+
+    if type(body) == dict and "error" in body:
+        return facebook.GraphAPIError(body)
+
+    return facebook.GraphAPIError("operation failed with status {}".format(batch_response.get("code")))
+
 class FacebookStoryTeller(ServiceStoryteller):
 
     description = "(EXPERIMENTAL) Given input data and a template file, this storyteller publishes a story as a Facebook thread."
 
+    # Facebook reports page usage in response headers, this is the starting point until it does
+    publish_requests_per_window = 50
+    publish_window_seconds = 60
+
+    # the Graph API accepts at most 50 operations in a batch request
+    comment_batch_size = 50
+
     def load_credentials_filename(self):
 
         super(FacebookStoryTeller, self).load_credentials_filename()
@@ -40,38 +88,146 @@ class FacebookStoryTeller(ServiceStoryteller):
             version="2.12"
         )
 
+        self.graph.session.hooks['response'].append(self.scheduler.response_hook)
+
+    def is_rate_limit_error(self, exception):
+        return is_facebook_rate_limit_error(exception)
+
+    def post_comment_batch(self, title_post_id, indexed_posts):
+        """
+            Posts the comments in `indexed_posts`, a list of (index, post)
+            pairs, to the post `title_post_id` with one Graph API batch
+            request. Each operation depends on the one before it so that
+            Facebook creates the comments in story order.
+
+            Returns a list of (index, comment ID) pairs, with None as the ID
+            of a comment that failed and was skipped, for the leading run of
+            operations that completed. The caller resubmits the rest. A rate
+            limit error on the first operation is raised so that the
+            scheduler backs off.
+        """
+
+        batch = []
+
+        for index, thread_post in indexed_posts:
+
+            operation = {
+                "method": "POST",
+                "name": "comment{}".format(index),
+                "relative_url": "{}/{}/comments".format(self.graph.version, title_post_id),
+                "body": urlencode({ "message": thread_post["text"] }),
+                "omit_response_on_success": False
+            }
+
+            if len(batch) > 0:
+                operation["depends_on"] = batch[-1]["name"]
+
+            batch.append(operation)
+
+        batch_responses = self.graph.request(
+            self.graph.version, post_args={ "batch": json.dumps(batch) }, method="POST")
+
+        results = []
+
+        for (index, thread_post), batch_response in zip(indexed_posts, batch_responses):
+
+            if batch_response is not None:
+                self.scheduler.update_from_headers(CaseInsensitiveDict(
+                    (header["name"], header["value"]) for header in batch_response.get("headers", [])
+                ))
+
+            error = get_batch_error(batch_response)
+
+            if error is None:
+                results.append( (index, json.loads(batch_response["body"])["id"]) )
+                continue
+
+            if batch_response is None:
+
+                if len(results) == 0:
+                    raise error
+
+                # resubmit this and the rest in the next batch
+                break
+
+            if self.is_rate_limit_error(error):
+
+                if len(results) == 0:
+                    raise error
+
+                break
+
+            module_logger.error("cannot post comment for story element {}, skipping: {}".format(index + 1, error))
+            results.append( (index, None) )
+
+        return results
+
     def publish_story(self, story_output_data):
 
         page_id = self.credentials['page_id']
 
         module_logger.info("publishing story as a thread to Facebook page {}".format(page_id))
 
-        title_post = self.graph.put_object(
-            parent_object=page_id,
-            connection_name="feed",
-            message=story_output_data["main_post"]
-        )
-
-        commentcounter = 0
-        commentcount = len(story_output_data["comment_posts"])
+        if getattr(self, 'graph', None) is None:
+            self.auth()
 
-        for thread_post in story_output_data["comment_posts"]:
+        journal = self.get_publish_journal(story_output_data)
 
-            commentcounter += 1
-            module_logger.info("publishing story element {} of {}".format(commentcounter, commentcount))
+        if journal is not None and journal.get_post('title') is not None:
+            title_post_id = journal.get_post('title')['id']
+            first_index = journal.get_next_index()
+            module_logger.info("resuming comments on post with ID {}".format(title_post_id))
+        else:
+            self.check_publishing()
 
-            element_post = self.graph.put_object(
-                parent_object=title_post['id'], connection_name="comments",
-                message=thread_post["text"]
+            title_post = self.scheduler.call(
+                self.graph.put_object,
+                parent_object=page_id,
+                connection_name="feed",
+                message=story_output_data["main_post"]
             )
+            title_post_id = title_post['id']
+            first_index = 0
+
+            if journal is not None:
+                journal.record_post('title', title_post_id)
 
-            module_logger.info("sleeping for 2 seconds for Facebook's benefit...")
-            time.sleep(2)
+        comment_posts = story_output_data["comment_posts"]
+        next_index = first_index
+
+        while True:
+
+            # when publishing is pipelined, a batch holds the elements generated so far
+            indexed_posts = list(enumerate(get_posts(comment_posts, next_index, self.comment_batch_size), start=next_index))
+
+            if len(indexed_posts) == 0:
+                break
+
+            module_logger.info("publishing story elements {} to {} of {}".format(
+                indexed_posts[0][0] + 1, indexed_posts[-1][0] + 1, get_post_count(comment_posts)))
+
+            self.check_publishing()
+
+            # Facebook counts each request within a batch against the rate limit
+            results = self.scheduler.call(self.post_comment_batch, title_post_id, indexed_posts,
+                cost=len(indexed_posts))
+
+            for index, comment_id in results:
+
+                if journal is not None:
+                    journal.record_post(index, comment_id)
+
+            next_index += len(results)
+
+        story_location = "https://www.facebook.com/permalink.php?story_fbid={}&id={}".format(
+            title_post_id.split('_')[1], page_id
+        )
+
+        if journal is not None:
+            journal.record_complete(story_location)
 
         module_logger.info(
-            "Your story has been told on Facebook. Find it at "
-            "https://www.facebook.com/permalink.php?story_fbid={}&id={}".format(
-                title_post['id'].split('_')[1], page_id
-            )
+            "Your story has been told on Facebook. Find it at {}".format(story_location)
         )
 
+        return story_location
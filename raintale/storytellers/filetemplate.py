@@ -1,13 +1,15 @@
 import logging
 import pprint
+import time
 
-from jinja2 import Environment
-
-from .storyteller import FileStoryteller, get_story_elements
-from ..surrogatedata import MementoData
+from .storyteller import FileStoryteller, get_story_elements, compile_template
+from ..surrogatedata import get_sanitized_template, iter_element_memento_data
 
 module_logger = logging.getLogger('raintale.storytellers.filetemplate')
 
+# how often, in seconds, a streamed story is flushed to its output file
+stream_flush_interval = 0.5
+
 class FileTemplateStoryTellerTemplateUnsupportedElement(Exception):
     
     def __init__(self, message):
@@ -17,8 +19,25 @@ class FileTemplateStoryTeller(FileStoryteller):
     
     description = "Given input data and a template file, this storyteller generates a story formatted based on the template and saves it to an output file."
 
+    def __init__(self, output_filename, streamed=False):
+        super(FileTemplateStoryTeller, self).__init__(output_filename)
+        self.streamed = streamed
+
+    @classmethod
+    def get_options_from_arguments(cls, args):
+
+        options = {}
+
+        if getattr(args, 'streamed', False) is True:
+            options['streamed'] = True
+
+        return options
+
     def generate_story(self, story_data, mementoembed_api, story_template, session=None):
 
+        if self.streamed is True:
+            return self.generate_story_stream(story_data, mementoembed_api, story_template, session=session)
+
         story_elements = get_story_elements(story_data)
 
         elements = []
@@ -27,7 +46,7 @@ class FileTemplateStoryTeller(FileStoryteller):
             "elements".format(len(story_elements)))
 
         elementcounter = 1
-        md = MementoData(story_template, mementoembed_api)
+        md = self.make_memento_data(story_template, mementoembed_api)
 
         for element in story_elements:
 
@@ -101,8 +120,7 @@ class FileTemplateStoryTeller(FileStoryteller):
 
         module_logger.debug("sanitized template:\n\n {}\n\n".format(sanitized_template))
 
-        env = Environment()
-        template = env.from_string(sanitized_template)
+        template = compile_template(sanitized_template, sandboxed=self.sandboxed_templates)
         rendered_story = template.render(
             title=story_data['title'],
             generated_by=story_data['generated_by'],
@@ -115,12 +133,93 @@ class FileTemplateStoryTeller(FileStoryteller):
 
         return rendered_story
 
+    def generate_story_stream(self, story_data, mementoembed_api, story_template, session=None):
+        """
+            Like generate_story, but returns the story as an iterator of
+            text that reads the story elements, fetches their surrogates,
+            and renders them as it goes, so that the story is written
+            while it is being generated.
+        """
+
+        story_elements = get_story_elements(story_data)
+
+        def iter_elements():
+
+            elementcounter = 0
+
+            for element, memento_data in iter_element_memento_data(story_elements, story_template, mementoembed_api,
+                surrogate_dataset=self.surrogate_dataset,
+                session=session if session is not None else self.mementoembed_session, progress=self.progress):
+
+                elementcounter += 1
+
+                module_logger.debug("processing element {}".format(elementcounter))
+
+                try:
+
+                    if element['type'] == 'link':
+
+                        if memento_data is None:
+                            raise KeyError(element['value'])
+
+                        yield {
+                            "type": "link",
+                            "surrogate": memento_data
+                        }
+
+                    elif element['type'] == 'text':
+
+                        yield {
+                            "type": "text",
+                            "text": element['value']
+                        }
+
+                    else:
+                        module_logger.warning(
+                            "element of type {} is unsupported, skipping...".format(element['type'])
+                        )
+
+                except KeyError:
+
+                    module_logger.exception(
+                        "cannot process story element data of {}, skipping...".format(element)
+                    )
+
+            module_logger.info("processed {} story elements".format(elementcounter))
+
+        template = compile_template(get_sanitized_template(story_template), sandboxed=self.sandboxed_templates)
+
+        return template.generate(
+            title=story_data['title'],
+            generated_by=story_data['generated_by'],
+            collection_url=story_data['collection_url'],
+            story_image=story_data['story image'],
+            generation_date=story_data['generation_date'],
+            metadata=story_data.get('metadata'),
+            elements=iter_elements()
+        )
+
     def publish_story(self, story_output_data):
 
         module_logger.info("writing story to file named {}".format(self.output_filename))
 
         with open(self.output_filename, 'w') as f:
-            f.write(story_output_data)
+
+            if isinstance(story_output_data, str):
+                f.write(story_output_data)
+
+            else:
+
+                last_flush = time.monotonic()
+
+                for text in story_output_data:
+
+                    f.write(text)
+
+                    # flushed now and then so that the story can be read while it is written
+                    if time.monotonic() - last_flush > stream_flush_interval:
+                        f.flush()
+                        last_flush = time.monotonic()
 
         module_logger.info(
             "Your story has been told to file {}".format(
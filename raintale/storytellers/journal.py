@@ -0,0 +1,200 @@
+import os
+import json
+import logging
+
+module_logger = logging.getLogger('raintale.storytellers.journal')
+
+class PublishJournalError(Exception):
+
+    def __init__(self, message):
+        super(PublishJournalError, self).__init__(message)
+        self.message = message
+
+class PublishJournal:
+    """
+        Durably records the generated output of a story and the ID of each
+        post as it is published, so that an interrupted publication can be
+        resumed from the last confirmed post instead of starting over.
+
+        The journal is a file of JSON lines. Every line is flushed to disk
+        before publishing continues, and a partially written last line from
+        a crash is ignored when the journal is read back.
+
+        An existing journal is only read if `resume` is True, otherwise it
+        is replaced once publishing starts.
+
+        When publishing is pipelined with generating, each post is recorded
+        as it is generated, and the journal notes once all of them are.
+    """
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.story_output_data = None
+        self.posts = {}
+        self.last_post_index = None
+        self.location = None
+        self.generated = False
+
+        if resume is True and os.path.exists(self.filename):
+            self.load()
+
+    def load(self):
+
+        with open(self.filename) as f:
+            lines = f.readlines()
+
+        for linenumber, line in enumerate(lines, start=1):
+
+            try:
+                record = json.loads(line)
+            except ValueError:
+
+                if linenumber == len(lines):
+                    module_logger.warning("ignoring incomplete last record in publish journal {}".format(self.filename))
+                    break
+
+                msg = "Publish journal {} is corrupt at line {}, cannot continue...".format(self.filename, linenumber)
+                module_logger.critical(msg)
+                raise PublishJournalError(msg)
+
+            self.apply(record)
+
+    def apply(self, record):
+
+        event = record.get('event')
+
+        if event == 'story':
+            self.story_output_data = record['story_output_data']
+            self.posts = {}
+            self.last_post_index = None
+            self.location = None
+            self.generated = record.get('generated', True)
+
+        elif event == 'element':
+            comment_posts = self.story_output_data['comment_posts']
+
+            if record['index'] < len(comment_posts):
+                comment_posts[record['index']] = record['post']
+            else:
+                comment_posts.append(record['post'])
+
+        elif event == 'generated':
+            self.generated = True
+
+        elif event == 'post':
+            self.posts[record['index']] = record
+
+            if record['index'] != 'title':
+                if self.last_post_index is None or record['index'] > self.last_post_index:
+                    self.last_post_index = record['index']
+
+        elif event == 'complete':
+            self.location = record['location']
+
+    def write(self, record, mode='a'):
+
+        with open(self.filename, mode) as f:
+            f.write("{}\n".format(json.dumps(record)))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.apply(record)
+
+    def has_story(self):
+        return self.story_output_data is not None
+
+    def is_complete(self):
+        return self.location is not None
+
+    def is_generated(self):
+        """
+            Returns False if the story was interrupted before all of its
+            posts were generated.
+        """
+        return self.generated
+
+    def start(self, story_output_data):
+        """
+            Starts a new journal for `story_output_data`, replacing any
+            earlier contents.
+        """
+        self.write({ "event": "story", "story_output_data": story_output_data }, mode='w')
+
+    def start_stream(self, main_post):
+        """
+            Starts a new journal for a story whose comment posts are
+            recorded by `record_element` as they are generated.
+        """
+        self.write({
+            "event": "story",
+            "story_output_data": { "main_post": main_post, "comment_posts": [] },
+            "generated": False
+        }, mode='w')
+
+    def extend(self, comment_posts):
+        """
+            Completes a story whose generation was interrupted with the
+            `comment_posts` generated again, recording those past the ones
+            already generated, so that the posts already published are
+            kept.
+        """
+
+        for index in range(len(self.story_output_data['comment_posts']), len(comment_posts)):
+            self.record_element(index, comment_posts[index])
+
+        self.record_generated()
+
+    def record_element(self, index, post):
+        self.write({ "event": "element", "index": index, "post": post })
+
+    def record_generated(self):
+        self.write({ "event": "generated" })
+
+    def get_post(self, index):
+        """
+            Returns the record of the post for `index`, either 'title' or the
+            position of a story element, or None if it was not published.
+        """
+        return self.posts.get(index)
+
+    def get_last_post_id(self):
+        """
+            Returns the ID of the most recent post that was confirmed by the
+            service, the title post if no story element was published.
+        """
+
+        for index in sorted([ i for i in self.posts if i != 'title' ], reverse=True):
+            if self.posts[index]['id'] is not None:
+                return self.posts[index]['id']
+
+        title = self.posts.get('title')
+
+        if title is not None:
+            return title['id']
+
+        return None
+
+    def get_next_index(self):
+        """
+            Returns the position of the first story element after the last
+            one that was published or skipped.
+        """
+
+        if self.last_post_index is None:
+            return 0
+
+        return self.last_post_index + 1
+
+    def record_post(self, index, post_id, **details):
+        """
+            Records that the post for `index` was published with `post_id`.
+            A `post_id` of None records that the element was skipped.
+        """
+
+        record = { "event": "post", "index": index, "id": post_id }
+        record.update(details)
+
+        self.write(record)
+
+    def record_complete(self, location):
+        self.write({ "event": "complete", "location": location })
@@ -0,0 +1,136 @@
+import logging
+import threading
+
+module_logger = logging.getLogger('raintale.storytellers.poststream')
+
+class PostStream:
+    """
+        The comment posts of a story, appended in story order by the thread
+        generating them while a storyteller publishes the posts that are
+        already available. Reading a post that is not yet generated waits
+        for it.
+
+        If generating fails, the error is raised to the reader once the
+        posts generated before it have been read.
+    """
+
+    def __init__(self):
+        self._posts = []
+        self._closed = False
+        self._error = None
+        self._listeners = []
+        self._condition = threading.Condition()
+
+    def append(self, post):
+
+        with self._condition:
+            self._posts.append(post)
+
+            for on_post, on_close in self._listeners:
+                on_post(len(self._posts) - 1, post)
+
+            self._condition.notify_all()
+
+    def close(self, error=None):
+        """
+            Marks the stream as complete, or as failed with `error`.
+        """
+
+        with self._condition:
+            self._closed = True
+            self._error = error
+
+            if error is None:
+                for on_post, on_close in self._listeners:
+                    on_close()
+
+            self._condition.notify_all()
+
+    def subscribe(self, on_post, on_close):
+        """
+            Calls `on_post` with the index of each post and the post, from
+            the first one on, and `on_close` once every post has been
+            generated.
+        """
+
+        with self._condition:
+
+            for index, post in enumerate(self._posts):
+                on_post(index, post)
+
+            if self._closed is True:
+                if self._error is None:
+                    on_close()
+            else:
+                self._listeners.append( (on_post, on_close) )
+
+    def wait_for(self, index):
+        """
+            Waits until the post at `index` is generated and returns True,
+            or returns False if the story has fewer posts.
+        """
+
+        with self._condition:
+
+            while len(self._posts) <= index and self._closed is False:
+                self._condition.wait()
+
+            if len(self._posts) > index:
+                return True
+
+            if self._error is not None:
+                raise self._error
+
+            return False
+
+    def get_posts(self, start, limit):
+        """
+            Returns up to `limit` posts from `start` on, waiting for the
+            first of them but not for the rest.
+        """
+
+        if self.wait_for(start) is False:
+            return []
+
+        with self._condition:
+            return self._posts[start:start + limit]
+
+    def __iter__(self):
+
+        index = 0
+
+        while self.wait_for(index) is True:
+            yield self._posts[index]
+            index += 1
+
+    def get_count(self):
+        """
+            Returns the number of posts, or None while they are still being
+            generated.
+        """
+
+        with self._condition:
+
+            if self._closed is True:
+                return len(self._posts)
+
+            return None
+
+def get_posts(comment_posts, start, limit):
+    """
+        Returns up to `limit` posts from `start` on from either a list of
+        comment posts or a PostStream.
+    """
+
+    if isinstance(comment_posts, PostStream):
+        return comment_posts.get_posts(start, limit)
+
+    return comment_posts[start:start + limit]
+
+def get_post_count(comment_posts):
+
+    if isinstance(comment_posts, PostStream):
+        count = comment_posts.get_count()
+        return "?" if count is None else count
+
+    return len(comment_posts)
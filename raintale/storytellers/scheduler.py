@@ -0,0 +1,254 @@
+import json
+import logging
+import threading
+import time
+
+module_logger = logging.getLogger('raintale.storytellers.scheduler')
+
+class PublishSchedulerRateLimitError(Exception):
+
+    def __init__(self, message):
+        super(PublishSchedulerRateLimitError, self).__init__(message)
+        self.message = message
+
+class TokenBucket:
+    """
+        A token bucket holding up to `capacity` tokens that refills at `rate`
+        tokens per second. Each publishing request consumes one token, or
+        as many as the service counts it as, such as a batch of posts.
+    """
+
+    def __init__(self, capacity, rate, clock=time.time):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.clock = clock
+        self.last_refill = clock()
+
+    def refill(self):
+
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def get_delay(self, cost=1):
+        """
+            Returns the number of seconds until `cost` tokens are available.
+            A request costing more than the bucket holds waits for a full
+            bucket and leaves it in debt, delaying the requests after it.
+        """
+
+        self.refill()
+
+        needed = min(cost, self.capacity)
+
+        if self.tokens >= needed:
+            return 0
+
+        return (needed - self.tokens) / self.rate
+
+    def consume(self, cost=1):
+
+        self.refill()
+        self.tokens -= cost
+
+    def limit_tokens(self, tokens):
+
+        self.refill()
+        self.tokens = min(self.tokens, tokens)
+
+def get_usage_percentage(header_value):
+    """
+        Returns the highest percentage reported in a Facebook usage header,
+        such as X-App-Usage or X-Business-Use-Case-Usage, along with the
+        number of seconds Facebook estimates until access is regained.
+    """
+
+    try:
+        usage = json.loads(header_value)
+    except ValueError:
+        return 0, 0
+
+    # X-Business-Use-Case-Usage nests a list of usage entries under each business ID
+    if type(usage) == dict and len(usage) > 0 and all(type(v) == list for v in usage.values()):
+        entries = [ entry for value in usage.values() for entry in value ]
+    else:
+        entries = [ usage ]
+
+    percentage = 0
+    regain_seconds = 0
+
+    for entry in entries:
+
+        if type(entry) != dict:
+            continue
+
+        for key in [ "call_count", "total_time", "total_cputime" ]:
+            try:
+                percentage = max(percentage, float(entry.get(key, 0)))
+            except (TypeError, ValueError):
+                pass
+
+        try:
+            regain_seconds = max(regain_seconds, float(entry.get("estimated_time_to_regain_access", 0)) * 60)
+        except (TypeError, ValueError):
+            pass
+
+    return percentage, regain_seconds
+
+class PublishScheduler:
+    """
+        Paces publishing requests to a social media service. Requests go out
+        as fast as a token bucket allows, the bucket is drained early when
+        the rate limit headers of the service say that few requests remain,
+        and publishing pauses until the service's reset time once none do.
+
+        Errors that `is_rate_limit_error` recognizes are retried with
+        exponential backoff instead of being raised, up to `max_retries`
+        times.
+
+        A scheduler may be shared by several threads.
+    """
+
+    def __init__(self, requests_per_window, window_seconds, is_rate_limit_error=None,
+        max_retries=10, initial_backoff=15, max_backoff=15 * 60,
+        clock=time.time, sleep=time.sleep):
+
+        self.bucket = TokenBucket(requests_per_window, requests_per_window / window_seconds, clock=clock)
+        self.is_rate_limit_error = is_rate_limit_error
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.paused_until = 0
+        self.lock = threading.RLock()
+
+    def pause_until(self, timestamp):
+
+        with self.lock:
+
+            if timestamp > self.paused_until:
+                module_logger.info("pausing publishing for {:.0f} seconds to respect the service's rate limit".format(
+                    timestamp - self.clock()
+                ))
+                self.paused_until = timestamp
+
+    def wait(self, cost=1):
+        """
+            Blocks until the next publishing request, which the service
+            counts as `cost` requests, is allowed.
+        """
+
+        while True:
+
+            with self.lock:
+
+                now = self.clock()
+
+                if self.paused_until > now:
+                    delay = self.paused_until - now
+                else:
+                    delay = self.bucket.get_delay(cost)
+
+                    if delay <= 0:
+                        self.bucket.consume(cost)
+                        return
+
+            module_logger.debug("waiting {:.2f} seconds for the next publishing slot".format(delay))
+            self.sleep(delay)
+
+    def update_from_headers(self, headers):
+        """
+            Adjusts the pace of publishing from the rate limit headers of a
+            service response: Retry-After, Twitter's X-Rate-Limit headers,
+            and Facebook's usage headers.
+        """
+
+        with self.lock:
+
+            now = self.clock()
+
+            retry_after = headers.get('retry-after')
+
+            if retry_after is not None:
+                try:
+                    self.pause_until(now + float(retry_after))
+                except ValueError:
+                    pass
+
+            remaining = headers.get('x-rate-limit-remaining')
+            reset = headers.get('x-rate-limit-reset')
+
+            if remaining is not None and reset is not None:
+
+                try:
+                    remaining = int(remaining)
+                    reset = float(reset)
+                except ValueError:
+                    remaining = None
+
+                if remaining is not None:
+
+                    if remaining <= 0:
+                        self.pause_until(reset)
+                    else:
+                        self.bucket.limit_tokens(remaining)
+
+            for header in [ 'x-app-usage', 'x-page-usage', 'x-ad-account-usage', 'x-business-use-case-usage' ]:
+
+                if header in headers:
+
+                    percentage, regain_seconds = get_usage_percentage(headers[header])
+
+                    if percentage >= 100 and regain_seconds > 0:
+                        self.pause_until(now + regain_seconds)
+                    else:
+                        # slow down as usage approaches the limit
+                        self.bucket.limit_tokens(self.bucket.capacity * (100 - percentage) / 100)
+
+    def response_hook(self, response, *args, **kwargs):
+        """
+            A requests response hook that feeds every service response to
+            update_from_headers.
+        """
+
+        self.update_from_headers(response.headers)
+
+    def call(self, function, *args, cost=1, **kwargs):
+        """
+            Calls `function` once the schedule allows it, retrying with
+            backoff if it fails with a rate limit error. The call counts as
+            `cost` requests, such as a batch request of that many posts.
+        """
+
+        attempt = 0
+
+        while True:
+
+            self.wait(cost)
+
+            try:
+                return function(*args, **kwargs)
+
+            except Exception as e:
+
+                if self.is_rate_limit_error is None or not self.is_rate_limit_error(e):
+                    raise
+
+                attempt += 1
+
+                if attempt > self.max_retries:
+                    msg = "service rate limit still exceeded after {} retries, cannot continue...".format(self.max_retries)
+                    module_logger.critical(msg)
+                    raise PublishSchedulerRateLimitError(msg) from e
+
+                backoff = min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))
+
+                module_logger.warning("service rate limit reached ({}), retry {} of {} after backing off".format(
+                    e, attempt, self.max_retries))
+
+                # the response headers may already have told us when the limit resets
+                with self.lock:
+                    if self.paused_until <= self.clock():
+                        self.pause_until(self.clock() + backoff)
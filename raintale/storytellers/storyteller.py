@@ -2,13 +2,28 @@ import logging
 import sys # for debugging
 import pprint # for debugging
 
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
 from yaml import load, Loader
-from jinja2 import Template
+from jinja2 import Environment
+from jinja2.sandbox import SandboxedEnvironment
 
+from .scheduler import PublishScheduler
+from .journal import PublishJournal
+from .poststream import PostStream
 from ..surrogatedata import get_template_surrogate_fields, MementoData
 
 module_logger = logging.getLogger('raintale.storytellers.storyteller')
 
+# compiled templates are kept for reuse across elements and stories, rendering them is thread safe
+template_environment = Environment()
+
+# templates that come from outside, such as with a job request, cannot reach Python objects through their variables
+sandboxed_template_environment = SandboxedEnvironment()
+
 class StoryTellerException(Exception):
     pass
 
@@ -21,6 +36,9 @@ class StoryTellerStoryParseError(StoryTellerException):
 class StoryTellerMultipartTemplateParseError(StoryTellerException):
     pass
 
+class StoryTellerPublishStoppedError(StoryTellerException):
+    pass
+
 def get_story_elements(story_data):
 
     try:
@@ -75,10 +93,84 @@ def split_multipart_template(template_contents):
 
     return title_template, element_template, media_template, cleaned_media_list
 
+@lru_cache(maxsize=256)
+def compile_template(template_string, sandboxed=False):
+    """
+        Returns `template_string` compiled as a Jinja2 template, compiling
+        each distinct template only once per process. A `sandboxed`
+        template raises jinja2.exceptions.SecurityError when rendering it
+        reaches for unsafe attributes.
+    """
+
+    if sandboxed is True:
+        return sandboxed_template_environment.from_string(template_string)
+
+    return template_environment.from_string(template_string)
+
+def tell_stories(storytelling, story_data, mementoembed_api, max_workers=None):
+    """
+        Tells the same story with each (storyteller, story template) pair
+        in `storytelling` concurrently. The storytellers should share a
+        surrogate dataset so that MementoEmbed is only consulted once.
+
+        Returns the location of each story, in order, or None for those
+        that failed, so that one failing service does not stop the others.
+    """
+
+    if max_workers is None:
+        max_workers = len(storytelling)
+
+    locations = []
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+
+        futures = [
+            executor.submit(storyteller.tell_story, story_data, mementoembed_api, story_template)
+                for storyteller, story_template in storytelling
+        ]
+
+        for (storyteller, story_template), future in zip(storytelling, futures):
+
+            try:
+                locations.append(future.result())
+            except Exception:
+                module_logger.exception("storyteller {} failed to tell the story".format(storyteller))
+                locations.append(None)
+
+    return locations
+
 class Storyteller:
 
     description = "ERROR"
 
+    # when set, surrogate data comes from this SurrogateDataset instead of MementoEmbed
+    surrogate_dataset = None
+
+    # when set, MementoEmbed is consulted through this session, such as one caching its responses
+    mementoembed_session = None
+
+    # when set, a FetchProgress that follows the requests made to MementoEmbed
+    progress = None
+
+    # when set, called to create the surrogate store that keeps the fetched surrogate data
+    surrogate_store_factory = None
+
+    # when True, templates are rendered in a Jinja2 sandbox, as are those that come with a job request
+    sandboxed_templates = False
+
+    @classmethod
+    def get_options_from_arguments(cls, args):
+        """
+            Returns the keyword arguments, taken from the parsed command
+            line arguments, that this storyteller accepts when created.
+        """
+        return {}
+
+    def make_memento_data(self, template_string, mementoembed_api):
+        return MementoData(template_string, mementoembed_api, surrogate_dataset=self.surrogate_dataset,
+            session=self.mementoembed_session, progress=self.progress,
+            store=None if self.surrogate_store_factory is None else self.surrogate_store_factory())
+
     def generate_story(self, story_data, mementoembed_api, story_template):
         raise NotImplementedError(
             "StoryTeller class is not meant to be called directly. "
@@ -102,19 +194,141 @@ class ServiceStoryteller(Storyteller):
     requires_file = False
     requires_credentials = True
 
-    def __init__(self, credentials_filename, auth_check=True):
+    # the publishing limit of the service, child classes override these
+    publish_requests_per_window = 1
+    publish_window_seconds = 2
+
+    # when set, a threading.Event that stops publishing before the next post, such as when a worker loses its job
+    stop_publishing = None
+
+    def __init__(self, credentials_filename, auth_check=True, journal_filename=None, resume=False,
+        pipelined=False):
         self.credentials_filename = credentials_filename
+        self.pipelined = pipelined
+        self.scheduler = PublishScheduler(
+            self.publish_requests_per_window,
+            self.publish_window_seconds,
+            is_rate_limit_error=self.is_rate_limit_error
+        )
+
+        if journal_filename is None:
+            self.journal = None
+        else:
+            self.journal = PublishJournal(journal_filename, resume=resume)
+
         self.load_credentials_filename()
 
         if auth_check is True:
             self.auth()
 
+    @classmethod
+    def get_options_from_arguments(cls, args):
+
+        options = {}
+
+        if getattr(args, 'journal_filename', None) is not None:
+            options['journal_filename'] = args.journal_filename
+
+        if getattr(args, 'resume', False) is True:
+            options['resume'] = True
+
+        if getattr(args, 'pipelined', False) is True:
+            options['pipelined'] = True
+
+        return options
+
+    def tell_story(self, story_data, mementoembed_api, story_template):
+
+        if self.journal is not None and self.journal.has_story():
+
+            if self.journal.is_complete():
+                module_logger.info("publish journal {} shows that this story was already told".format(self.journal.filename))
+                return self.journal.location
+
+            if self.journal.is_generated():
+
+                module_logger.info("resuming story from publish journal {} without generating it again".format(
+                    self.journal.filename))
+
+                return self.publish_story(self.journal.story_output_data)
+
+            module_logger.info("publish journal {} was interrupted while the story was generated, "
+                "generating it again".format(self.journal.filename))
+
+        if self.pipelined is True:
+            return self.publish_story(self.generate_story_stream(story_data, mementoembed_api, story_template))
+
+        return super(ServiceStoryteller, self).tell_story(story_data, mementoembed_api, story_template)
+
+    def get_publish_journal(self, story_output_data):
+        """
+            Returns the publish journal for `story_output_data`, starting a
+            new one if the journal holds a different story, or None if
+            publishing is not journaled.
+        """
+
+        if self.journal is None:
+            return None
+
+        comment_posts = story_output_data["comment_posts"]
+
+        if isinstance(comment_posts, PostStream):
+
+            # posts generated again after an interruption keep the posts already published
+            if self.journal.story_output_data is None or \
+                self.journal.story_output_data["main_post"] != story_output_data["main_post"]:
+                self.journal.start_stream(story_output_data["main_post"])
+
+            comment_posts.subscribe(self.journal.record_element, self.journal.record_generated)
+
+        elif self.journal.story_output_data == story_output_data:
+            pass
+
+        elif self.journal.has_story() and self.journal.is_generated() is False and \
+            self.journal.story_output_data["main_post"] == story_output_data["main_post"]:
+
+            # a pipelined story interrupted while it was generated, resumed without pipelining
+            if self.journal.story_output_data["comment_posts"] != comment_posts[0:len(self.journal.story_output_data["comment_posts"])]:
+                module_logger.warning("story elements generated again differ from those in publish journal {}, "
+                    "keeping the ones already published".format(self.journal.filename))
+
+            self.journal.extend(comment_posts)
+
+        else:
+            self.journal.start(story_output_data)
+
+        return self.journal
+
+    def check_publishing(self):
+        """
+            Raises StoryTellerPublishStoppedError if publishing was told to
+            stop, so that nothing more is posted.
+        """
+
+        if self.stop_publishing is not None and self.stop_publishing.is_set():
+            msg = "publishing was stopped before the story was told, the publish journal records what was posted"
+            module_logger.error(msg)
+            raise StoryTellerPublishStoppedError(msg)
+
     def load_credentials_filename(self):
 
         with open(self.credentials_filename) as f:
             self.credentials = load(f, Loader=Loader)
 
-    def generate_story(self, story_data, mementoembed_api, story_template, session=None):
+    def generate_main_post(self, story_data, title_template):
+
+        return compile_template(title_template, sandboxed=self.sandboxed_templates).render(
+                title=story_data['title'],
+                generated_by=story_data['generated_by'],
+                collection_url=story_data['collection_url'],
+                metadata=story_data['metadata']
+        )
+
+    def iter_comment_posts(self, story_data, mementoembed_api, story_template, session=None):
+        """
+            Generates the comment post of each story element in story
+            order, yielding each as soon as its surrogates are fetched.
+        """
 
         title_template, element_template, media_template, media_template_list = split_multipart_template(story_template)
 
@@ -123,38 +337,26 @@ class ServiceStoryteller(Storyteller):
         module_logger.debug("media_template_list: {}".format(media_template_list))
 
         module_logger.debug("media_template: [{}]".format(media_template))
-        
-        story_output_data = {
-            "main_post": "",
-            "comment_posts": []
-        }
-
-        story_output_data["main_post"] = Template(title_template).render(
-                title=story_data['title'],
-                generated_by=story_data['generated_by'],
-                collection_url=story_data['collection_url'],
-                metadata=story_data['metadata']
-        )
 
         module_logger.info("preparing to iterate through {} story "
             "elements".format(len(story_elements)))
 
-        md = MementoData(element_template, mementoembed_api)
+        md = self.make_memento_data(element_template, mementoembed_api)
 
         # handle the case where there no media is requested
         if media_template == "\n" or media_template == '':
             md_media = None
         else:
-            md_media = MementoData(media_template, mementoembed_api)
+            md_media = self.make_memento_data(media_template, mementoembed_api)
         
         # TODO: how to handle media part of template?
 
-        for element in story_elements:
+        urims = [ element['value'] for element in story_elements if element.get('type') == 'link' ]
 
-            if element['type'] == 'link':
+        link_data = md.iter_memento_data(urims, session=session)
 
-                urim = element['value']
-                md.add(urim)
+        if md_media is not None:
+            link_media_data = md_media.iter_memento_data(urims, session=session)
 
         for element in story_elements:
 
@@ -164,16 +366,22 @@ class ServiceStoryteller(Storyteller):
 
                 if element['type'] == 'link':
 
-                    urim = element['value']
+                    urim, memento_data = next(link_data)
 
-                    memento_data = md.get_memento_data(urim, session=session)
+                    if md_media is not None:
+                        urim, media_data = next(link_media_data)
+
+                    if memento_data is None:
+                        raise KeyError(urim)
 
                     module_logger.debug("memento_data: {}".format(memento_data))
 
                     media_uris = []
 
                     if md_media is not None:
-                        media_data = md_media.get_memento_data(urim, session=session)
+
+                        if media_data is None:
+                            raise KeyError(urim)
 
                         for variable in media_template_list:
                             sanitized_variable = variable.replace('{{ element.surrogate.', '').replace('}}', '')
@@ -185,27 +393,23 @@ class ServiceStoryteller(Storyteller):
 
                     module_logger.debug("media_uris: {}".format(media_uris))
 
-                    story_output_data["comment_posts"].append(
-                        {
-                            "text": Template(element_template).render(
-                                {
-                                    "element": {
-                                        "surrogate": memento_data
-                                    }
+                    yield {
+                        "text": compile_template(element_template, sandboxed=self.sandboxed_templates).render(
+                            {
+                                "element": {
+                                    "surrogate": memento_data
                                 }
-                            ),
-                            "media": media_uris
-                        }
-                    )
+                            }
+                        ),
+                        "media": media_uris
+                    }
 
                 elif element['type'] == 'text':
 
-                    story_output_data["comment_posts"].append(
-                        {
-                            "text": element['value'],
-                            "media": []
-                        }
-                    )
+                    yield {
+                        "text": element['value'],
+                        "media": []
+                    }
 
                 else:
                     module_logger.warning(
@@ -218,17 +422,63 @@ class ServiceStoryteller(Storyteller):
                     "cannot process story element data of {}, skipping".format(element)
                 )
 
+    def generate_story(self, story_data, mementoembed_api, story_template, session=None):
+
+        title_template, element_template, media_template, media_template_list = split_multipart_template(story_template)
+
+        story_output_data = {
+            "main_post": self.generate_main_post(story_data, title_template),
+            "comment_posts": list(self.iter_comment_posts(story_data, mementoembed_api, story_template, session=session))
+        }
+
         module_logger.debug(
             "story_output_data: {}".format(pprint.pformat(story_output_data))
         )
 
         return story_output_data
 
+    def generate_story_stream(self, story_data, mementoembed_api, story_template, session=None):
+        """
+            Like generate_story, but returns as soon as the main post is
+            ready, with a PostStream of comment posts that a separate
+            thread fills in story order.
+        """
+
+        title_template, element_template, media_template, media_template_list = split_multipart_template(story_template)
+
+        comment_posts = PostStream()
+
+        def generate_comment_posts():
+
+            try:
+                for comment_post in self.iter_comment_posts(story_data, mementoembed_api, story_template, session=session):
+                    comment_posts.append(comment_post)
+            except Exception as e:
+                module_logger.exception("failed to generate the story, publishing stops after the last generated element")
+                comment_posts.close(error=e)
+            else:
+                comment_posts.close()
+
+        generator = threading.Thread(target=generate_comment_posts, name="raintale-generate", daemon=True)
+        generator.start()
+
+        return {
+            "main_post": self.generate_main_post(story_data, title_template),
+            "comment_posts": comment_posts
+        }
+
     def auth(self):
         raise NotImplementedError(
             "ServiceStoryTeller class is not meant to be called directly. "
             "Create a child class to use ServiceStoryTeller functionality.")
 
+    def is_rate_limit_error(self, exception):
+        """
+            Returns True if `exception` means the service's rate limit was
+            reached, so the request should be retried later.
+        """
+        return False
+
     def reset_credentials(self, credentials):
         raise NotImplementedError(
             "ServiceStoryTeller class is not meant to be called directly. "
@@ -1,17 +1,158 @@
+import os
+import logging
+import importlib
 
-from .filetemplate import FileTemplateStoryTeller
-from .twitter import TwitterStoryTeller
-from .facebook import FacebookStoryTeller
-from .video import VideoStoryTeller
+from collections.abc import Mapping
 
-storytellers = {
-    "facebook": FacebookStoryTeller,
-    "twitter": TwitterStoryTeller,
+module_logger = logging.getLogger('raintale.storytellers.storytellers')
+
+package_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# other packages provide storytellers by naming their classes in this entry point group
+storyteller_entry_point_group = "raintale.storytellers"
+
+# the module, class, and description of each storyteller included with raintale
+builtin_storytellers = {
+    "facebook": (
+        "raintale.storytellers.facebook", "FacebookStoryTeller",
+        "(EXPERIMENTAL) Given input data and a template file, this storyteller publishes a story as a Facebook thread."
+    ),
+    "twitter": (
+        "raintale.storytellers.twitter", "TwitterStoryTeller",
+        "Given input data and a template file, this storyteller publishes a story as a Twitter thread."
+    ),
     # "blogger": BloggerStoryTeller,
-    "template": FileTemplateStoryTeller,
-    "video": VideoStoryTeller
+    "template": (
+        "raintale.storytellers.filetemplate", "FileTemplateStoryTeller",
+        "Given input data and a template file, this storyteller generates a story formatted based on the template and saves it to an output file."
+    ),
+    "video": (
+        "raintale.storytellers.video", "VideoStoryTeller",
+        "(EXPERIMENTAL) Given input data, this storyteller creates a video of the top images and sentences "
+        "of each memento. The output format (MP4, animated GIF, or animated WebP) follows the output filename extension."
+    )
 }
 
 storytellers_without_templates = [
     "video"
 ]
+
+class StorytellerRegistry(Mapping):
+    """
+        Maps storyteller names to their classes, importing each class, and
+        the services it depends on, only when it is first looked up.
+
+        Besides the storytellers included with raintale, other packages
+        may provide storytellers in the "raintale.storytellers" entry point
+        group, for example in setup.py:
+
+            entry_points={
+                "raintale.storytellers": [
+                    "mastodon = raintale_mastodon:MastodonStoryTeller"
+                ]
+            }
+    """
+
+    def __init__(self, builtin, entry_point_group=None):
+        self._builtin = dict(builtin)
+        self._entry_point_group = entry_point_group
+        self._entry_points = None
+        self._classes = {}
+
+    def get_entry_points(self):
+
+        if self._entry_points is None:
+
+            self._entry_points = {}
+
+            # importing the package metadata is slow, so it waits until a storyteller is not built in
+            try:
+                from importlib.metadata import entry_points
+            except ImportError: # Python before 3.8
+                entry_points = None
+
+            if self._entry_point_group is not None and entry_points is not None:
+
+                try:
+                    group = entry_points(group=self._entry_point_group)
+                except TypeError: # Python before 3.10
+                    group = entry_points().get(self._entry_point_group, [])
+
+                for entry_point in group:
+
+                    if entry_point.name in self._builtin:
+                        module_logger.warning("ignoring storyteller {} from entry point {}, "
+                            "it is included with raintale".format(entry_point.name, entry_point.value))
+                        continue
+
+                    self._entry_points[entry_point.name] = entry_point
+
+        return self._entry_points
+
+    def __getitem__(self, name):
+
+        if name not in self._classes:
+
+            if name in self._builtin:
+                module_name, class_name, description = self._builtin[name]
+                self._classes[name] = getattr(importlib.import_module(module_name), class_name)
+
+            elif name in self.get_entry_points():
+                self._classes[name] = self.get_entry_points()[name].load()
+
+            else:
+                raise KeyError(name)
+
+        return self._classes[name]
+
+    def __iter__(self):
+
+        for name in self._builtin:
+            yield name
+
+        for name in self.get_entry_points():
+            yield name
+
+    def __len__(self):
+        return len(self._builtin) + len(self.get_entry_points())
+
+    def __contains__(self, name):
+        return name in self._builtin or name in self.get_entry_points()
+
+    def get_description(self, name):
+        """
+            Returns the description of storyteller `name`, without importing
+            it if it is included with raintale.
+        """
+
+        if name in self._builtin:
+            return self._builtin[name][2]
+
+        return self[name].description
+
+storytellers = StorytellerRegistry(builtin_storytellers, storyteller_entry_point_group)
+
+_template_index = None
+
+def get_template_index():
+    """
+        Returns the storytellers and the presets of the templates included
+        with raintale, listing the templates directory only once.
+    """
+
+    global _template_index
+
+    if _template_index is None:
+
+        template_storytellers = []
+        presets = []
+
+        for filename in sorted(os.listdir(os.path.join(package_directory, "templates"))):
+
+            preset, fileformat = filename.split('.')
+            template_storytellers.append(fileformat)
+            presets.append(preset)
+
+        _template_index = (template_storytellers, presets)
+
+    return _template_index
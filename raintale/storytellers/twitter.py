@@ -1,27 +1,129 @@
 import logging
 import mimetypes
-import tempfile
-import os
-import time
 import io
+import concurrent.futures
+import itertools
+import queue
+import hashlib
+import threading
 import sys # for debugging
 import pprint # for debugging
 
 import twitter
-import requests
+
+from twitter.twitter_utils import parse_media_file
 
 from jinja2 import Template
-from PIL import Image
 
 from .storyteller import ServiceStoryteller, get_story_elements, StoryTellerCredentialParseError, split_multipart_template
-from ..surrogatedata import datauri_to_data
+from .scheduler import PublishScheduler
+from .poststream import get_post_count
+from ..httpcache import default_expire_after, default_max_cache_size
+from ..mediacache import MediaCache
 
 module_logger = logging.getLogger('raintale.storytellers.twitter')
 
+# media types that python-twitter uploads in chunks
+chunked_media_types = [ 'video/mp4', 'video/quicktime', 'image/gif' ]
+
+# Twitter error codes for exceeded rate limits and temporary overload
+twitter_rate_limit_error_codes = [ 88, 130, 185 ]
+
+# the story elements whose media is uploaded ahead of the tweet being posted
+media_upload_lookahead = 4
+
+twitter_rate_limit_error_messages = [
+    "Capacity Error",
+    "Exceeded connection limit for user"
+]
+
+def is_twitter_rate_limit_error(exception):
+
+    if not isinstance(exception, twitter.error.TwitterError):
+        return False
+
+    errors = exception.message
+
+    if type(errors) != list:
+        errors = [ errors ]
+
+    for error in errors:
+
+        if type(error) == dict:
+
+            if error.get('code') in twitter_rate_limit_error_codes:
+                return True
+
+            if error.get('message') in twitter_rate_limit_error_messages:
+                return True
+
+    return False
+
+class MediaBuffer(io.BytesIO):
+    """
+        In-memory media for python-twitter's upload methods, which only
+        accept file objects opened in binary mode and guess the media type
+        from the file name.
+    """
+
+    mode = 'rb'
+
+    def __init__(self, data, mimetype):
+        super(MediaBuffer, self).__init__(data)
+        self.mimetype = mimetype
+        self.name = "raintale-media{}".format(mimetypes.guess_extension(mimetype) or "")
+
 class TwitterStoryTeller(ServiceStoryteller):
 
     description = "Given input data and a template file, this storyteller publishes a story as a Twitter thread."
 
+    # Twitter allows 300 tweets per user every 3 hours
+    publish_requests_per_window = 300
+    publish_window_seconds = 3 * 60 * 60
+
+    # Twitter allows 615 media uploads per user every 15 minutes
+    media_upload_requests_per_window = 615
+    media_upload_window_seconds = 15 * 60
+
+    def __init__(self, credentials_filename, auth_check=True, journal_filename=None, resume=False,
+        pipelined=False, media_upload_workers=4, cache_directory=None, cache_expire_after=default_expire_after,
+        cache_max_size=default_max_cache_size):
+
+        self.media_upload_workers = media_upload_workers
+        self.start_thread_media()
+        self.media_cache = MediaCache(
+            cache_directory=cache_directory,
+            expire_after=cache_expire_after,
+            max_cache_size=cache_max_size
+        )
+        self.media_scheduler = PublishScheduler(
+            self.media_upload_requests_per_window,
+            self.media_upload_window_seconds,
+            is_rate_limit_error=self.is_rate_limit_error
+        )
+
+        super(TwitterStoryTeller, self).__init__(credentials_filename, auth_check=auth_check,
+            journal_filename=journal_filename, resume=resume, pipelined=pipelined)
+
+    @classmethod
+    def get_options_from_arguments(cls, args):
+
+        options = super(TwitterStoryTeller, cls).get_options_from_arguments(args)
+
+        if getattr(args, 'max_workers', None) is not None:
+            options['media_upload_workers'] = args.max_workers
+
+        if getattr(args, 'cache_directory', None) is not None:
+            options['cache_directory'] = args.cache_directory
+
+        if getattr(args, 'cache_expire_after', None) is not None:
+            options['cache_expire_after'] = args.cache_expire_after
+
+        if getattr(args, 'cache_max_size', None) is not None:
+            options['cache_max_size'] = args.cache_max_size
+
+        return options
+
     def load_credentials_filename(self):
 
         super(TwitterStoryTeller, self).load_credentials_filename()
@@ -49,11 +151,133 @@ class TwitterStoryTeller(ServiceStoryteller):
             access_token_secret=self.credentials['access_token_secret']
         )
 
+        # python-twitter does not expose its session, but its responses carry the rate limit headers
+        self.api._session.hooks['response'].append(self.response_hook)
+
+    def response_hook(self, response, *args, **kwargs):
+
+        # media uploads and tweets have separate rate limits
+        if response.url.startswith(self.api.upload_url):
+            self.media_scheduler.update_from_headers(response.headers)
+        else:
+            self.scheduler.update_from_headers(response.headers)
+
+    def is_rate_limit_error(self, exception):
+        return is_twitter_rate_limit_error(exception)
+
+    def prepare_media(self, media_uris):
+
+        tweet_media = []
+
+        for media_uri in media_uris:
+
+            module_logger.debug("working on media URI {}".format(media_uri))
+
+            if media_uri != "":
+
+                # download once here so the upload can be sized, python-twitter would download it again
+                media = self.media_cache.fetch(media_uri)
+
+                if media is None:
+                    module_logger.warning("cannot fetch media at {}, leaving it out of the tweet".format(media_uri[0:200]))
+                    continue
+
+                if media.mimetype == 'image/gif' and media_uri[0:5] != 'data:':
+                    # Twitter does not allow multiple animated GIFs, and an imagereel would be a data URI, but it still blocks regular GIFs
+                    media = self.media_cache.convert(media, "png")
+
+                    if media is None:
+                        continue
+
+                tweet_media.append(MediaBuffer(media.data, media.mimetype))
+
+        return tweet_media
+
+    def upload_media(self, media):
+        """
+            Uploads a single MediaBuffer to Twitter and returns its media ID.
+            Like python-twitter's PostUpdate, large files, videos, and GIFs
+            use the chunked upload.
+        """
+
+        _, _, file_size, media_type = parse_media_file(media)
+
+        if file_size > self.api.chunk_size or media_type in chunked_media_types:
+            return self.api.UploadMediaChunked(media=media)
+        else:
+            return self.api.UploadMediaSimple(media=media)
+
+    def upload_thread_media(self, media):
+        """
+            Uploads `media` and returns its media ID, reusing the ID of
+            identical media already uploaded for this thread, such as the
+            same logo found in several mementos of a site.
+        """
+
+        digest = hashlib.sha256(media.getvalue()).hexdigest()
+
+        with self.thread_media_lock:
+            upload_lock = self.thread_media_locks.setdefault(digest, threading.Lock())
+
+        # a concurrent upload of the same media finishes before its ID is looked up
+        with upload_lock:
+
+            if digest in self.thread_media_ids:
+                module_logger.info("reusing media ID {} for identical media".format(self.thread_media_ids[digest]))
+                return self.thread_media_ids[digest]
+
+            media_id = self.media_scheduler.call(self.upload_media, media)
+            self.thread_media_ids[digest] = media_id
+
+        return media_id
+
+    def start_thread_media(self):
+        """
+            Forgets the media uploaded for an earlier thread.
+        """
+        self.thread_media_ids = {}
+        self.thread_media_locks = {}
+        self.thread_media_lock = threading.Lock()
+
+    def upload_tweet_media(self, media_uris):
+        """
+            Uploads the media for one tweet and returns the list of media
+            IDs. Media that fails to upload is left out of the tweet.
+        """
+
+        tweet_media = self.prepare_media(media_uris)
+
+        media_ids = []
+
+        try:
+
+            for item in tweet_media:
+
+                try:
+                    media_id = self.upload_thread_media(item)
+                except twitter.error.TwitterError:
+                    module_logger.exception("cannot upload media {}, leaving it out of the tweet".format(
+                        getattr(item, 'name', item)))
+                    continue
+
+                # a tweet cannot attach the same media twice
+                if media_id not in media_ids:
+                    media_ids.append(media_id)
+
+        finally:
+            # the tweet only needs the media IDs, so release the buffers now
+            for item in tweet_media:
+                if isinstance(item, MediaBuffer):
+                    item.close()
+
+        return media_ids
+
     def publish_story(self, story_output_data):
 
         module_logger.info("publishing story as a thread to Twitter")
 
-        self.auth()
+        if getattr(self, 'api', None) is None:
+            self.auth()
 
         module_logger.debug(
             "story_output_data: {}".format(pprint.pformat(story_output_data))
@@ -63,85 +287,130 @@ class TwitterStoryTeller(ServiceStoryteller):
             story_output_data["main_post"]
         ))
 
-        try:
-            # TODO: what about title post media?
-            title_post = self.api.PostUpdate(story_output_data["main_post"])
-            module_logger.info("posted title tweet with ID {}".format(title_post.id))
-            lastid = title_post.id
-        except twitter.error.TwitterError as e:
-            module_logger.exception("Failed to post title tweet, cannot continue.")
-            raise e
-
-        threadtweetcounter = 0
-        threadtweetcount = len(story_output_data["comment_posts"])
-
-        for thread_tweet in story_output_data["comment_posts"]:
-            module_logger.debug("thread tweet text: \n{}".format(
-                thread_tweet["text"]
-            ))
-
-            threadtweetcounter += 1
-            module_logger.info("publishing story element {} of {}".format(threadtweetcounter, threadtweetcount))
-
-            tweet_media = []
-
-            for media_uri in thread_tweet["media"]:
-
-                module_logger.debug("working on media URI {}".format(media_uri))
-
-                if media_uri != "":
-                    if media_uri[0:5] == 'data:':
-                        mimetype, filedata = datauri_to_data(media_uri)
-                        ext = mimetypes.guess_extension(mimetype)
-                        f = tempfile.NamedTemporaryFile(prefix='raintale-', suffix=ext, delete=False)
-                        f.write(filedata)
-                        module_logger.debug("temporary file name is {}".format(f.name))
-                        tweet_media.append(f)
-                    elif os.path.splitext(media_uri)[1] == '.gif':
-                        # Twitter does not allow multiple animated GIFs, and an imagereel would be a data URI, but it still blocks regular GIFs
-                        # TODO: actually check the content-type
-                        
-                        r = requests.get(media_uri)
-
-                        if r.status_code == 200:
-                            ifp = io.BytesIO(r.content)
-                            converted_im = Image.open(ifp)
-                            converted = tempfile.NamedTemporaryFile(prefix='raintale-', suffix="png", delete=False)
-                            converted_im.save(converted, "PNG")
-                            tweet_media.append(converted)
-
-                    else:
-                        tweet_media.append(media_uri)
-
-            module_logger.debug("thread tweet media: \n{}".format(
-                tweet_media
-            ))
+        journal = self.get_publish_journal(story_output_data)
+
+        if journal is not None and journal.get_post('title') is not None:
+            story_location = journal.get_post('title')['location']
+            lastid = journal.get_last_post_id()
+            first_index = journal.get_next_index()
+            module_logger.info("resuming thread after tweet with ID {}".format(lastid))
+        else:
+            self.check_publishing()
 
             try:
-                element_post = self.api.PostUpdate(
-                    status=thread_tweet["text"],
-                    media=tweet_media,
-                    in_reply_to_status_id=lastid
-                )
-                lastid = element_post.id
-            except twitter.error.TwitterError:
-
-                module_logger.exception(
-                    "cannot post tweet for element data {} (note that media will not be shown), skipping".format(thread_tweet["text"])
-                )
+                # TODO: what about title post media?
+                title_post = self.scheduler.call(self.api.PostUpdate, story_output_data["main_post"])
+                module_logger.info("posted title tweet with ID {}".format(title_post.id))
+                lastid = title_post.id
+            except twitter.error.TwitterError as e:
+                module_logger.exception("Failed to post title tweet, cannot continue.")
+                raise e
 
-            for item in tweet_media:
-                if type(item) == "tempfile._TemporaryFileWrapper":
-                    item.close()
-                    os.unlink(item.name)
+            story_location = "https://twitter.com/{}/status/{}".format(title_post.user.screen_name, title_post.id)
+            first_index = 0
+
+            if journal is not None:
+                journal.record_post('title', title_post.id, location=story_location)
+
+        self.start_thread_media()
+
+        threadtweetcount = get_post_count(story_output_data["comment_posts"])
+        remaining_tweets = itertools.islice(enumerate(story_output_data["comment_posts"]), first_index, None)
+
+        media_uploads = queue.Queue()
+
+        # uploads stop once posting fails, and run only a few elements ahead, so that a failure
+        # partway through the thread spends little of the media upload limit
+        stop_uploads = threading.Event()
+        lookahead = threading.Semaphore(media_upload_lookahead)
+
+        # media uploads do not depend on the reply chain, so they run ahead of it in story order,
+        # starting as each element is generated when publishing is pipelined
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.media_upload_workers)
+
+        def submit_media_uploads():
+
+            try:
+                for index, thread_tweet in remaining_tweets:
+
+                    while not lookahead.acquire(timeout=0.1):
+                        if stop_uploads.is_set():
+                            return
+
+                    if stop_uploads.is_set():
+                        return
+
+                    media_uploads.put( (index, thread_tweet, executor.submit(self.upload_tweet_media, thread_tweet["media"])) )
+
+            except Exception as e:
+                media_uploads.put(e)
+            else:
+                media_uploads.put(None)
+
+        submitter = threading.Thread(target=submit_media_uploads, name="raintale-media-uploads", daemon=True)
+        submitter.start()
+
+        try:
+
+            while True:
+
+                media_upload = media_uploads.get()
+
+                if media_upload is None:
+                    break
+
+                if isinstance(media_upload, Exception):
+                    raise media_upload
+
+                index, thread_tweet, media_upload = media_upload
+
+                module_logger.debug("thread tweet text: \n{}".format(
+                    thread_tweet["text"]
+                ))
+
+                module_logger.info("publishing story element {} of {}".format(index + 1, threadtweetcount))
+
+                media_ids = media_upload.result()
+                lookahead.release()
+
+                self.check_publishing()
+
+                module_logger.debug("thread tweet media IDs: \n{}".format(
+                    media_ids
+                ))
+
+                try:
+                    element_post = self.scheduler.call(
+                        self.api.PostUpdate,
+                        status=thread_tweet["text"],
+                        media=media_ids,
+                        in_reply_to_status_id=lastid
+                    )
+                    lastid = element_post.id
+                    element_post_id = element_post.id
+                except twitter.error.TwitterError:
+
+                    module_logger.exception(
+                        "cannot post tweet for element data {} (note that media will not be shown), skipping".format(thread_tweet["text"])
+                    )
+                    element_post_id = None
+
+                if journal is not None:
+                    journal.record_post(index, element_post_id)
+
+        except BaseException:
+            # the uploads already running finish on their own, the ones waiting are dropped
+            stop_uploads.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        executor.shutdown()
 
-            module_logger.info("sleeping for 2 seconds for Twitter's benefit...")
-            time.sleep(2)
+        if journal is not None:
+            journal.record_complete(story_location)
 
         module_logger.info(
-            "Your story has been told on Twitter. Find it at https://twitter.com/{}/status/{}".format(
-                title_post.user.screen_name, title_post.id
-            )
+            "Your story has been told on Twitter. Find it at {}".format(story_location)
         )
 
-        return "https://twitter.com/{}/status/{}".format(title_post.user.screen_name, title_post.id)
+        return story_location
@@ -1,27 +1,114 @@
 import logging
 import pprint
 import tempfile
-import imghdr
 import io
 import math
 import textwrap
 import os
 import shutil
+import concurrent.futures
+import hashlib
+import json
+import time
 
 import requests
-import requests_cache
 import ffmpeg
 
 from PIL import ImageFile, Image, ImageFont, ImageDraw
 
-from .storyteller import FileStoryteller, get_story_elements
+from .storyteller import FileStoryteller, get_story_elements, StoryTellerException
+from ..httpcache import get_cached_session, get_cache_directory, default_expire_after, default_max_cache_size
+from ..mediacache import MediaCache, image_media_types
+from .videoprofiles import video_profiles, default_video_profile
 
 module_logger = logging.getLogger('raintale.storytellers.video')
 
 pp = pprint.PrettyPrinter(indent=4)
 
+fontfile = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "fonts", "OpenSans-Regular.ttf"
+)
+
+# the layout of a frame was designed at this height, other heights scale it
+layout_height = 480
+
+# archived images beyond these limits are skipped rather than downloaded or decoded
+max_image_bytes = 16 * 1024 * 1024
+max_favicon_bytes = 1024 * 1024
+max_image_pixels = 40 * 1000 * 1000
+
+# output formats, chosen by the extension of the output filename
+video_output_formats = {
+    ".mp4": "mp4",
+    ".m4v": "mp4",
+    ".mov": "mp4",
+    ".gif": "gif",
+    ".webp": "webp"
+}
+
+# change this whenever the appearance of rendered segments changes so that cached segments are not reused
+segment_format_version = 2
+
+# the element fields that appear in a rendered segment
+segment_element_fields = [
+    "title",
+    "text",
+    "memento-datetime",
+    "original-domain",
+    "archive-name"
+]
+
+# segments being copied into the cache, left behind only if raintale crashes
+partial_segment_suffix = ".partial"
+stale_partial_segment_seconds = 60 * 60
+
+_font_digest = None
+
+def get_font_digest():
+
+    global _font_digest
+
+    if _font_digest is None:
+        with open(fontfile, 'rb') as f:
+            _font_digest = hashlib.sha256(f.read()).hexdigest()
+
+    return _font_digest
+
+def get_segment_key(segment):
+    """
+        Returns a hash of everything that determines the appearance of the
+        segment: its element text, its media, the font, and the video
+        settings. Segments with the same key produce identical video.
+    """
+
+    h = hashlib.sha256()
+
+    inputs = {
+        "version": segment_format_version,
+        "kind": segment["kind"],
+        "story title": segment["title"],
+        "generated by": segment["generated_by"],
+        "element": dict(
+            (field, segment["element"].get(field)) for field in segment_element_fields
+        ),
+        "media": dict(
+            (name, hashlib.sha256(data).hexdigest()) for name, data in segment["media"].items()
+        ),
+        "font": get_font_digest(),
+        "video": [ "libx264", "yuv420p" ],
+        "profile": dict(
+            (key, value) for key, value in segment["profile"].items() if key != "description"
+        )
+    }
+
+    h.update(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8'))
+
+    return h.hexdigest()
+
 def save_fading_frames(imbase, im, framesdir, video_width, video_height, frame_width, frame_height, imgcounter,
-    archive_favicon_im, original_favicon_im, archive_name, original_domain, memento_datetime, sourcefnt ):
+    archive_favicon_im, original_favicon_im, archive_name, original_domain, memento_datetime, sourcefnt,
+    transition_steps=10, hold_frames=30, scale=1.0 ):
     im_width = im.size[0]
     im_height = im.size[1]
 
@@ -64,41 +151,49 @@ def save_fading_frames(imbase, im, framesdir, video_width, video_height, frame_w
 
     d.rectangle(
         (
-            (0, math.floor(frame_height) + 45),
-            (video_width, math.floor(frame_height) + 90),
+            (0, math.floor(frame_height + 45 * scale)),
+            (video_width, math.floor(frame_height + 90 * scale)),
         ),
         fill=(255, 255, 255)
     )
 
-    newim.paste(original_favicon_im, (offset[0], math.floor(frame_height) + 50), )
+    newim.paste(original_favicon_im, (offset[0], math.floor(frame_height + 50 * scale)), )
     newim.paste(
         archive_favicon_im, 
-        (offset[0], math.floor(frame_height) + 70), )
+        (offset[0], math.floor(frame_height + 70 * scale)), )
 
-    d.text( (offset[0] + 20, math.floor(frame_height) + 45), 
+    d.text( (offset[0] + math.floor(20 * scale), math.floor(frame_height + 45 * scale)), 
         "{}@{}".format(original_domain, memento_datetime),
         font=sourcefnt, fill=(0, 0, 0) 
         )
-    d.text( (offset[0] + 20, math.floor(frame_height) + 65 ), 
+    d.text( (offset[0] + math.floor(20 * scale), math.floor(frame_height + 65 * scale)), 
         "Preserved by {}".format(archive_name),
         font=sourcefnt, fill=(0, 0, 0) 
         )
 
-    for i in range(1, 99, 10):
-        i = i / 100
+    for step in range(0, transition_steps):
+        i = (step + 0.1) / transition_steps
         imgcounter += 1
         filename = "{}/img{}.png".format(framesdir, str(imgcounter).zfill(10))
         module_logger.debug("saving file to {}".format(filename))
         Image.blend(imbase, newim, i).save(filename)
 
-    for i in range(0, 30):
+    holdfilename = None
+
+    for i in range(0, hold_frames):
         imgcounter += 1
         filename = "{}/img{}.png".format(framesdir, str(imgcounter).zfill(10))
         module_logger.debug("saving file to {}".format(filename))
-        newim.save(filename)
 
-    for i in range(1, 99, 10):
-        i = i / 100
+        # the held frames are identical, so only the first is encoded as a PNG
+        if holdfilename is None:
+            newim.save(filename)
+            holdfilename = filename
+        else:
+            os.link(holdfilename, filename)
+
+    for step in range(0, transition_steps):
+        i = (step + 0.1) / transition_steps
         imgcounter += 1
         filename = "{}/img{}.png".format(framesdir, str(imgcounter).zfill(10))
         module_logger.debug("saving file to {}".format(filename))
@@ -106,101 +201,361 @@ def save_fading_frames(imbase, im, framesdir, video_width, video_height, frame_w
 
     return imgcounter
 
-class VideoStoryTeller(FileStoryteller):
+def download_image(media_cache, uri, max_bytes=max_image_bytes):
+    """
+        Downloads the image at `uri` through `media_cache`, returning its
+        bytes, or None if it is unavailable, is not an image, is larger
+        than `max_bytes`, or has too many pixels to decode.
+    """
 
-    def generate_story(self, story_data, mementoembed_api, story_template):
+    media = media_cache.fetch(uri, max_bytes=max_bytes, media_types=image_media_types)
 
-        requests_cache.install_cache('videostory_test')
+    if media is None:
+        return None
 
-        session = requests_cache.CachedSession()
+    if get_image_size(media.data) is None:
+        module_logger.warning("content at {} is not a usable image, skipping...".format(uri))
+        return None
 
-        story_elements = get_story_elements(story_data)
+    return media.data
 
-        story_output_data = {
-            "title": story_data['title'],
-            "generated_by": story_data['generated_by'],
-            "collection_url": story_data['collection_url'],
-            "elements": []
-        }
+def get_image_size(data):
+    """
+        Returns the dimensions of the image in `data` by reading only its
+        header, or None if it is not an image or has too many pixels to decode.
+    """
 
-        for element in story_elements:
+    try:
+        im = Image.open(io.BytesIO(data))
+    except (IOError, SyntaxError, Image.DecompressionBombError):
+        return None
 
-            try:
+    if im.size[0] * im.size[1] > max_image_pixels:
+        return None
 
-                if element['type'] == 'link':
+    return im.size
 
-                    urim = element['value']
-                    top_sentence = None
-                    top_image_uri = None
+def decode_image(data, target_size):
+    """
+        Decodes the image in `data` at roughly `target_size`. JPEGs are
+        decoded at a reduced scale by the decoder itself and other formats
+        are reduced by an integer factor before conversion, so the full
+        resolution image is never converted.
+
+        Palette, bilevel, and 16-bit images cannot be reduced, so they are
+        converted first.
+    """
+
+    im = Image.open(io.BytesIO(data))
+
+    target_width, target_height = [ int(i) for i in target_size ]
+
+    im.draft('RGB', (target_width, target_height))
+
+    if im.mode not in ('L', 'LA', 'RGB', 'RGBA', 'CMYK'):
+        im = im.convert('RGBA')
+
+    factor = min(im.size[0] // max(1, target_width), im.size[1] // max(1, target_height))
+
+    if factor > 1:
+        im = im.reduce(factor)
+
+    return im.convert('RGBA', palette=Image.ADAPTIVE)
+
+def load_favicon(data, size=16):
+
+    ifp = io.BytesIO(data)
+
+    return Image.open(ifp).convert("RGBA", palette=Image.ADAPTIVE).resize((size, size), resample=Image.BICUBIC)
+
+def render_segment(segment):
+    """
+        Renders the frames for one story element and encodes them into the
+        video segment named by segment["filename"]. This runs in a worker
+        process, so everything it needs is carried in `segment`.
+
+        The segment is encoded in the working directory and then moved into
+        the cache, so concurrent runs never see a partially written segment.
+    """
+
+    element = segment["element"]
+    media = segment["media"]
+    framesdir = segment["framesdir"]
+    profile = segment["profile"]
 
-                    endpoint = "{}/services/memento/contentdata/{}".format(mementoembed_api, urim)
+    os.makedirs(framesdir)
 
-                    r = session.get(endpoint)
+    video_width = profile["width"]
+    video_height = profile["height"]
+    scale = video_height / layout_height
 
-                    if r.status_code == 200:
+    frame_height = video_height * 0.7
+    frame_width = video_width * 0.7
 
-                        jdata = r.json()
-                        title = jdata["title"]
-                        mdt = jdata["memento-datetime"]
+    transition_steps = profile["transition_steps"]
+    hold_frames = math.ceil(profile["hold_seconds"] * profile["framerate"])
+    favicon_size = max(1, round(16 * scale))
 
-                    endpoint = "{}/services/memento/sentencerank/{}".format(mementoembed_api, urim)
+    toptitlefnt = ImageFont.truetype(fontfile, round(20 * scale))
+    metadatafnt = ImageFont.truetype(fontfile, round(16 * scale))
+    sentencefnt = ImageFont.truetype(fontfile, round(40 * scale))
+    sourcefnt = ImageFont.truetype(fontfile, round(16 * scale))
+    imblank = Image.new("RGBA", (video_width, video_height), "black")
+    imbase = Image.new("RGBA", (video_width, video_height), "black")
+    d = ImageDraw.Draw(imbase)
+    d.text((round(10 * scale), round(10 * scale)), segment["title"], font=toptitlefnt, fill=(255, 255, 255, 255) )
+    d.text((round(30 * scale), video_height - round(30 * scale)), "Generated by {}".format(segment["generated_by"]), font=metadatafnt, fill=(255, 255, 255, 255))
 
-                    r = session.get(endpoint)
+    if segment["kind"] == "image":
 
-                    if r.status_code == 200:
+        im = decode_image(media["image"], (frame_width, frame_height))
 
-                        jdata = r.json()
-                        top_sentence = jdata['scored sentences'][0]["text"].replace('\t', ' ').replace('\n', ' ')
+        save_fading_frames(imbase, im, framesdir, video_width, video_height,
+            frame_width, frame_height, 0,
+            load_favicon(media["archive-favicon"], favicon_size), load_favicon(media["original-favicon"], favicon_size),
+            element["archive-name"], element["original-domain"], element["memento-datetime"], sourcefnt,
+            transition_steps=transition_steps, hold_frames=hold_frames, scale=scale)
 
-                    endpoint = "{}/services/memento/imagedata/{}".format(mementoembed_api, urim)
+    elif segment["kind"] == "text":
 
-                    r = session.get(endpoint)
+        text = element['text']
 
-                    if r.status_code == 200:
+        if len(text) > 60:
+            text = '\n'.join(textwrap.wrap(text, width=40))
+
+        if "title" in element:
+            title = element["title"]
+
+            if len(title) > 40:
+                title = '\n'.join(textwrap.wrap(title, width=40))
+
+            text = title + '\n\n' + text
+
+        im = imblank.copy()
+        d = ImageDraw.Draw(im)
+        module_logger.debug("writing sentence item {}".format(text))
+
+        d.text( (0, 0), text, font=sentencefnt, fill=(255, 255, 255) )
+
+        save_fading_frames(imbase, im, framesdir, video_width, video_height,
+            frame_width, frame_height, 0,
+            load_favicon(media["archive-favicon"], favicon_size), load_favicon(media["original-favicon"], favicon_size),
+            element["archive-name"], element["original-domain"], element["memento-datetime"], sourcefnt,
+            transition_steps=transition_steps, hold_frames=hold_frames, scale=scale)
+
+    else:
+
+        im = imbase.copy()
+        d = ImageDraw.Draw(im)
+        d.text( (round(40 * scale), round(40 * scale)), "The End", font=sentencefnt, fill=(255, 255, 255))
+        im.save("{}/img{}.png".format(framesdir, str(1).zfill(10)))
+
+    encoded_filename = "{}/segment.mp4".format(framesdir)
+
+    (
+        ffmpeg
+        .input('{}/img*.png'.format(framesdir), pattern_type='glob', framerate=profile["framerate"])
+        .output(encoded_filename, pix_fmt='yuv420p', vcodec='libx264',
+            preset=profile["preset"], crf=profile["crf"], threads=profile["threads"])
+        .overwrite_output()
+        .run(quiet=True)
+    )
+
+    # the cache may be on another filesystem, so copy next to the segment and rename it into place
+    partial_filename = "{}.{}{}".format(segment["filename"], os.getpid(), partial_segment_suffix)
+
+    try:
+        shutil.copyfile(encoded_filename, partial_filename)
+        os.replace(partial_filename, segment["filename"])
+    finally:
+        if os.path.exists(partial_filename):
+            os.unlink(partial_filename)
+
+    shutil.rmtree(framesdir)
+
+    return segment["filename"]
+
+def get_output_format(output_filename):
+
+    ext = os.path.splitext(output_filename)[1].lower()
+
+    return video_output_formats.get(ext, "mp4")
+
+def concat_segments(segment_filenames, output_filename, workingdir, output_format="mp4"):
+    """
+        Joins the encoded segments into `output_filename` with ffmpeg's
+        concat demuxer. The segments share the same encoding settings, so
+        MP4 output copies them without re-encoding. Animated GIF and WebP
+        output are encoded directly from the joined segments.
+    """
+
+    listfilename = "{}/segments.txt".format(workingdir)
+
+    with open(listfilename, 'w') as f:
+        for segment_filename in segment_filenames:
+            f.write("file '{}'\n".format(segment_filename))
+
+    stream = ffmpeg.input(listfilename, format='concat', safe=0)
+
+    if output_format == "gif":
+
+        # a palette built from the whole video looks far better than the default GIF palette
+        split_stream = stream.split()
+        palette = split_stream[0].filter('palettegen')
+
+        output = ffmpeg.filter([ split_stream[1], palette ], 'paletteuse').output(
+            output_filename, format='gif', loop=0)
+
+    elif output_format == "webp":
+
+        output = stream.output(output_filename, vcodec='libwebp_anim', format='webp', loop=0)
+
+    else:
+
+        output = stream.output(output_filename, c='copy')
+
+    output.run(quiet=True)
+
+class VideoStoryTeller(FileStoryteller):
+
+    description = "(EXPERIMENTAL) Given input data, this storyteller creates a video of the top images and sentences " \
+        "of each memento. The output format (MP4, animated GIF, or animated WebP) follows the output filename extension."
+
+    # the video has no story template, these are the surrogate fields it uses
+    surrogate_template = "\n".join([
+        "{{ element.surrogate.title }}",
+        "{{ element.surrogate.memento_datetime }}",
+        "{{ element.surrogate.sentence }}",
+        "{{ element.surrogate.image }}",
+        "{{ element.surrogate.original_domain }}",
+        "{{ element.surrogate.original_favicon }}",
+        "{{ element.surrogate.archive_name }}",
+        "{{ element.surrogate.archive_favicon }}"
+    ])
+
+    def __init__(self, output_filename, cache_directory=None,
+        cache_expire_after=default_expire_after, cache_max_size=default_max_cache_size,
+        max_workers=None, video_profile=default_video_profile, video_threads=None):
+
+        super(VideoStoryTeller, self).__init__(output_filename)
+
+        if video_profile not in video_profiles:
+            msg = "Unknown video profile {}, available profiles are {}".format(
+                video_profile, ", ".join(sorted(video_profiles.keys())))
+            module_logger.critical(msg)
+            raise StoryTellerException(msg)
+
+        self.video_profile = video_profile
+        self.profile = dict(video_profiles[video_profile])
+
+        if video_threads is not None:
+            self.profile["threads"] = video_threads
+
+        # None lets the process pool use every available core
+        self.max_workers = max_workers
+
+        self.cache_directory = cache_directory
+        self.cache_expire_after = cache_expire_after
+        self.cache_max_size = cache_max_size
+        self._session = None
+
+        self.media_cache = MediaCache(
+            cache_directory=cache_directory,
+            expire_after=cache_expire_after,
+            max_cache_size=cache_max_size
+        )
 
-                        jdata = r.json()
-                        top_image_uri = jdata['ranked images'][0]
+    @classmethod
+    def get_options_from_arguments(cls, args):
 
-                    endpoint = "{}/services/memento/originalresourcedata/{}".format(mementoembed_api, urim)
+        options = {}
 
-                    r = session.get(endpoint)
+        if getattr(args, 'cache_directory', None) is not None:
+            options['cache_directory'] = args.cache_directory
 
-                    if r.status_code == 200:
+        if getattr(args, 'cache_expire_after', None) is not None:
+            options['cache_expire_after'] = args.cache_expire_after
 
-                        jdata = r.json()
-                        original_domain = jdata['original-domain']
-                        original_favicon = jdata['original-favicon']
+        if getattr(args, 'cache_max_size', None) is not None:
+            options['cache_max_size'] = args.cache_max_size
 
-                    endpoint = "{}/services/memento/archivedata/{}".format(mementoembed_api, urim)
+        if getattr(args, 'max_workers', None) is not None:
+            options['max_workers'] = args.max_workers
 
-                    r = session.get(endpoint)
+        if getattr(args, 'video_profile', None) is not None:
+            options['video_profile'] = args.video_profile
 
-                    if r.status_code == 200:
+        if getattr(args, 'video_threads', None) is not None:
+            options['video_threads'] = args.video_threads
 
-                        jdata = r.json()
-                        archive_name = jdata['archive-name']
-                        archive_favicon = jdata['archive-favicon']
+        return options
+
+    @property
+    def session(self):
+
+        if self._session is None:
+            self._session = get_cached_session(
+                'videostory',
+                cache_directory=self.cache_directory,
+                expire_after=self.cache_expire_after,
+                max_cache_size=self.cache_max_size
+            )
+
+        return self._session
+
+    def generate_story(self, story_data, mementoembed_api, story_template):
+
+        session = self.session
+
+        story_elements = get_story_elements(story_data)
+
+        story_output_data = {
+            "title": story_data['title'],
+            "generated_by": story_data['generated_by'],
+            "collection_url": story_data['collection_url'],
+            "elements": []
+        }
+
+        md = self.make_memento_data(self.surrogate_template, mementoembed_api)
+
+        for element in story_elements:
+
+            if element['type'] == 'link':
+                md.add(element['value'])
+
+        for element in story_elements:
+
+            try:
+
+                if element['type'] == 'link':
+
+                    urim = element['value']
+
+                    memento_data = md.get_memento_data(urim, session=session)
+
+                    mdt = memento_data['memento_datetime'].strftime("%Y-%m-%dT%H:%M:%SZ")
+                    top_sentence = memento_data['sentence'].replace('\t', ' ').replace('\n', ' ')
 
                     story_output_data["elements"].append(
                         {
-                            "title": title,
+                            "title": memento_data['title'],
                             "text": top_sentence,
                             "memento-datetime": mdt,
-                            "original-favicon": original_favicon,
-                            "original-domain": original_domain,
-                            "archive-favicon": archive_favicon,
-                            "archive-name": archive_name
+                            "original-favicon": memento_data['original_favicon'],
+                            "original-domain": memento_data['original_domain'],
+                            "archive-favicon": memento_data['archive_favicon'],
+                            "archive-name": memento_data['archive_name']
                         }
                     )
 
                     story_output_data["elements"].append(
                         {
-                            "image": top_image_uri,
+                            "image": memento_data['image'],
                             "memento-datetime": mdt,
-                            "original-favicon": original_favicon,
-                            "original-domain": original_domain,
-                            "archive-favicon": archive_favicon,
-                            "archive-name": archive_name
+                            "original-favicon": memento_data['original_favicon'],
+                            "original-domain": memento_data['original_domain'],
+                            "archive-favicon": memento_data['archive_favicon'],
+                            "archive-name": memento_data['archive_name']
                         }
                     )
                 
@@ -232,143 +587,171 @@ class VideoStoryTeller(FileStoryteller):
         return story_output_data
 
 
-    def publish_story(self, story_output_data):
+    def fetch_segment_media(self, element, include_image):
+        """
+            Downloads the favicons, and the image if `include_image` is True,
+            used by the video segment for `element`. Returns None if any of
+            them is unavailable.
+        """
 
-        module_logger.info("incoming story data:\n{}".format(pprint.pformat(story_output_data, indent=4)))
+        media = {}
 
-        requests_cache.install_cache('videostory_test')
+        for key in [ "archive-favicon", "original-favicon" ]:
 
-        session = requests_cache.CachedSession()
+            if key not in element:
+                module_logger.warning("story element {} has no {}, skipping...".format(element, key))
+                return None
 
-        workingdir = tempfile.mkdtemp(suffix=".tmp", prefix="raintale-")
-        # workingdir = "/Users/smj/tmp/raintale-testing"
-        framesdir = "{}/videoframes".format(workingdir)
+            data = download_image(self.media_cache, element[key], max_bytes=max_favicon_bytes)
+
+            if data is None:
+                return None
+
+            media[key] = data
+
+        if include_image is True:
 
-        if not os.path.exists(framesdir):
-            os.makedirs(framesdir)
+            data = download_image(self.media_cache, element["image"])
 
-        fontfile = "raintale/fonts/OpenSans-Regular.ttf"
+            if data is None:
+                return None
 
-        # 864 x 480 is SD according to https://learn.g2.com/youtube-video-size
-        video_height = 480
-        video_width = 864
+            media["image"] = data
 
-        frame_height = video_height * 0.7
-        frame_width = video_width * 0.7
+        return media
 
-        toptitlefnt = ImageFont.truetype(fontfile, 20)
-        metadatafnt = ImageFont.truetype(fontfile, 16)
-        sentencefnt = ImageFont.truetype(fontfile, 40)
-        sourcefnt = ImageFont.truetype(fontfile, 16)
-        imblank = Image.new("RGBA", (video_width, video_height), "black") 
-        imbase = Image.new("RGBA", (video_width, video_height), "black")
-        d = ImageDraw.Draw(imbase)
-        d.text((10, 10), story_output_data["title"], font=toptitlefnt, fill=(255, 255, 255, 255) )
-        d.text((30, video_height - 30), "Generated by {}".format(story_output_data["generated_by"]), font=metadatafnt, fill=(255, 255, 255, 255))
+    @property
+    def segment_cache_directory(self):
+
+        segment_cache_directory = os.path.join(get_cache_directory(self.cache_directory), "video-segments")
+
+        if not os.path.exists(segment_cache_directory):
+            os.makedirs(segment_cache_directory, exist_ok=True)
+
+        return segment_cache_directory
+
+    def prune_segment_cache(self):
+        """
+            Removes cached segments that have not been used for longer than
+            the cache expiration time, and partial segments left behind by
+            runs that crashed.
+        """
+
+        now = time.time()
+
+        for filename in os.listdir(self.segment_cache_directory):
+
+            segment_filename = os.path.join(self.segment_cache_directory, filename)
+
+            try:
+                if filename.endswith(partial_segment_suffix):
+
+                    # another run may still be copying it
+                    if os.path.getmtime(segment_filename) < now - stale_partial_segment_seconds:
+                        module_logger.debug("removing stale partial video segment {}".format(segment_filename))
+                        os.unlink(segment_filename)
+
+                elif self.cache_expire_after is not None and self.cache_expire_after >= 0 and \
+                    os.path.getmtime(segment_filename) < now - self.cache_expire_after:
+                    module_logger.debug("removing expired video segment {}".format(segment_filename))
+                    os.unlink(segment_filename)
+            except FileNotFoundError:
+                # another raintale process removed it first
+                pass
+
+    def build_segments(self, story_output_data, workingdir):
+
+        segments = []
+
+        def add_segment(kind, element, media):
+
+            segment_number = len(segments) + 1
+
+            segment = {
+                "kind": kind,
+                "element": element,
+                "media": media,
+                "title": story_output_data["title"],
+                "generated_by": story_output_data["generated_by"],
+                "profile": self.profile,
+                "framesdir": "{}/frames{}".format(workingdir, str(segment_number).zfill(6))
+            }
+
+            segment["filename"] = os.path.join(
+                self.segment_cache_directory, "{}.mp4".format(get_segment_key(segment))
+            )
+
+            segments.append(segment)
 
-        imgcounter = 0
         elementcounter = 0
 
         for element in story_output_data["elements"]:
-            
+
             elementcounter += 1
-            im = None
 
-            module_logger.info("generating video frames for story element {} of {}".format(elementcounter, len(story_output_data["elements"])))
+            module_logger.info("gathering media for story element {} of {}".format(elementcounter, len(story_output_data["elements"])))
 
             if "image" in element:
 
                 if element["image"] is not None:
 
-                    r = session.get(element["image"])
-                    afav = session.get(element["archive-favicon"])
-                    ofav = session.get(element["original-favicon"])
-                    if r.status_code == 200 and afav.status_code == 200 and ofav.status_code == 200:
-                        imgcounter += 1
-                        data = r.content
+                    media = self.fetch_segment_media(element, include_image=True)
 
-                        ifp = io.BytesIO(data)
-                        im = Image.open(ifp).convert('RGBA', palette=Image.ADAPTIVE)
+                    if media is not None:
+                        add_segment("image", element, media)
 
-                        ifp = io.BytesIO(afav.content)
-                        ar_favicon_im = Image.open(ifp).convert("RGBA", palette=Image.ADAPTIVE).resize((16, 16), resample=Image.BICUBIC)
+            if "text" in element:
 
-                        ifp = io.BytesIO(ofav.content)
-                        or_favicon_im = Image.open(ifp).convert("RGBA", palette=Image.ADAPTIVE).resize((16, 16), resample=Image.BICUBIC)
+                media = self.fetch_segment_media(element, include_image=False)
 
-                        imgcounter = save_fading_frames(imbase, im, framesdir, video_width, video_height, 
-                            frame_width, frame_height,
-                            imgcounter, ar_favicon_im, or_favicon_im, element["archive-name"],
-                            element["original-domain"], element["memento-datetime"], sourcefnt)
+                if media is not None:
+                    add_segment("text", element, media)
 
+        add_segment("end", {}, {})
 
-            if "text" in element:
+        return segments
 
-                afav = session.get(element["archive-favicon"])
-                ofav = session.get(element["original-favicon"])
-                if afav.status_code == 200 and ofav.status_code == 200:
+    def publish_story(self, story_output_data):
 
-                    text = element['text']
+        module_logger.info("incoming story data:\n{}".format(pprint.pformat(story_output_data, indent=4)))
 
-                    if len(text) > 60:
-                        text = '\n'.join(textwrap.wrap(text, width=40))
+        workingdir = tempfile.mkdtemp(suffix=".tmp", prefix="raintale-")
 
-                    if "title" in element:
-                        title = element["title"]
+        self.prune_segment_cache()
 
-                        if len(title) > 40:
-                            title = '\n'.join(textwrap.wrap(title, width=40))
+        segments = self.build_segments(story_output_data, workingdir)
 
-                        text = title + '\n\n' + text
+        changed_segments = []
+        scheduled_filenames = set()
 
-                    im = imblank.copy()
-                    d = ImageDraw.Draw(im)
-                    module_logger.debug("writing sentence item {}".format(text))
+        for segment in segments:
 
-                    ifp = io.BytesIO(afav.content)
-                    ar_favicon_im = Image.open(ifp).convert("RGBA", palette=Image.ADAPTIVE).resize((16, 16), resample=Image.BICUBIC)
+            if os.path.exists(segment["filename"]):
+                # mark the segment as recently used so it survives pruning
+                os.utime(segment["filename"])
 
-                    ifp = io.BytesIO(ofav.content)
-                    or_favicon_im = Image.open(ifp).convert("RGBA", palette=Image.ADAPTIVE).resize((16, 16), resample=Image.BICUBIC)
+            elif segment["filename"] not in scheduled_filenames:
+                changed_segments.append(segment)
+                scheduled_filenames.add(segment["filename"])
 
-                    d.text( (0, 0), text, font=sentencefnt, fill=(255, 255, 255) )
+        module_logger.info("reusing {} cached video segments, rendering and encoding {} video segments with {} worker processes".format(
+            len(segments) - len(changed_segments), len(changed_segments),
+            self.max_workers if self.max_workers is not None else os.cpu_count()
+        ))
 
-                    imgcounter = save_fading_frames(imbase, im, framesdir, video_width, video_height, 
-                        frame_width, frame_height, imgcounter, ar_favicon_im, or_favicon_im, 
-                        element["archive-name"], element["original-domain"], element["memento-datetime"], sourcefnt)
+        if len(changed_segments) > 0:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(render_segment, changed_segments))
 
-        im = imbase.copy()
-        d = ImageDraw.Draw(im)
-        d.text( (40, 40), "The End", font=sentencefnt, fill=(255, 255, 255))
-        imgcounter += 1
-        filename = "{}/img{}.png".format(framesdir, str(imgcounter).zfill(10))
-        im.save(filename)
+        segment_filenames = [ segment["filename"] for segment in segments ]
 
-        module_logger.info("generating movie from frames")
+        module_logger.info("joining video segments into movie")
 
         if os.path.exists(self.output_filename):
             os.unlink(self.output_filename)
 
-        # outputims = []
-        # imout = Image.new("RGBA", (video_width, video_height), "black")
-
-        # for filename in os.listdir(framesdir):            
-        #     im = Image.open("{}/{}".format(framesdir, filename))
-        #     outputims.append(im)
-                
-
-        # with open(self.output_filename, 'wb') as outputfp:
-        #     imout.save(
-        #         outputfp, save_all=True, format="GIF", 
-        #         append_images=outputims, duration=100, loop=0
-        #     ) 
-
-        (
-            ffmpeg
-            .input('{}/img*.png'.format(framesdir), pattern_type='glob', framerate=10)
-            .output(self.output_filename, pix_fmt='yuv420p', vcodec='libx264')
-            .run()
-        )
+        concat_segments(segment_filenames, self.output_filename, workingdir,
+            output_format=get_output_format(self.output_filename))
 
         shutil.rmtree(workingdir)
 
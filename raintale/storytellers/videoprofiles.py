@@ -0,0 +1,42 @@
+# The output profiles of the video storyteller. They live apart from it so
+# that the command line can list them without importing ffmpeg and Pillow.
+
+# "threads" is passed to the encoder, 0 lets ffmpeg use every core for each segment
+video_profiles = {
+    "preview": {
+        "description": "low resolution output that renders in seconds, for checking a story before publishing",
+        "width": 432,
+        "height": 240,
+        "framerate": 5,
+        "transition_steps": 3,
+        "hold_seconds": 3,
+        "preset": "ultrafast",
+        "crf": 35,
+        "threads": 0
+    },
+    "standard": {
+        # 864 x 480 is SD according to https://learn.g2.com/youtube-video-size
+        "description": "SD output suitable for Twitter",
+        "width": 864,
+        "height": 480,
+        "framerate": 10,
+        "transition_steps": 10,
+        "hold_seconds": 3,
+        "preset": "medium",
+        "crf": 23,
+        "threads": 0
+    },
+    "hq": {
+        "description": "HD output for publishing to YouTube",
+        "width": 1280,
+        "height": 720,
+        "framerate": 25,
+        "transition_steps": 25,
+        "hold_seconds": 3,
+        "preset": "slow",
+        "crf": 18,
+        "threads": 0
+    }
+}
+
+default_video_profile = "standard"
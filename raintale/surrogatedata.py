@@ -4,13 +4,21 @@ import base64
 import random
 import json
 import pprint
+import queue
+import itertools
+import threading
 
 import requests
 
 from datetime import datetime
+from functools import lru_cache
+
+from jinja2 import Environment, TemplateSyntaxError, nodes
 
 from requests_futures.sessions import FuturesSession
 
+from .surrogatestore import MemorySurrogateStore
+
 module_logger = logging.getLogger('raintale.surrogatedata')
 
 fieldname_to_endpoint = {
@@ -67,6 +75,17 @@ raintale_ranking_services = [
     "/services/"
 ]
 
+# the story elements whose memento data is fetched at a time when a story is streamed
+stream_batch_size = 50
+
+# a surrogate field written with the |prefer syntax of raintale, which Jinja2 cannot parse
+prefer_pattern = re.compile(
+    r'element\.surrogate\.(\w+)\s*\|\s*prefer\s+(\w+(?:\s*=\s*\w+)?(?:\s*,\s*\w+(?:\s*=\s*\w+)?)*)'
+)
+
+# templates are only parsed with this environment, never rendered
+parsing_environment = Environment()
+
 class MementoEmbedRequestError(Exception):
     pass
 
@@ -88,12 +107,177 @@ def get_futures_session(session=None):
 
     return fs
 
+def get_sanitized_fieldname(fieldname, preferences=None):
+    """
+        Returns the name under which the memento data of surrogate field
+        `fieldname`, fetched with `preferences`, is kept and rendered.
+    """
+
+    if preferences is None:
+        return fieldname
+
+    return "{}__prefer__{}".format(fieldname, preferences.replace('=', '_').replace(',', '_'))
+
+@lru_cache(maxsize=256)
+def normalize_template(story_template_string):
+    """
+        Returns `story_template_string` with each surrogate field written
+        with |prefer renamed to its sanitized field name, so that Jinja2
+        can parse it, along with a dictionary mapping each sanitized field
+        name to its field name and preferences.
+    """
+
+    preferred_fields = {}
+
+    def rename(match):
+
+        fieldname = match.group(1)
+        preferences = ",".join(
+            "=".join( part.strip() for part in preference.split('=') )
+                for preference in match.group(2).split(',')
+        )
+
+        sanitized_fieldname = get_sanitized_fieldname(fieldname, preferences)
+        preferred_fields[sanitized_fieldname] = (fieldname, preferences)
+
+        return "element.surrogate.{}".format(sanitized_fieldname)
+
+    return prefer_pattern.sub(rename, story_template_string), preferred_fields
+
+def get_surrogate_attribute(node):
+    """
+        Returns the attribute of element.surrogate that `node` accesses,
+        such as title for element.surrogate.title, or None.
+    """
+
+    def is_surrogate(node):
+
+        if isinstance(node, nodes.Getattr):
+            parent, name = node.node, node.attr
+        elif isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const):
+            parent, name = node.node, node.arg.value
+        else:
+            return False
+
+        return name == 'surrogate' and isinstance(parent, nodes.Name) and parent.name == 'element'
+
+    if isinstance(node, nodes.Getattr) and is_surrogate(node.node):
+        return node.attr
+
+    if isinstance(node, nodes.Getitem) and is_surrogate(node.node) and isinstance(node.arg, nodes.Const):
+        return node.arg.value
+
+    return None
+
+def get_constant_truth(node):
+    """
+        Returns whether the test `node` is always true or always false, or
+        None if that depends on the story.
+    """
+
+    try:
+        return bool(node.as_const())
+    except Exception:
+        # Impossible, or an error raised while folding the constant
+        return None
+
+def iter_surrogate_attributes(node, definedness_test=False):
+    """
+        Yields each attribute of element.surrogate that the template
+        `node` uses, paired with whether it is only tested with `is
+        defined`, skipping the branches of conditions that are never met.
+    """
+
+    if isinstance(node, (nodes.If, nodes.CondExpr)):
+
+        if isinstance(node, nodes.If):
+            branches = [ (node.test, node.body) ] + [ (elif_.test, elif_.body) for elif_ in node.elif_ ]
+            otherwise = node.else_
+        else:
+            branches = [ (node.test, [ node.expr1 ]) ]
+            otherwise = [] if node.expr2 is None else [ node.expr2 ]
+
+        for test, body in branches:
+
+            truth = get_constant_truth(test)
+
+            if truth is None:
+                yield from iter_surrogate_attributes(test)
+
+            if truth is not False:
+                for child in body:
+                    yield from iter_surrogate_attributes(child)
+
+            if truth is True:
+                # the branches after one that is always taken never are
+                return
+
+        for child in otherwise:
+            yield from iter_surrogate_attributes(child)
+
+        return
+
+    attribute = get_surrogate_attribute(node)
+
+    if attribute is not None:
+        yield attribute, definedness_test
+        return
+
+    if isinstance(node, nodes.Test) and node.name in ('defined', 'undefined'):
+        yield from iter_surrogate_attributes(node.node, definedness_test=True)
+        return
+
+    for child in node.iter_child_nodes():
+        yield from iter_surrogate_attributes(child)
+
+@lru_cache(maxsize=256)
 def get_template_surrogate_fields(story_template_string):
+    """
+        Returns the surrogate fields that `story_template_string` uses,
+        each written as {{ element.surrogate.fieldname }} or, if it has
+        preferences, {{ element.surrogate.fieldname|prefer preferences }}.
+
+        The fields are found by parsing the template, so they may be used
+        anywhere, including in conditions, loops, and filter arguments,
+        while the fields in branches whose condition is always false are
+        left out, so that MementoEmbed is only asked for what the story
+        can show. Results are kept for each distinct template.
+    """
+
+    normalized_template, preferred_fields = normalize_template(story_template_string)
+
+    try:
+        template_ast = parsing_environment.parse(normalized_template)
+    except TemplateSyntaxError as e:
+        # the error is reported when the story is rendered
+        module_logger.warning("cannot parse story template, looking for surrogate fields in its text: {}".format(e))
+        return tuple(sorted(set(re.findall(r'{{ element.surrogate\.[^}]* }}', story_template_string))))
+
+    template_surrogate_fields = set()
+    unknown_fieldnames = set()
 
-    template_surrogate_fields = \
-        list(set(sorted(re.findall(r'{{ element.surrogate\.[^}]* }}', story_template_string))))
+    for attribute, definedness_test in iter_surrogate_attributes(template_ast):
 
-    return template_surrogate_fields
+        fieldname, preferences = preferred_fields.get(attribute, (attribute, None))
+
+        if fieldname not in fieldname_to_endpoint and fieldname not in calculated_fields:
+
+            # a template may check for a field that MementoEmbed does not provide
+            if definedness_test is False:
+                unknown_fieldnames.add(fieldname)
+
+            continue
+
+        if preferences is None:
+            template_surrogate_fields.add("{{{{ element.surrogate.{} }}}}".format(fieldname))
+        else:
+            template_surrogate_fields.add("{{{{ element.surrogate.{}|prefer {} }}}}".format(fieldname, preferences))
+
+    for fieldname in sorted(unknown_fieldnames):
+        module_logger.warning("story template uses surrogate field {}, which MementoEmbed does not provide, "
+            "it will be empty".format(fieldname))
+
+    return tuple(sorted(template_surrogate_fields))
 
 def png_to_datauri(imgdata):
     datauri = "data:image/png;base64,{}".format(
@@ -218,12 +402,19 @@ def get_field_value(data, preferences, base_fieldname):
 
 class MementoData:
 
-    def __init__(self, template_string, mementoembed_api):
+    def __init__(self, template_string, mementoembed_api, surrogate_dataset=None, session=None, progress=None,
+        store=None):
         self.mementoembed_api = mementoembed_api
         self.template_string = template_string
+        self.surrogate_dataset = surrogate_dataset
+        # the session used to consult MementoEmbed when a method is not given one
+        self.session = session
+        # when set, a FetchProgress that counts each request made to MementoEmbed
+        self.progress = progress
+        # where the fetched memento data is kept, such as a SQLiteSurrogateStore for very large stories
+        self.store = MemorySurrogateStore() if store is None else store
         self._data = {}
         self._urimlist = []
-        self._mementodata = {}
 
         module_logger.debug("initializing memento data class with template:\n\n{}\n\n".format(template_string))
 
@@ -318,20 +509,7 @@ class MementoData:
             self._urimlist.append(urim)
 
     def get_sanitized_template(self):
-
-        fieldlist_to_replacements = {}
-
-        for field, urim in self._data:
-            fieldlist_to_replacements[field] = "{{ element.surrogate." + self._data[(field, urim)]["Jinja2-compliant field name"] + " }}"
-
-        sanitized_template = self.template_string
-
-        for field in fieldlist_to_replacements:
-            sanitized_template = sanitized_template.replace(
-                field, fieldlist_to_replacements[field]
-            )
-
-        return sanitized_template
+        return normalize_template(self.template_string)[0]
 
     def get_endpoints_and_preferences_with_fields(self):
 
@@ -356,6 +534,33 @@ class MementoData:
             
         return endpoint_data
 
+    def request_endpoint(self, futuressession, endpoint, headers):
+        """
+            Requests `endpoint` through `futuressession`, counting the
+            request in the progress, if any, and returns its future.
+        """
+
+        if self.progress is None:
+            return futuressession.get(endpoint, headers=headers)
+
+        progress = self.progress
+
+        progress.add_requests(1, endpoint=endpoint)
+
+        future = futuressession.get(endpoint, headers=headers)
+
+        def record_completion(future):
+
+            if future.exception() is None:
+                progress.record_response(future.result())
+            else:
+                progress.record_completion(endpoint=endpoint, failed=True)
+
+        # a response hook is not used, as the cached session may call it more than once for a request
+        future.add_done_callback(record_completion)
+
+        return future
+
     def issue_future_requests(self, endpoint_data, futuressession):
 
         endpoint_keys = list(endpoint_data.keys())
@@ -368,13 +573,13 @@ class MementoData:
                 if len(me_preferences) > 0:
                     headers['Prefer'] = ','.join(me_preferences)
 
-                endpoint_data[ (endpoint, me_preferences) ]["future request"] = futuressession.get(endpoint, headers=headers)
+                endpoint_data[ (endpoint, me_preferences) ]["future request"] = self.request_endpoint(futuressession, endpoint, headers)
 
         return endpoint_data
 
     def fetch_all_memento_data(self, session=None):
 
-        fs = get_futures_session(session=session)
+        fs = get_futures_session(session=session if session is not None else self.session)
 
         future_requests = {}
 
@@ -420,39 +625,7 @@ class MementoData:
                             ))
 
                             # TODO: this should be going through the content for just endpoint, me_preferences
-                            for fieldname, urim in future_requests[ (endpoint, me_preferences) ]["fields"]:
-                                self._mementodata.setdefault(
-                                    urim, {
-                                        "urim": urim,
-                                        "creation_time": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-                                    })
-                                rt_preferences = self._data[ (fieldname, urim) ]["Raintale preferences"]
-                                base_fieldname = self._data[ (fieldname, urim) ]["base field name"]
-
-                                module_logger.debug("attempting to set memento data value '{}' using base field name '{}' and Raintale preferences '{}'".format(
-                                    self._data[ (fieldname, urim) ]["sanitized field name"],
-                                    base_fieldname,
-                                    rt_preferences
-                                ))
-                                module_logger.debug("mementodata was {}\n\n".format(
-                                    pprint.pformat( self._mementodata )
-                                ))
-
-                                try:
-                                    
-                                    self._mementodata[urim][
-                                        self._data[ (fieldname, urim) ]["sanitized field name"]
-                                    ] = get_field_value(result.content, rt_preferences, base_fieldname)
-
-                                except json.decoder.JSONDecodeError as e:
-                                    module_logger.exception("Failed to process output from MementoEmbed for URI-M {} at endpoint {}, quitting...".format(urim, endpoint))
-
-                                except KeyError as e:
-                                    module_logger.exception("Got error at endpoint {}: {}".format(endpoint, e))
-
-                                module_logger.debug("mementodata is now {}\n\n".format(
-                                    pprint.pformat( self._mementodata )
-                                ))
+                            self.store_memento_data(future_requests[ (endpoint, me_preferences) ]["fields"], result, endpoint)
 
                             module_logger.debug("done with endpoint {} with preferences {}, removing...".format(endpoint, me_preferences))
 
@@ -479,27 +652,253 @@ class MementoData:
                 
             module_logger.debug("working list is now {}".format(request_working_list))
 
-        for urim in self._mementodata:
-            
-            if 'memento_datetime' in self._mementodata[urim]:
-                self._mementodata[urim]['memento_datetime_14num'] = \
-                    self._mementodata[urim]['memento_datetime'].strftime("%Y%m%d%H%M%S")
+        for urim in self.store:
+            self.finish_memento_data(urim)
+
+        module_logger.debug("mementodata stabilized at {}".format(self.store))
+
+
+    def store_memento_data(self, fields, result, endpoint):
+        """
+            Stores the value of each of `fields`, pairs of template field
+            and URI-M, from the MementoEmbed response `result`.
+        """
+
+        values_by_urim = {}
+
+        for fieldname, urim in fields:
+
+            if urim not in values_by_urim:
+
+                values_by_urim[urim] = {}
 
-        module_logger.debug("mementodata stabilized at {}".format(pprint.pformat(self._mementodata, indent=4)))
+                if urim not in self.store:
+                    values_by_urim[urim]["urim"] = urim
+                    values_by_urim[urim]["creation_time"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
 
+            rt_preferences = self._data[ (fieldname, urim) ]["Raintale preferences"]
+            base_fieldname = self._data[ (fieldname, urim) ]["base field name"]
+
+            module_logger.debug("attempting to set memento data value '{}' using base field name '{}' and Raintale preferences '{}'".format(
+                self._data[ (fieldname, urim) ]["sanitized field name"],
+                base_fieldname,
+                rt_preferences
+            ))
+
+            try:
+                
+                values_by_urim[urim][
+                    self._data[ (fieldname, urim) ]["sanitized field name"]
+                ] = get_field_value(result.content, rt_preferences, base_fieldname)
+
+            except json.decoder.JSONDecodeError as e:
+                module_logger.exception("Failed to process output from MementoEmbed for URI-M {} at endpoint {}, quitting...".format(urim, endpoint))
+
+            except KeyError as e:
+                module_logger.exception("Got error at endpoint {}: {}".format(endpoint, e))
+
+        for urim, values in values_by_urim.items():
+            self.store.update(urim, values)
+
+        module_logger.debug("mementodata is now {}\n\n".format(self.store))
+
+    def finish_memento_data(self, urim):
+
+        if urim not in self.store:
+            return
+
+        memento_data = self.store.get(urim)
+
+        if 'memento_datetime' in memento_data:
+            self.store.update(urim, {
+                'memento_datetime_14num': memento_data['memento_datetime'].strftime("%Y%m%d%H%M%S")
+            })
+
+    def iter_memento_data(self, urims, session=None):
+        """
+            Fetches the memento data of `urims`, issuing the requests in
+            story order, and yields each URI-M with its memento data, or
+            None if it could not be fetched, as soon as it and every URI-M
+            before it are ready.
+        """
+
+        if self.surrogate_dataset is not None:
+
+            for urim in urims:
+
+                try:
+                    yield urim, self.surrogate_dataset.get_memento_data(urim)
+                except KeyError:
+                    yield urim, None
+
+            return
+
+        for urim in urims:
+            if urim not in self._urimlist:
+                self.add(urim)
+
+        endpoint_data = self.get_endpoints_and_preferences_with_fields()
+
+        endpoints_by_urim = {}
+
+        for endpoint, me_preferences in endpoint_data:
+            urim = endpoint_data[ (endpoint, me_preferences) ]["fields"][0][1]
+            endpoints_by_urim.setdefault(urim, []).append( (endpoint, me_preferences) )
+
+        fs = get_futures_session(session=session if session is not None else self.session)
+
+        # the futures session works through its requests in the order they are issued
+        for urim in urims:
+
+            if urim not in self.store:
+
+                for endpoint, me_preferences in endpoints_by_urim.get(urim, []):
+
+                    headers = {}
+
+                    if len(me_preferences) > 0:
+                        headers['Prefer'] = ','.join(me_preferences)
+
+                    endpoint_data[ (endpoint, me_preferences) ]["future request"] = self.request_endpoint(fs, endpoint, headers)
+
+        for urim in urims:
+
+            for endpoint, me_preferences in endpoints_by_urim.get(urim, []):
+
+                request = endpoint_data[ (endpoint, me_preferences) ].pop("future request", None)
+
+                if request is None:
+                    continue
+
+                result = request.result()
+
+                if result.status_code == 200:
+                    self.store_memento_data(endpoint_data[ (endpoint, me_preferences) ]["fields"], result, endpoint)
+                else:
+                    module_logger.error("failed to get a good response from MementoEmbed at {}, something went wrong, skipping...".format(endpoint))
+
+            self.finish_memento_data(urim)
+
+            yield urim, self.store.get(urim) if urim in self.store else None
+
+    def has_memento_data(self, urim):
+        """
+            Returns True if the surrogate data for `urim` has been fetched.
+        """
+        return urim in self.store
 
     def get_memento_data(self, urim, session=None):
-        
+
+        if self.surrogate_dataset is not None:
+            # everything was fetched ahead of time, so there is nothing to request
+            return self.surrogate_dataset.get_memento_data(urim)
+
         if urim not in self._urimlist:
             self.add(urim)
 
-        if urim not in self._mementodata:
+        if urim not in self.store:
             self.fetch_all_memento_data(session=session)
 
-        module_logger.debug("mementodata: {}".format(
-            pprint.pformat(self._mementodata, indent=4)
-        ))
+        module_logger.debug("mementodata: {}".format(self.store))
+
+        return self.store.get(urim)
+
+
+
+def get_sanitized_template(template_string):
+    """
+        Returns `template_string` with its surrogate fields renamed as
+        MementoData renames them, without fetching anything.
+    """
+    return normalize_template(template_string)[0]
+
+def iter_element_memento_data(elements, template_string, mementoembed_api, surrogate_dataset=None, session=None,
+    batch_size=stream_batch_size, progress=None):
+    """
+        Yields each story element of `elements`, which may be an iterator
+        that is still being read, with the memento data that
+        `template_string` needs for it, or None if it is not a link or its
+        data could not be fetched.
+
+        Elements are read and their memento data fetched by a separate
+        thread, `batch_size` elements at a time, while the elements already
+        fetched are consumed. Only about two batches are held at once, so
+        memory does not grow with the length of the story.
+    """
+
+    ready = queue.Queue(maxsize=batch_size)
+    stopped = threading.Event()
+    end_of_elements = object()
+
+    def put(item):
+
+        while not stopped.is_set():
+            try:
+                ready.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def fetch_batches():
+
+        try:
+
+            batch = []
+
+            for element in itertools.chain(elements, [ end_of_elements ]):
+
+                if element is not end_of_elements:
+                    batch.append(element)
+
+                    if len(batch) < batch_size:
+                        continue
+
+                if len(batch) == 0:
+                    break
+
+                md = MementoData(template_string, mementoembed_api, surrogate_dataset=surrogate_dataset,
+                    progress=progress)
+
+                urims = [ element['value'] for element in batch if type(element) == dict and element.get('type') == 'link' ]
+                link_data = md.iter_memento_data(urims, session=session)
+
+                for element in batch:
+
+                    memento_data = None
+
+                    if type(element) == dict and element.get('type') == 'link':
+                        urim, memento_data = next(link_data)
+
+                    if put( (element, memento_data) ) is False:
+                        return
+
+                batch = []
+
+        except Exception as e:
+            put(e)
+
+        else:
+            put(end_of_elements)
+
+    fetcher = threading.Thread(target=fetch_batches, name="raintale-fetch", daemon=True)
+    fetcher.start()
+
+    try:
+
+        while True:
+
+            item = ready.get()
+
+            if item is end_of_elements:
+                break
 
-        return self._mementodata[urim]
+            if isinstance(item, Exception):
+                raise item
 
+            yield item
 
+    finally:
+        # a reader that stops early releases the fetching thread
+        stopped.set()
@@ -0,0 +1,264 @@
+import gzip
+import json
+import logging
+import threading
+
+from collections import OrderedDict
+
+from .surrogatedata import MementoData, get_template_surrogate_fields
+from .surrogatestore import MemorySurrogateStore, encode_value, decode_value
+
+module_logger = logging.getLogger('raintale.surrogatedataset')
+
+dataset_format = "raintale surrogate dataset"
+dataset_format_version = 1
+
+# URI-Ms whose surrogate data a SurrogateCache keeps, the least recently used are dropped first
+default_max_cached_urims = 10000
+
+class SurrogateDatasetError(Exception):
+
+    def __init__(self, message):
+        super(SurrogateDatasetError, self).__init__(message)
+        self.message = message
+
+def open_dataset_file(filename, mode):
+
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf-8')
+
+    return open(filename, mode, encoding='utf-8')
+
+def get_story_surrogate_fields(story_templates):
+    """
+        Returns the union of the surrogate fields used by `story_templates`.
+    """
+
+    fields = set()
+
+    for story_template in story_templates:
+        fields.update(get_template_surrogate_fields(story_template))
+
+    return fields
+
+def get_story_urims(story_data):
+
+    urims = []
+
+    for element in story_data.get('elements', []):
+        if element.get('type') == 'link' and element['value'] not in urims:
+            urims.append(element['value'])
+
+    return urims
+
+class SurrogateDataset:
+    """
+        The surrogate data for every URI-M of a story, along with the story
+        data itself, so that the story can be rendered by any storyteller
+        whose template fields the dataset covers without contacting
+        MementoEmbed.
+
+        A dataset file is JSON Lines, compressed with gzip if its name ends
+        in .gz. The first line holds the story data and the list of fields,
+        and each following line holds the surrogate data of one URI-M.
+        Images chosen as data URIs, such as thumbnails, are stored inline.
+
+        The surrogate data is kept in `store`, in memory unless another
+        surrogate store, such as a SQLiteSurrogateStore, is given.
+    """
+
+    def __init__(self, story_data=None, fields=None, store=None):
+        self.story_data = story_data
+        self.fields = set(fields or [])
+        self.store = MemorySurrogateStore() if store is None else store
+
+    @property
+    def urims(self):
+        return list(self.store)
+
+    def add_memento_data(self, urim, memento_data):
+        self.store.update(urim, memento_data)
+
+    def has_memento_data(self, urim):
+        return urim in self.store
+
+    def get_memento_data(self, urim):
+        """
+            Returns the surrogate data for `urim`, raising KeyError, like
+            MementoData, if it could not be fetched.
+        """
+
+        try:
+            return self.store.get(urim)
+        except KeyError:
+            module_logger.error("no surrogate data for URI-M {} in the surrogate dataset".format(urim))
+            raise
+
+    def get_missing_fields(self, story_template):
+        """
+            Returns the surrogate fields of `story_template` that this
+            dataset does not contain.
+        """
+        return set(get_template_surrogate_fields(story_template)) - self.fields
+
+    def write(self, filename):
+
+        module_logger.info("writing surrogate data for {} URI-Ms to {}".format(len(self.store), filename))
+
+        with open_dataset_file(filename, 'w') as f:
+
+            header = {
+                "format": dataset_format,
+                "version": dataset_format_version,
+                "fields": sorted(self.fields),
+                "story": encode_value(self.story_data)
+            }
+
+            f.write("{}\n".format(json.dumps(header)))
+
+            for urim in self.store:
+                memento_data = dict(self.store.get(urim))
+                f.write("{}\n".format(json.dumps({ "urim": urim, "surrogate": encode_value(memento_data) })))
+
+    @classmethod
+    def load(cls, filename, store=None):
+
+        module_logger.info("reading surrogate dataset from {}".format(filename))
+
+        with open_dataset_file(filename, 'r') as f:
+
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                header = {}
+
+            if type(header) != dict or header.get("format") != dataset_format:
+                msg = "{} is not a surrogate dataset, cannot continue...".format(filename)
+                module_logger.critical(msg)
+                raise SurrogateDatasetError(msg)
+
+            if header["version"] > dataset_format_version:
+                msg = "surrogate dataset {} has version {}, but this version of raintale only reads " \
+                    "up to version {}, cannot continue...".format(filename, header["version"], dataset_format_version)
+                module_logger.critical(msg)
+                raise SurrogateDatasetError(msg)
+
+            # fields are found by parsing templates, datasets written before that may list them differently
+            fields = get_template_surrogate_fields("\n".join(header["fields"]))
+
+            dataset = cls(story_data=decode_value(header["story"]), fields=fields, store=store)
+
+            for linenumber, line in enumerate(f, start=2):
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    msg = "surrogate dataset {} is corrupt at line {}, cannot continue...".format(filename, linenumber)
+                    module_logger.critical(msg)
+                    raise SurrogateDatasetError(msg)
+
+                dataset.add_memento_data(record["urim"], decode_value(record["surrogate"]))
+
+        return dataset
+
+def fetch_surrogate_dataset(story_data, story_templates, mementoembed_api, session=None, progress=None, store=None):
+    """
+        Fetches, in one pass, the surrogate data needed by all of
+        `story_templates` for the URI-Ms of the story, and returns it as a
+        SurrogateDataset kept in `store`. If given, `progress` follows the
+        requests.
+    """
+
+    fields = get_story_surrogate_fields(story_templates)
+
+    md = MementoData("\n".join(sorted(fields)), mementoembed_api, progress=progress, store=store)
+
+    urims = get_story_urims(story_data)
+
+    module_logger.info("fetching {} surrogate fields for {} URI-Ms".format(len(fields), len(urims)))
+
+    for urim in urims:
+        md.add(urim)
+
+    if len(urims) > 0 and len(fields) > 0:
+        md.fetch_all_memento_data(session=session)
+
+    # the dataset shares the store of the memento data, so the surrogates are not copied
+    dataset = SurrogateDataset(story_data=story_data, fields=fields, store=md.store)
+
+    for urim in urims:
+
+        if not md.has_memento_data(urim):
+            module_logger.warning("no surrogate data was fetched for URI-M {}".format(urim))
+
+    return dataset
+
+class SurrogateCache:
+    """
+        Surrogate data kept in memory between stories. Each URI-M records
+        the template fields it was fetched for, so a story only fetches the
+        URI-Ms, or the fields, that no earlier story needed.
+    """
+
+    def __init__(self, mementoembed_api, session=None, max_urims=default_max_cached_urims):
+        self.mementoembed_api = mementoembed_api
+        self.session = session
+        self.max_urims = max_urims
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_dataset(self, story_data, story_templates):
+        """
+            Returns a SurrogateDataset of the surrogate data needed by
+            `story_templates` for the URI-Ms of `story_data`, fetching from
+            MementoEmbed only what is not already cached.
+        """
+
+        fields = get_story_surrogate_fields(story_templates)
+        urims = get_story_urims(story_data)
+
+        with self._lock:
+            missing_urims = [
+                urim for urim in urims
+                    if urim not in self._entries or not fields.issubset(self._entries[urim][0])
+            ]
+
+        module_logger.info("{} of {} URI-Ms of story '{}' are not cached".format(
+            len(missing_urims), len(urims), story_data['title']))
+
+        if len(missing_urims) > 0 and len(fields) > 0:
+
+            missing_story_data = {
+                "elements": [ { "type": "link", "value": urim } for urim in missing_urims ]
+            }
+
+            fetched = fetch_surrogate_dataset(missing_story_data, story_templates, self.mementoembed_api,
+                session=self.session)
+
+            with self._lock:
+
+                for urim in missing_urims:
+
+                    # failed fetches are not cached, so the next story tries them again
+                    if fetched.has_memento_data(urim):
+                        cached_fields, memento_data = self._entries.pop(urim, (set(), {}))
+                        memento_data.update(fetched.get_memento_data(urim))
+                        self._entries[urim] = (cached_fields | fields, memento_data)
+
+        dataset = SurrogateDataset(story_data=story_data, fields=fields)
+
+        with self._lock:
+
+            for urim in urims:
+
+                if urim in self._entries:
+                    self._entries.move_to_end(urim)
+                    dataset.add_memento_data(urim, dict(self._entries[urim][1]))
+
+            while len(self._entries) > self.max_urims:
+                self._entries.popitem(last=False)
+
+        return dataset
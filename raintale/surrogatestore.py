@@ -0,0 +1,264 @@
+import os
+import json
+import logging
+import sqlite3
+import tempfile
+import threading
+
+from collections.abc import Mapping
+from datetime import datetime
+
+module_logger = logging.getLogger('raintale.surrogatestore')
+
+datetime_format = "%Y-%m-%dT%H:%M:%S.%f"
+
+# values at least this many bytes long, such as thumbnails and imagereels, stay on disk until they are used
+default_spill_size = 4096
+
+surrogate_store_kinds = [ "memory", "sqlite" ]
+
+def encode_value(value):
+    """
+        Converts the datetimes in surrogate and story data, which JSON
+        cannot represent, into tagged strings.
+    """
+
+    if isinstance(value, datetime):
+        return { "$datetime": value.strftime(datetime_format) }
+
+    if type(value) == dict:
+        return dict( (k, encode_value(v)) for k, v in value.items() )
+
+    if type(value) in (list, tuple):
+        return [ encode_value(v) for v in value ]
+
+    return value
+
+def decode_value(value):
+
+    if type(value) == dict:
+
+        if list(value.keys()) == [ "$datetime" ]:
+            return datetime.strptime(value["$datetime"], datetime_format)
+
+        return dict( (k, decode_value(v)) for k, v in value.items() )
+
+    if type(value) == list:
+        return [ decode_value(v) for v in value ]
+
+    return value
+
+class MemorySurrogateStore:
+    """
+        Keeps the surrogate data of each URI-M in a dictionary, which is
+        fastest while the whole story fits in memory.
+    """
+
+    def __init__(self):
+        self._mementodata = {}
+
+    def __contains__(self, urim):
+        return urim in self._mementodata
+
+    def __iter__(self):
+        return iter(list(self._mementodata))
+
+    def __len__(self):
+        return len(self._mementodata)
+
+    def __repr__(self):
+        return "<{} of {} URI-Ms>".format(type(self).__name__, len(self))
+
+    def update(self, urim, values):
+        self._mementodata.setdefault(urim, {}).update(values)
+
+    def get(self, urim):
+        """
+            Returns the surrogate data of `urim`, raising KeyError if there
+            is none.
+        """
+        return self._mementodata[urim]
+
+    def close(self):
+        self._mementodata = {}
+
+class LazySurrogateData(Mapping):
+    """
+        The surrogate data of a URI-M held by a SQLiteSurrogateStore. Small
+        values are read up front and large ones from disk each time they
+        are used, so a story holding many of these holds little memory.
+    """
+
+    def __init__(self, store, urim, values, spilled_fieldnames):
+        self.store = store
+        self.urim = urim
+        self._values = values
+        self._spilled_fieldnames = spilled_fieldnames
+
+    def __getitem__(self, fieldname):
+
+        if fieldname in self._values:
+            return self._values[fieldname]
+
+        if fieldname in self._spilled_fieldnames:
+            return self.store.read_value(self.urim, fieldname)
+
+        raise KeyError(fieldname)
+
+    def __iter__(self):
+        yield from self._values
+        yield from self._spilled_fieldnames
+
+    def __len__(self):
+        return len(self._values) + len(self._spilled_fieldnames)
+
+    def __repr__(self):
+
+        fields = [ "{!r}: {!r}".format(k, v) for k, v in self._values.items() ]
+        fields.extend( "{!r}: <on disk>".format(k) for k in self._spilled_fieldnames )
+
+        return "{" + ", ".join(fields) + "}"
+
+class SQLiteSurrogateStore:
+    """
+        Keeps the surrogate data of each URI-M in a SQLite database, so
+        that stories of many thousands of URI-Ms, with thumbnails and
+        imagereels inline, are told without holding them all in memory.
+
+        Values of at least `spill_size` bytes are only read from disk when
+        a template uses them. Unless `filename` is given, the database is
+        a temporary file in `directory` that is removed as soon as it is
+        opened, so nothing is left behind if raintale is killed.
+    """
+
+    def __init__(self, filename=None, directory=None, spill_size=default_spill_size):
+
+        self.spill_size = spill_size
+        self._lock = threading.Lock()
+
+        if filename is None:
+
+            fd, filename = tempfile.mkstemp(prefix="raintale-surrogates-", suffix=".sqlite", dir=directory)
+            os.close(fd)
+
+            self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+
+            try:
+                # an unlinked database stays usable through the open connection
+                os.remove(filename)
+                self.filename = None
+            except OSError:
+                self.filename = filename
+
+            self._remove_on_close = self.filename is not None
+
+        else:
+            self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+            self.filename = filename
+            self._remove_on_close = False
+
+        # the data can always be fetched again, so durability is traded for speed
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+
+        self.db.execute("""CREATE TABLE IF NOT EXISTS surrogates (
+            urim TEXT NOT NULL,
+            fieldname TEXT NOT NULL,
+            value TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (urim, fieldname)
+        )""")
+
+    def __contains__(self, urim):
+
+        with self._lock:
+            row = self.db.execute("SELECT 1 FROM surrogates WHERE urim = ? LIMIT 1", (urim,)).fetchone()
+
+        return row is not None
+
+    def __iter__(self):
+
+        with self._lock:
+            rows = self.db.execute("SELECT urim FROM surrogates GROUP BY urim ORDER BY MIN(rowid)").fetchall()
+
+        return iter([ row[0] for row in rows ])
+
+    def __len__(self):
+
+        with self._lock:
+            return self.db.execute("SELECT COUNT(DISTINCT urim) FROM surrogates").fetchone()[0]
+
+    def __repr__(self):
+        return "<{} of {} URI-Ms>".format(type(self).__name__, len(self))
+
+    def update(self, urim, values):
+
+        rows = []
+
+        for fieldname, value in values.items():
+            encoded = json.dumps(encode_value(value))
+            rows.append( (urim, fieldname, encoded, len(encoded)) )
+
+        with self._lock:
+            self.db.executemany("INSERT OR REPLACE INTO surrogates (urim, fieldname, value, size) VALUES (?, ?, ?, ?)",
+                rows)
+
+    def get(self, urim):
+        """
+            Returns the surrogate data of `urim` as a mapping that reads its
+            large values from disk when they are used, raising KeyError if
+            there is none.
+        """
+
+        with self._lock:
+            rows = self.db.execute("SELECT fieldname, CASE WHEN size < ? THEN value END FROM surrogates "
+                "WHERE urim = ? ORDER BY rowid", (self.spill_size, urim)).fetchall()
+
+        if len(rows) == 0:
+            raise KeyError(urim)
+
+        values = {}
+        spilled_fieldnames = []
+
+        for fieldname, value in rows:
+
+            if value is None:
+                spilled_fieldnames.append(fieldname)
+            else:
+                values[fieldname] = decode_value(json.loads(value))
+
+        return LazySurrogateData(self, urim, values, spilled_fieldnames)
+
+    def read_value(self, urim, fieldname):
+
+        with self._lock:
+            row = self.db.execute("SELECT value FROM surrogates WHERE urim = ? AND fieldname = ?",
+                (urim, fieldname)).fetchone()
+
+        if row is None:
+            raise KeyError(fieldname)
+
+        return decode_value(json.loads(row[0]))
+
+    def close(self):
+
+        with self._lock:
+            self.db.close()
+
+        if self._remove_on_close is True:
+            os.remove(self.filename)
+            self._remove_on_close = False
+
+def open_surrogate_store(kind="memory", directory=None, spill_size=default_spill_size):
+    """
+        Returns a new, empty surrogate store of `kind`, either "memory" or
+        "sqlite", whose database is a temporary file in `directory`.
+    """
+
+    if kind == "memory":
+        return MemorySurrogateStore()
+
+    if kind == "sqlite":
+        return SQLiteSurrogateStore(directory=directory, spill_size=spill_size)
+
+    raise ValueError("unknown surrogate store {}, expected one of {}".format(kind, ", ".join(surrogate_store_kinds)))
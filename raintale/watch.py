@@ -0,0 +1,165 @@
+import os
+import time
+import logging
+import threading
+
+from jinja2 import TemplateError
+
+from .storydata import StoryDataError
+from .surrogatedataset import get_story_urims
+from .storytellers.storyteller import tell_stories
+
+module_logger = logging.getLogger('raintale.watch')
+
+# how often, in seconds, the watched files are checked for changes
+default_poll_interval = 0.25
+
+# editors often save in several steps, so a change is told once the files have stopped changing for this long
+default_settle_time = 0.1
+
+def get_file_state(filename):
+    """
+        Returns what changes when `filename` is saved, or None if it does
+        not exist.
+    """
+
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+class StoryWatcher:
+    """
+        Tells a story again whenever its input file or the template of one
+        of its storytellers changes.
+
+        Surrogates are kept in `surrogate_cache` between tellings, so a
+        change only fetches the surrogates of the URI-Ms added to the story,
+        or of the fields added to a template, and everything else is
+        rendered from memory.
+
+        `storytelling` holds a (storyteller, template filename, surrogate
+        template) tuple for each storyteller. The template filename is None
+        for storytellers without templates, whose surrogate template is
+        given instead. `read_story_data` is called with no arguments to read
+        the story from `input_filename`.
+    """
+
+    def __init__(self, input_filename, read_story_data, storytelling, surrogate_cache,
+        poll_interval=default_poll_interval, settle_time=default_settle_time):
+
+        self.input_filename = input_filename
+        self.read_story_data = read_story_data
+        self.storytelling = storytelling
+        self.surrogate_cache = surrogate_cache
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self._urims = None
+
+    @property
+    def watched_filenames(self):
+
+        filenames = [ self.input_filename ]
+
+        for storyteller, template_filename, surrogate_template in self.storytelling:
+            if template_filename is not None and template_filename not in filenames:
+                filenames.append(template_filename)
+
+        return filenames
+
+    def get_state(self):
+        return [ get_file_state(filename) for filename in self.watched_filenames ]
+
+    def log_changes(self, story_data):
+
+        urims = set(get_story_urims(story_data))
+
+        if self._urims is not None:
+            module_logger.info("story now has {} URI-Ms, {} added and {} removed".format(
+                len(urims), len(urims - self._urims), len(self._urims - urims)))
+
+        self._urims = urims
+
+    def tell_story(self):
+        """
+            Reads the story and the templates and tells the story with every
+            storyteller, returning the location of each story, or None for
+            those that failed.
+        """
+
+        story_data = self.read_story_data()
+
+        self.log_changes(story_data)
+
+        storytelling = []
+        surrogate_templates = []
+
+        for storyteller, template_filename, surrogate_template in self.storytelling:
+
+            if template_filename is None:
+                story_template = ""
+            else:
+                with open(template_filename) as f:
+                    story_template = f.read()
+
+            storytelling.append( (storyteller, story_template) )
+            surrogate_templates.append(story_template if surrogate_template is None else surrogate_template)
+
+        start = time.monotonic()
+
+        dataset = self.surrogate_cache.get_dataset(story_data, surrogate_templates)
+
+        for storyteller, story_template in storytelling:
+            storyteller.surrogate_dataset = dataset
+
+        locations = tell_stories(storytelling, story_data, self.surrogate_cache.mementoembed_api)
+
+        module_logger.info("told story '{}' in {:.2f} seconds".format(story_data['title'], time.monotonic() - start))
+
+        return locations
+
+    def watch(self, stop_event=None, on_told=None):
+        """
+            Tells the story, then tells it again after each change until
+            `stop_event` is set, calling `on_told` with the locations of
+            the stories each time. A story that cannot be read, such as
+            one saved halfway through an edit, is reported and the
+            watcher waits for the next change.
+        """
+
+        if stop_event is None:
+            stop_event = threading.Event()
+
+        state = None
+
+        while not stop_event.is_set():
+
+            current_state = self.get_state()
+
+            if current_state != state:
+
+                # wait for the files to stop changing
+                while True:
+
+                    stop_event.wait(self.settle_time)
+                    settled_state = self.get_state()
+
+                    if settled_state == current_state:
+                        break
+
+                    current_state = settled_state
+
+                state = current_state
+
+                try:
+                    locations = self.tell_story()
+                except (StoryDataError, TemplateError, OSError, ValueError) as e:
+                    module_logger.error("cannot tell the story, waiting for the next change: {}".format(
+                        getattr(e, 'message', e)))
+                else:
+                    if on_told is not None:
+                        on_told(locations)
+
+            stop_event.wait(self.poll_interval)
@@ -0,0 +1,349 @@
+"""
+    Local stand-ins for the social media APIs used by the service
+    storytellers. They record what was published and enforce rate limits
+    the way the real services do, using a fake clock so tests never sleep.
+"""
+
+import json
+import threading
+
+from urllib.parse import parse_qsl
+
+import requests
+import twitter
+import facebook
+
+from requests.structures import CaseInsensitiveDict
+
+from raintale.storytellers.twitter import TwitterStoryTeller
+from raintale.storytellers.facebook import FacebookStoryTeller
+from raintale.storytellers.scheduler import PublishScheduler
+
+class FakeClock:
+
+    def __init__(self, now=1500000000.0):
+        self.now = now
+        self.slept = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+class FakeResponse:
+
+    def __init__(self, headers, url="https://api.example.com/"):
+        self.headers = CaseInsensitiveDict(headers)
+        self.url = url
+
+class FakeTwitterUser:
+
+    def __init__(self, screen_name):
+        self.screen_name = screen_name
+
+class FakeTwitterStatus:
+
+    def __init__(self, status_id, text, media, in_reply_to_status_id, screen_name):
+        self.id = status_id
+        self.text = text
+        self.media = media
+        self.in_reply_to_status_id = in_reply_to_status_id
+        self.user = FakeTwitterUser(screen_name)
+
+class StandInTwitterApi:
+    """
+        Mimics the parts of python-twitter's Api used by TwitterStoryTeller.
+        Allows `limit` tweets every `window` seconds, reports the limit in
+        X-Rate-Limit headers, and fails with error code 88 once exceeded.
+        If `fail_after` is set, the connection is lost once that many tweets
+        have been posted.
+    """
+
+    chunk_size = 1024 * 1024
+    upload_url = "https://upload.twitter.com/1.1"
+
+    def __init__(self, clock, limit=300, window=3 * 60 * 60, response_hook=None, screen_name="raintaletest",
+        fail_after=None):
+        self.clock = clock
+        self.fail_after = fail_after
+        self.limit = limit
+        self.window = window
+        self.response_hook = response_hook
+        self.screen_name = screen_name
+        self.window_start = clock.time()
+        self.window_count = 0
+        self.next_id = 1000
+        self.statuses = []
+        self.rejected = 0
+        self.next_media_id = 9000
+        self.uploads = {}
+        self.upload_lock = threading.Lock()
+
+    def _check_rate_limit(self):
+
+        if self.clock.time() >= self.window_start + self.window:
+            self.window_start = self.clock.time()
+            self.window_count = 0
+
+        remaining = self.limit - self.window_count
+        headers = {
+            "x-rate-limit-limit": str(self.limit),
+            "x-rate-limit-remaining": str(max(0, remaining - 1)),
+            "x-rate-limit-reset": str(int(self.window_start + self.window))
+        }
+
+        if remaining <= 0:
+            headers["x-rate-limit-remaining"] = "0"
+
+            if self.response_hook is not None:
+                self.response_hook(FakeResponse(headers, url="https://api.twitter.com/1.1/statuses/update.json"))
+
+            self.rejected += 1
+            raise twitter.error.TwitterError([ { "code": 88, "message": "Rate limit exceeded" } ])
+
+        self.window_count += 1
+
+        if self.response_hook is not None:
+            self.response_hook(FakeResponse(headers, url="https://api.twitter.com/1.1/statuses/update.json"))
+
+    def _upload(self, media, chunked):
+
+        if hasattr(media, 'read'):
+            media.seek(0)
+            data = media.read()
+        else:
+            data = media
+
+        with self.upload_lock:
+            self.next_media_id += 1
+            media_id = self.next_media_id
+            self.uploads[media_id] = { "data": data, "chunked": chunked }
+
+        if self.response_hook is not None:
+            self.response_hook(FakeResponse({}, url="{}/media/upload.json".format(self.upload_url)))
+
+        return media_id
+
+    def UploadMediaSimple(self, media, additional_owners=None, media_category=None):
+        return self._upload(media, False)
+
+    def UploadMediaChunked(self, media, additional_owners=None, media_category=None):
+        return self._upload(media, True)
+
+    def PostUpdate(self, status, media=None, in_reply_to_status_id=None):
+
+        if self.fail_after is not None and len(self.statuses) >= self.fail_after:
+            raise requests.ConnectionError("connection lost")
+
+        self._check_rate_limit()
+
+        for item in media or []:
+            if type(item) != int or item not in self.uploads:
+                raise twitter.error.TwitterError([ { "code": 324, "message": "The validation of media ids failed." } ])
+
+        self.next_id += 1
+
+        posted = FakeTwitterStatus(self.next_id, status, media, in_reply_to_status_id, self.screen_name)
+        self.statuses.append(posted)
+
+        return posted
+
+class StandInGraphAPI:
+    """
+        Mimics the parts of facebook-sdk's GraphAPI used by
+        FacebookStoryTeller, including batch requests. Reports usage in the
+        X-Page-Usage header and fails with error code 32 once `limit` calls
+        are made in `window` seconds. Each operation in a batch counts as a
+        call. Comments whose message is in `invalid_messages` fail with
+        error code 100. If `fail_after` is set, the connection is lost once
+        that many objects have been created.
+    """
+
+    version = "v2.12"
+
+    def __init__(self, clock, limit=50, window=60, response_hook=None, page_id="1234", fail_after=None,
+        invalid_messages=None):
+        self.clock = clock
+        self.fail_after = fail_after
+        self.invalid_messages = invalid_messages or []
+        self.limit = limit
+        self.window = window
+        self.response_hook = response_hook
+        self.page_id = page_id
+        self.window_start = clock.time()
+        self.window_count = 0
+        self.next_id = 5000
+        self.objects = []
+        self.rejected = 0
+        self.http_requests = 0
+
+    def _check_rate_limit(self):
+        """
+            Counts a call and returns the usage headers for it along with
+            the error body if the limit was exceeded.
+        """
+
+        if self.clock.time() >= self.window_start + self.window:
+            self.window_start = self.clock.time()
+            self.window_count = 0
+
+        if self.window_count >= self.limit:
+
+            self.rejected += 1
+
+            return { "x-page-usage": json.dumps({ "call_count": 100, "total_time": 10, "total_cputime": 10 }) }, \
+                { "error": { "message": "Page request limit reached", "code": 32, "type": "OAuthException" } }
+
+        self.window_count += 1
+
+        return { "x-page-usage": json.dumps({
+            "call_count": int(100 * self.window_count / self.limit), "total_time": 10, "total_cputime": 10 }) }, None
+
+    def _create_object(self, parent_object, connection_name, data):
+
+        self.next_id += 1
+
+        if connection_name == "feed":
+            object_id = "{}_{}".format(self.page_id, self.next_id)
+        else:
+            object_id = "{}".format(self.next_id)
+
+        self.objects.append(
+            {
+                "id": object_id,
+                "parent_object": parent_object,
+                "connection_name": connection_name,
+                "data": data
+            }
+        )
+
+        return object_id
+
+    def put_object(self, parent_object, connection_name, **data):
+
+        if self.fail_after is not None and len(self.objects) >= self.fail_after:
+            raise requests.ConnectionError("connection lost")
+
+        self.http_requests += 1
+
+        headers, error = self._check_rate_limit()
+
+        if self.response_hook is not None:
+            self.response_hook(FakeResponse(headers))
+
+        if error is not None:
+            raise facebook.GraphAPIError(error)
+
+        return { "id": self._create_object(parent_object, connection_name, data) }
+
+    def request(self, path, args=None, post_args=None, files=None, method=None):
+
+        if self.fail_after is not None and len(self.objects) >= self.fail_after:
+            raise requests.ConnectionError("connection lost")
+
+        self.http_requests += 1
+
+        batch = json.loads(post_args["batch"])
+
+        responses = []
+        failed = set()
+
+        for operation in batch:
+
+            if operation.get("depends_on") in failed:
+                failed.add(operation["name"])
+                responses.append(None)
+                continue
+
+            headers, error = self._check_rate_limit()
+
+            relative_url = operation["relative_url"].split('/')
+            parent_object, connection_name = relative_url[-2], relative_url[-1]
+            data = dict(parse_qsl(operation["body"]))
+
+            if error is None and data.get("message") in self.invalid_messages:
+                error = { "error": { "message": "Invalid parameter", "code": 100, "type": "OAuthException" } }
+
+            if error is not None:
+                failed.add(operation["name"])
+                responses.append({
+                    "code": 400,
+                    "headers": [ { "name": k, "value": v } for k, v in headers.items() ],
+                    "body": json.dumps(error)
+                })
+                continue
+
+            object_id = self._create_object(parent_object, connection_name, data)
+
+            responses.append({
+                "code": 200,
+                "headers": [ { "name": k, "value": v } for k, v in headers.items() ],
+                "body": json.dumps({ "id": object_id })
+            })
+
+        return responses
+
+def make_story_output_data(count):
+
+    return {
+        "main_post": "My Story Title",
+        "comment_posts": [
+            { "text": "story element #{}".format(i), "media": [] } for i in range(1, count + 1)
+        ]
+    }
+
+def write_twitter_credentials(credentials_filename):
+
+    with open(credentials_filename, 'w') as f:
+        f.write("""consumer_key: XXX
+consumer_secret: XXX
+access_token_key: XXX
+access_token_secret: XXX""")
+
+def write_facebook_credentials(credentials_filename):
+
+    with open(credentials_filename, 'w') as f:
+        f.write("""page_id: 1234
+access_token: XXX""")
+
+def make_fake_clock_scheduler(storyteller, clock, requests_per_window, window_seconds, scheduler_options=None):
+
+    return PublishScheduler(requests_per_window, window_seconds,
+        is_rate_limit_error=storyteller.is_rate_limit_error, clock=clock.time, sleep=clock.sleep,
+        **(scheduler_options or {}))
+
+def make_standin_twitter_storyteller(credentials_filename, clock, api, scheduler_options=None, **storyteller_options):
+    """
+        Returns a TwitterStoryTeller that publishes to the stand-in `api`
+        and paces itself with `clock`.
+    """
+
+    tst = TwitterStoryTeller(credentials_filename, auth_check=False, **storyteller_options)
+
+    tst.scheduler = make_fake_clock_scheduler(tst, clock,
+        tst.publish_requests_per_window, tst.publish_window_seconds, scheduler_options)
+    tst.media_scheduler = make_fake_clock_scheduler(tst, clock,
+        tst.media_upload_requests_per_window, tst.media_upload_window_seconds, scheduler_options)
+
+    api.response_hook = tst.response_hook
+    tst.api = api
+
+    return tst
+
+def make_standin_facebook_storyteller(credentials_filename, clock, graph, scheduler_options=None, **storyteller_options):
+    """
+        Returns a FacebookStoryTeller that publishes to the stand-in `graph`
+        and paces itself with `clock`.
+    """
+
+    fst = FacebookStoryTeller(credentials_filename, auth_check=False, **storyteller_options)
+
+    fst.scheduler = make_fake_clock_scheduler(fst, clock,
+        fst.publish_requests_per_window, fst.publish_window_seconds, scheduler_options)
+
+    graph.response_hook = fst.scheduler.response_hook
+    fst.graph = graph
+
+    return fst
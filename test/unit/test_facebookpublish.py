@@ -0,0 +1,45 @@
+import unittest
+
+from .standin_apis import FakeClock, StandInGraphAPI, make_story_output_data, write_facebook_credentials, \
+    make_standin_facebook_storyteller
+
+class TestFacebookPublish(unittest.TestCase):
+
+    def setUp(self):
+
+        self.credentials_filename = "/tmp/fbcredentials.yaml"
+        write_facebook_credentials(self.credentials_filename)
+
+        self.clock = FakeClock()
+
+    def test_comments_published_in_batches(self):
+
+        graph = StandInGraphAPI(self.clock, limit=500)
+        fst = make_standin_facebook_storyteller(self.credentials_filename, self.clock, graph)
+
+        fst.publish_story(make_story_output_data(120))
+
+        comments = [ o for o in graph.objects if o["connection_name"] == "comments" ]
+
+        self.assertEqual([ c["data"]["message"] for c in comments ],
+            [ "story element #{}".format(i) for i in range(1, 121) ],
+            "comments were not published in story order")
+
+        # one request for the title post, and 120 comments in batches of 50
+        self.assertEqual(graph.http_requests, 4)
+
+        # each comment in a batch counts against the 50 requests a minute, so the second batch waits for the next
+        self.assertGreaterEqual(self.clock.slept, 60, "batches of comments were published faster than the rate limit")
+
+    def test_failed_comment_skipped(self):
+
+        graph = StandInGraphAPI(self.clock, limit=500, invalid_messages=[ "story element #3" ])
+        fst = make_standin_facebook_storyteller(self.credentials_filename, self.clock, graph)
+
+        fst.publish_story(make_story_output_data(10))
+
+        comments = [ o for o in graph.objects if o["connection_name"] == "comments" ]
+
+        self.assertEqual([ c["data"]["message"] for c in comments ],
+            [ "story element #{}".format(i) for i in range(1, 11) if i != 3 ],
+            "the comments after a failed comment were not published")
@@ -0,0 +1,63 @@
+import unittest
+import os
+import tempfile
+import shutil
+
+import requests
+import requests_mock
+
+from raintale.httpcache import get_cached_session, prune_cache, get_cache_size
+
+class TestHTTPCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_directory = tempfile.mkdtemp(prefix="raintale-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_directory)
+
+    def test_cache_shared_between_sessions(self):
+
+        adapter = requests_mock.Adapter()
+        adapter.register_uri('GET', 'mock://127.0.0.1:9899/image.png', content=b"image data")
+
+        session1 = get_cached_session('test', cache_directory=self.cache_directory)
+        session1.mount('mock', adapter)
+
+        r = session1.get('mock://127.0.0.1:9899/image.png')
+        self.assertEqual(r.content, b"image data")
+        self.assertFalse(r.from_cache)
+
+        self.assertTrue(
+            os.path.exists("{}/test.sqlite".format(self.cache_directory)),
+            "cache was not written to the cache directory"
+        )
+
+        session2 = get_cached_session('test', cache_directory=self.cache_directory)
+        session2.mount('mock', adapter)
+
+        r = session2.get('mock://127.0.0.1:9899/image.png')
+        self.assertEqual(r.content, b"image data")
+        self.assertTrue(r.from_cache, "second session did not use the shared cache")
+
+        self.assertNotIsInstance(requests.Session(), type(session1),
+            "requests was patched globally")
+
+    def test_prune_cache(self):
+
+        adapter = requests_mock.Adapter()
+
+        session = get_cached_session('test', cache_directory=self.cache_directory, max_cache_size=None)
+        session.mount('mock', adapter)
+
+        for i in range(0, 20):
+            uri = 'mock://127.0.0.1:9899/image{}.png'.format(i)
+            adapter.register_uri('GET', uri, content=os.urandom(10000))
+            session.get(uri)
+
+        self.assertEqual(len(session.cache.responses), 20)
+
+        prune_cache(session, 100000)
+
+        self.assertLessEqual(get_cache_size(session), 100000)
+        self.assertLess(len(session.cache.responses), 20)
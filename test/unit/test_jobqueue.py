@@ -0,0 +1,252 @@
+import unittest
+import os
+import time
+import tempfile
+import threading
+
+from raintale.jobqueue import JobQueue, RemoteJobQueue, JobBroker, StoryWorker, JobQueueError, is_loopback_host
+from raintale.server import StoryService
+
+from .test_surrogatedataset import make_mementoembed_session, mementoembed_api, urim1, urim2
+
+story_template = "<title>{{ title }}</title>\n" \
+    "{% for element in elements %}{% if element.type == 'link' %}<element>{{ element.surrogate.title }}</element>\n" \
+    "{% endif %}{% endfor %}"
+
+job_request = {
+    "storyteller": "template",
+    "template": story_template,
+    "title": "A story from the queue",
+    "urims": [ urim1, urim2 ]
+}
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.job_queue = JobQueue(os.path.join(self.tmpdir.name, "jobs.sqlite"), max_attempts=2)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_claim_and_complete(self):
+
+        job = self.job_queue.submit(job_request)
+        self.assertEqual(job["status"], "queued")
+
+        claimed = self.job_queue.claim("worker-1")
+
+        self.assertEqual(claimed["id"], job["id"])
+        self.assertEqual(claimed["request"], job_request)
+        self.assertEqual(claimed["attempts"], 1)
+        self.assertIsNone(self.job_queue.claim("worker-2"), "a claimed job was claimed twice")
+
+        self.assertFalse(self.job_queue.complete(job["id"], "worker-2", result={}))
+        self.assertTrue(self.job_queue.complete(job["id"], "worker-1", result={ "location": "story.html" }))
+
+        job = self.job_queue.get(job["id"])
+
+        self.assertEqual(job["status"], "succeeded")
+        self.assertEqual(job["result"], { "location": "story.html" })
+        self.assertEqual(self.job_queue.list_jobs(status="queued"), [])
+
+    def test_expired_claims_are_claimed_again(self):
+
+        job = self.job_queue.submit(job_request)
+
+        self.job_queue.claim("worker-1", lease_seconds=0.05)
+        time.sleep(0.1)
+
+        claimed = self.job_queue.claim("worker-2", lease_seconds=0.05)
+
+        self.assertEqual(claimed["id"], job["id"])
+        self.assertEqual(claimed["attempts"], 2)
+
+        # the first worker no longer holds the job
+        self.assertFalse(self.job_queue.renew(job["id"], "worker-1"))
+        self.assertFalse(self.job_queue.complete(job["id"], "worker-1"))
+
+        time.sleep(0.1)
+
+        self.assertIsNone(self.job_queue.claim("worker-3"))
+
+        job = self.job_queue.get(job["id"])
+        self.assertEqual(job["status"], "failed")
+        self.assertIn("abandoned", job["error"])
+
+    def test_failed_jobs_are_retried(self):
+
+        job = self.job_queue.submit(job_request)
+
+        self.job_queue.claim("worker-1")
+        self.assertTrue(self.job_queue.fail(job["id"], "worker-1", "MementoEmbed is down"))
+        self.assertEqual(self.job_queue.get(job["id"])["status"], "queued")
+
+        self.job_queue.claim("worker-1")
+        self.assertTrue(self.job_queue.fail(job["id"], "worker-1", "MementoEmbed is still down"))
+
+        job = self.job_queue.get(job["id"])
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["error"], "MementoEmbed is still down")
+
+    def test_released_jobs_keep_their_attempts(self):
+
+        job = self.job_queue.submit(job_request)
+
+        self.job_queue.claim("worker-1")
+        self.assertTrue(self.job_queue.release(job["id"], "worker-1"))
+
+        self.assertEqual(self.job_queue.claim("worker-2")["attempts"], 1)
+
+class TestJobBroker(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        self.broker = JobBroker(("127.0.0.1", 0), JobQueue(os.path.join(self.tmpdir.name, "jobs.sqlite")),
+            token="a-broker-token")
+
+        self.broker_thread = threading.Thread(target=self.broker.serve_forever, daemon=True)
+        self.broker_thread.start()
+
+        self.broker_uri = "http://127.0.0.1:{}".format(self.broker.server_address[1])
+        self.job_queue = RemoteJobQueue(self.broker_uri, token="a-broker-token")
+
+    def tearDown(self):
+        self.broker.shutdown()
+        self.broker.server_close()
+        self.tmpdir.cleanup()
+
+    def test_remote_queue(self):
+
+        job = self.job_queue.submit(job_request)
+
+        claimed = self.job_queue.claim("worker-1")
+
+        self.assertEqual(claimed["id"], job["id"])
+        self.assertIsNone(self.job_queue.claim("worker-2"))
+
+        self.assertTrue(self.job_queue.renew(job["id"], "worker-1"))
+        self.assertFalse(self.job_queue.complete(job["id"], "worker-2"))
+        self.assertTrue(self.job_queue.complete(job["id"], "worker-1", result={ "location": "story.html" }))
+
+        self.assertEqual(self.job_queue.get(job["id"])["status"], "succeeded")
+        self.assertEqual([ j["id"] for j in self.job_queue.list_jobs(status="succeeded") ], [ job["id"] ])
+        self.assertIsNone(self.job_queue.get("no-such-job"))
+
+    def test_requests_require_the_token(self):
+
+        for token in [ None, "a-guess" ]:
+
+            job_queue = RemoteJobQueue(self.broker_uri, token=token)
+
+            with self.assertRaises(JobQueueError) as context:
+                job_queue.submit(job_request)
+
+            self.assertIn("token", context.exception.message)
+            self.assertRaises(JobQueueError, job_queue.list_jobs)
+            self.assertRaises(JobQueueError, job_queue.claim, "worker-1")
+
+        self.assertEqual(self.job_queue.list_jobs(), [], "a job was submitted without the token")
+
+    def test_loopback_hosts(self):
+
+        self.assertTrue(is_loopback_host("127.0.0.1"))
+        self.assertTrue(is_loopback_host("::1"))
+        self.assertTrue(is_loopback_host("localhost"))
+        self.assertFalse(is_loopback_host("0.0.0.0"))
+        self.assertFalse(is_loopback_host("broker.example.com"))
+
+class TestStoryWorker(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        self.job_queue = JobQueue(os.path.join(self.tmpdir.name, "jobs.sqlite"))
+
+        self.session, self.adapter = make_mementoembed_session()
+        self.service = StoryService(mementoembed_api, jobs_directory=os.path.join(self.tmpdir.name, "stories"),
+            max_jobs=1, session=self.session)
+
+    def tearDown(self):
+        self.service.shutdown()
+        self.tmpdir.cleanup()
+
+    def test_workers_tell_queued_stories(self):
+
+        jobs = [ self.job_queue.submit(job_request) for i in range(0, 4) ]
+        invalid_job = self.job_queue.submit({ "storyteller": "no-such-storyteller", "urims": [ urim1 ], "title": "A story" })
+
+        workers = [ StoryWorker(self.job_queue, self.service, worker_id="worker-{}".format(i), poll_interval=0.01)
+            for i in range(0, 2) ]
+
+        stop_event = threading.Event()
+        threads = [ threading.Thread(target=worker.work, kwargs={ "stop_event": stop_event }) for worker in workers ]
+
+        for thread in threads:
+            thread.start()
+
+        deadline = time.time() + 10
+
+        while len(self.job_queue.list_jobs(status="queued") + self.job_queue.list_jobs(status="running")) > 0:
+            self.assertLess(time.time(), deadline, "the workers did not tell every story")
+            time.sleep(0.02)
+
+        stop_event.set()
+
+        for thread in threads:
+            thread.join()
+
+        for job in jobs:
+
+            job = self.job_queue.get(job["id"])
+
+            self.assertEqual(job["status"], "succeeded")
+            self.assertEqual(job["attempts"], 1)
+
+            with open(job["result"]["location"]) as f:
+                self.assertEqual(f.read(),
+                    "<title>A story from the queue</title>\n"
+                    "<element>Title of memento #1</element>\n"
+                    "<element>Title of memento #2</element>\n")
+
+        invalid_job = self.job_queue.get(invalid_job["id"])
+
+        self.assertEqual(invalid_job["status"], "failed")
+        self.assertEqual(invalid_job["attempts"], 1, "an invalid job was retried")
+
+        # each worker fetches the surrogates at most once, the service keeps them for the other jobs
+        self.assertLessEqual(self.adapter.call_count, 2 * len(workers))
+
+    def test_lost_claim_is_signalled(self):
+
+        queued_job = self.job_queue.submit(job_request)
+        self.job_queue.claim("worker-2")
+
+        worker = StoryWorker(self.job_queue, self.service, worker_id="worker-1", lease_seconds=0.03)
+
+        finished = threading.Event()
+        lost_claim = threading.Event()
+
+        worker.renew_claim(queued_job["id"], finished, lost_claim)
+
+        self.assertTrue(lost_claim.is_set(), "a worker that lost its claim was not told to stop publishing")
+
+    def test_job_templates_are_sandboxed(self):
+
+        unsafe_request = dict(job_request, template="{{ cycler.__init__.__globals__.os.getcwd() }}")
+
+        queued_job = self.job_queue.submit(unsafe_request)
+
+        worker = StoryWorker(self.job_queue, self.service, worker_id="worker-1")
+        job = worker.tell_job(self.job_queue.claim(worker.worker_id))
+
+        self.assertEqual(job.status, "failed")
+        self.assertIn("unsafe", job.error)
+        self.assertEqual(self.job_queue.get(queued_job["id"])["error"], job.error)
+
+        if os.path.exists(job.output_filename):
+            with open(job.output_filename) as f:
+                self.assertNotIn(os.getcwd(), f.read())
@@ -0,0 +1,116 @@
+import unittest
+import os
+import tempfile
+import shutil
+
+import requests
+
+from raintale.storytellers.journal import PublishJournal
+
+from .standin_apis import FakeClock, StandInTwitterApi, StandInGraphAPI, make_story_output_data, \
+    write_twitter_credentials, write_facebook_credentials, make_standin_twitter_storyteller, \
+    make_standin_facebook_storyteller
+
+class TestPublishJournal(unittest.TestCase):
+
+    def setUp(self):
+
+        self.working_directory = tempfile.mkdtemp(prefix="raintale-test-")
+        self.journal_filename = os.path.join(self.working_directory, "journal.jsonl")
+
+        self.twitter_credentials_filename = os.path.join(self.working_directory, "credentials.yaml")
+        write_twitter_credentials(self.twitter_credentials_filename)
+
+        self.facebook_credentials_filename = os.path.join(self.working_directory, "fbcredentials.yaml")
+        write_facebook_credentials(self.facebook_credentials_filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.working_directory)
+
+    def make_twitter_storyteller(self, clock, api, resume):
+        return make_standin_twitter_storyteller(self.twitter_credentials_filename, clock, api,
+            journal_filename=self.journal_filename, resume=resume)
+
+    def make_facebook_storyteller(self, clock, graph, resume):
+        return make_standin_facebook_storyteller(self.facebook_credentials_filename, clock, graph,
+            journal_filename=self.journal_filename, resume=resume)
+
+    def test_twitter_resumes_from_last_post(self):
+
+        clock = FakeClock()
+        api = StandInTwitterApi(clock, fail_after=8)
+
+        story_output_data = make_story_output_data(20)
+
+        tst = self.make_twitter_storyteller(clock, api, resume=False)
+
+        with self.assertRaises(requests.ConnectionError):
+            tst.publish_story(story_output_data)
+
+        self.assertEqual(len(api.statuses), 8)
+
+        api.fail_after = None
+        tst = self.make_twitter_storyteller(clock, api, resume=True)
+
+        def generate_story(*args):
+            raise AssertionError("the story was generated again")
+
+        tst.generate_story = generate_story
+
+        output = tst.tell_story(None, None, None)
+
+        statuses = api.statuses
+
+        self.assertEqual(len(statuses), 21, "story elements were not published exactly once")
+        self.assertEqual(output, "https://twitter.com/raintaletest/status/{}".format(statuses[0].id))
+
+        for i in range(1, len(statuses)):
+            self.assertEqual(statuses[i].text, "story element #{}".format(i))
+            self.assertEqual(statuses[i].in_reply_to_status_id, statuses[i - 1].id,
+                "resumed thread tweets are not chained to the last confirmed tweet")
+
+        journal = PublishJournal(self.journal_filename, resume=True)
+
+        self.assertTrue(journal.is_complete())
+        self.assertEqual(journal.get_last_post_id(), statuses[-1].id)
+
+    def test_facebook_resumes_from_last_post(self):
+
+        clock = FakeClock()
+        graph = StandInGraphAPI(clock, fail_after=10)
+
+        story_output_data = make_story_output_data(15)
+
+        fst = self.make_facebook_storyteller(clock, graph, resume=False)
+        fst.comment_batch_size = 4
+
+        with self.assertRaises(requests.ConnectionError):
+            fst.publish_story(story_output_data)
+
+        graph.fail_after = None
+        fst = self.make_facebook_storyteller(clock, graph, resume=True)
+
+        fst.publish_story(story_output_data)
+
+        feed = [ o for o in graph.objects if o["connection_name"] == "feed" ]
+        comments = [ o for o in graph.objects if o["connection_name"] == "comments" ]
+
+        self.assertEqual(len(feed), 1, "the title post was published again")
+        self.assertEqual([ c["data"]["message"] for c in comments ],
+            [ "story element #{}".format(i) for i in range(1, 16) ])
+
+    def test_incomplete_last_record_ignored(self):
+
+        journal = PublishJournal(self.journal_filename)
+        journal.start(make_story_output_data(3))
+        journal.record_post('title', 100)
+        journal.record_post(0, 101)
+
+        with open(self.journal_filename, 'a') as f:
+            f.write('{"event": "post", "ind')
+
+        journal = PublishJournal(self.journal_filename, resume=True)
+
+        self.assertEqual(journal.get_next_index(), 1)
+        self.assertEqual(journal.get_last_post_id(), 101)
+        self.assertFalse(journal.is_complete())
@@ -0,0 +1,132 @@
+import unittest
+import io
+import os
+import base64
+import tempfile
+import shutil
+
+import requests_mock
+
+from PIL import Image
+
+from raintale.httpcache import get_cached_session
+from raintale.mediacache import MediaCache, sniff_media_type, image_media_types
+
+class TestMediaCache(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cache_directory = tempfile.mkdtemp(prefix="raintale-test-")
+
+        self.adapter = requests_mock.Adapter()
+        self.session = get_cached_session('test', cache_directory=self.cache_directory)
+        self.session.mount('mock', self.adapter)
+
+        self.media_cache = MediaCache(cache_directory=self.cache_directory, session=self.session)
+
+        ifp = io.BytesIO()
+        Image.new("RGB", (64, 48), "blue").save(ifp, "JPEG")
+        self.image_data = ifp.getvalue()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_directory)
+
+    def test_sniff_media_type(self):
+
+        self.assertEqual(sniff_media_type(self.image_data), "image/jpeg")
+        self.assertEqual(sniff_media_type(b"GIF89a..."), "image/gif")
+        self.assertEqual(sniff_media_type(b"RIFF\x00\x00\x00\x00WEBPVP8 "), "image/webp")
+        self.assertIsNone(sniff_media_type(b"<html></html>"))
+
+    def test_media_type_from_content(self):
+
+        uri = 'mock://127.0.0.1:9899/image'
+        self.adapter.register_uri('GET', uri, content=self.image_data,
+            headers={ "Content-Type": "application/octet-stream" })
+
+        media = self.media_cache.fetch(uri, media_types=image_media_types)
+
+        self.assertEqual(media.mimetype, "image/jpeg")
+        self.assertEqual(media.data, self.image_data)
+
+        # served from the cache the second time
+        self.assertEqual(self.media_cache.fetch(uri).mimetype, "image/jpeg")
+        self.assertEqual(self.adapter.call_count, 1)
+
+        uri = 'mock://127.0.0.1:9899/notanimage.png'
+        self.adapter.register_uri('GET', uri, content=b"<html></html>")
+
+        self.assertIsNone(self.media_cache.fetch(uri, media_types=image_media_types))
+        self.assertEqual(self.session.get(uri, only_if_cached=True).status_code, 504,
+            "content of the wrong type was stored in the cache")
+
+    def test_datauri(self):
+
+        datauri = "data:image/png;base64,{}".format(base64.b64encode(self.image_data).decode('utf-8'))
+
+        media = self.media_cache.fetch(datauri)
+
+        self.assertEqual(media.mimetype, "image/jpeg", "the media type of a data URI was not taken from its content")
+        self.assertEqual(media.data, self.image_data)
+
+        self.assertIsNone(self.media_cache.fetch("data:image/png;base64"))
+
+    def test_cached_conversions(self):
+
+        ifp = io.BytesIO()
+        frames = [ Image.new("P", (400, 200), i) for i in range(3) ]
+        frames[0].save(ifp, "GIF", save_all=True, append_images=frames[1:])
+
+        uri = 'mock://127.0.0.1:9899/animated.gif'
+        self.adapter.register_uri('GET', uri, content=ifp.getvalue())
+
+        media = self.media_cache.fetch(uri)
+
+        self.assertEqual(media.mimetype, "image/gif")
+
+        png = self.media_cache.convert(media, "png")
+
+        self.assertEqual(png.mimetype, "image/png")
+        self.assertEqual(Image.open(io.BytesIO(png.data)).size, (400, 200))
+
+        fitted = self.media_cache.convert(png, "fit", 100, 100)
+
+        self.assertEqual(Image.open(io.BytesIO(fitted.data)).size, (100, 50))
+
+        conversions = sorted(os.listdir(self.media_cache.conversion_directory))
+
+        self.assertEqual(len(conversions), 2)
+
+        # a second cache over the same directory reuses the conversions
+        other_cache = MediaCache(cache_directory=self.cache_directory, session=self.session)
+
+        self.assertEqual(other_cache.convert(media, "png").data, png.data)
+        self.assertEqual(sorted(os.listdir(self.media_cache.conversion_directory)), conversions)
+
+        self.assertIsNone(self.media_cache.convert(self.media_cache.get_media(b"not an image", '', None), "png"))
+
+    def test_conversions_kept_when_cache_never_expires(self):
+
+        media = self.media_cache.get_media(self.image_data, '', None)
+        self.media_cache.convert(media, "png")
+
+        conversions = os.listdir(self.media_cache.conversion_directory)
+
+        for filename in conversions:
+            os.utime(os.path.join(self.media_cache.conversion_directory, filename), (0, 0))
+
+        for expire_after in [ -1, None ]:
+
+            other_cache = MediaCache(cache_directory=self.cache_directory, session=self.session, expire_after=expire_after)
+            other_cache.prune_conversions()
+
+            self.assertEqual(os.listdir(self.media_cache.conversion_directory), conversions,
+                "conversions were removed from a cache that never expires, expire_after={}".format(expire_after))
+
+        other_cache = MediaCache(cache_directory=self.cache_directory, session=self.session, expire_after=60)
+        other_cache.prune_conversions()
+
+        self.assertEqual(os.listdir(self.media_cache.conversion_directory), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
 import unittest
 import os
 import pprint
+import json
 
-from raintale.surrogatedata import MementoData
+import requests
+import requests_mock
+
+from raintale.surrogatedata import MementoData, get_template_surrogate_fields, get_sanitized_template
 
 testdir = os.path.dirname(os.path.realpath(__file__))
 
@@ -156,6 +160,84 @@ class TestMementoData(unittest.TestCase):
                     )
                 )
 
+    def test_iter_memento_data_in_story_order(self):
+
+        mementoembed_api = "mock://127.0.0.1:9899/shouldnotwork" # should go nowhere
+
+        urims = [ "http://archive.example/2010042413000{}/https://example.com/{}".format(i, i) for i in range(6) ]
+
+        adapter = requests_mock.Adapter()
+        session = requests.Session()
+        session.mount('mock', adapter)
+
+        for urim in urims[:-1]:
+            adapter.register_uri('GET', "{}/services/memento/contentdata/{}".format(mementoembed_api, urim),
+                text=json.dumps({ "title": "Title of {}".format(urim) }))
+
+        # the last memento is missing from MementoEmbed
+        adapter.register_uri('GET', "{}/services/memento/contentdata/{}".format(mementoembed_api, urims[-1]),
+            status_code=500)
+
+        md = MementoData("{{ element.surrogate.title }}", mementoembed_api)
+
+        results = list(md.iter_memento_data(urims, session=session))
+
+        self.assertEqual([ urim for urim, memento_data in results ], urims)
+
+        for urim, memento_data in results[:-1]:
+            self.assertEqual(memento_data["title"], "Title of {}".format(urim))
+
+        self.assertIsNone(results[-1][1])
+
+    def test_template_surrogate_fields(self):
+
+        template_str = """{% for element in elements %}
+{% if element.surrogate.thumbnail %}<img src="{{element.surrogate.thumbnail | prefer thumbnail_width = 208}}">{% endif %}
+{% for word in element.surrogate.snippet.split() %}{{ word }}{% endfor %}
+<a href="{{ element['surrogate']['urim'] }}">{{ element.surrogate.title|default(element.surrogate.original_uri) }}</a>
+{% if false %}{{ element.surrogate.imagereel }}{% elif true %}{{ element.surrogate.archive_name }}{% else %}{{ element.surrogate.sentence }}{% endif %}
+{{ element.surrogate.memento_datetime.strftime('%Y') if 0 else element.surrogate.first_memento_datetime }}
+{% if element.surrogate.collection_name is defined %}{{ element.surrogate.collection_name }}{% endif %}
+{% endfor %}"""
+
+        with self.assertLogs('raintale.surrogatedata', level='WARNING') as logs:
+            fields = get_template_surrogate_fields(template_str)
+
+        self.assertEqual(set(fields), set([
+            "{{ element.surrogate.thumbnail }}",
+            "{{ element.surrogate.thumbnail|prefer thumbnail_width=208 }}",
+            "{{ element.surrogate.snippet }}",
+            "{{ element.surrogate.urim }}",
+            "{{ element.surrogate.title }}",
+            "{{ element.surrogate.original_uri }}",
+            "{{ element.surrogate.archive_name }}",
+            "{{ element.surrogate.first_memento_datetime }}"
+        ]))
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("collection_name", logs.output[0])
+
+        self.assertIn('<img src="{{element.surrogate.thumbnail__prefer__thumbnail_width_208}}">',
+            get_sanitized_template(template_str))
+
+    def test_unused_endpoints_are_not_requested(self):
+
+        urim = "http://archive.example/20100424130000/https://example.com"
+        mementoembed_api = "mock://127.0.0.1:9899/shouldnotwork" # should go nowhere
+
+        adapter = requests_mock.Adapter()
+        session = requests.Session()
+        session.mount('mock', adapter)
+
+        adapter.register_uri('GET', "{}/services/memento/contentdata/{}".format(mementoembed_api, urim),
+            text=json.dumps({ "title": "Title of memento #1" }))
+
+        md = MementoData("{% if element.surrogate.title %}{{ element.surrogate.title }}{% endif %}"
+            "{% if false %}{{ element.surrogate.imagereel }}{% endif %}", mementoembed_api)
+
+        self.assertEqual(md.get_memento_data(urim, session=session)["title"], "Title of memento #1")
+        self.assertEqual([ request.url for request in adapter.request_history ],
+            [ "{}/services/memento/contentdata/{}".format(mementoembed_api, urim) ])
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import os
+import json
+import time
+import tempfile
+
+import requests
+import requests_mock
+
+from raintale.mementoembed import discover_mementoembed_api, probe_candidates, endpoint_cache_filename
+
+candidates = [
+    "mock://localhost:5550",
+    "mock://mementoembed:5550",
+    "mock://localhost:5000"
+]
+
+def make_session(live_candidates, slow_candidates={}):
+
+    adapter = requests_mock.Adapter()
+    session = requests.Session()
+    session.mount('mock', adapter)
+
+    for url in candidates:
+
+        if url in slow_candidates:
+
+            def answer_slowly(request, context, delay=slow_candidates[url]):
+                time.sleep(delay)
+                return "MementoEmbed"
+
+            adapter.register_uri('GET', url, text=answer_slowly)
+
+        elif url in live_candidates:
+            adapter.register_uri('GET', url, text="MementoEmbed")
+
+        else:
+            adapter.register_uri('GET', url, exc=requests.exceptions.ConnectionError)
+
+    return session, adapter
+
+class TestDiscoverMementoEmbed(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.cache_directory.cleanup()
+
+    def test_first_healthy_candidate_in_order(self):
+
+        session, adapter = make_session(live_candidates=[ candidates[1], candidates[2] ])
+
+        self.assertEqual(probe_candidates(candidates, timeout=1, session=session), candidates[1])
+
+    def test_unanswered_candidates_do_not_hold_up_discovery(self):
+
+        session, adapter = make_session(live_candidates=[ candidates[2] ], slow_candidates={ candidates[0]: 5 })
+
+        start = time.monotonic()
+        self.assertEqual(probe_candidates(candidates, timeout=0.5, session=session), candidates[2])
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_no_healthy_candidate(self):
+
+        session, adapter = make_session(live_candidates=[])
+
+        self.assertIsNone(discover_mementoembed_api(candidates, cache_directory=self.cache_directory.name,
+            timeout=0.5, attempts=1, session=session))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_directory.name, endpoint_cache_filename)))
+
+    def test_recent_discovery_is_reused(self):
+
+        session, adapter = make_session(live_candidates=[ candidates[2] ])
+
+        self.assertEqual(discover_mementoembed_api(candidates, cache_directory=self.cache_directory.name,
+            timeout=1, session=session), candidates[2])
+
+        probes = adapter.call_count
+
+        self.assertEqual(discover_mementoembed_api(candidates, cache_directory=self.cache_directory.name,
+            timeout=1, session=session), candidates[2])
+        self.assertEqual(adapter.call_count, probes, "a recent discovery was not reused")
+
+        # other candidates are probed again
+        self.assertEqual(discover_mementoembed_api(candidates[1:], cache_directory=self.cache_directory.name,
+            timeout=1, session=session), candidates[2])
+        self.assertGreater(adapter.call_count, probes)
+
+    def test_expired_discovery_is_probed_again(self):
+
+        session, adapter = make_session(live_candidates=[ candidates[0] ])
+
+        with open(os.path.join(self.cache_directory.name, endpoint_cache_filename), 'w') as f:
+            json.dump({ "candidates": candidates, "endpoint": candidates[2], "expires": time.time() - 1 }, f)
+
+        self.assertEqual(discover_mementoembed_api(candidates, cache_directory=self.cache_directory.name,
+            timeout=1, session=session), candidates[0])
+
+if __name__ == '__main__':
+    unittest.main()
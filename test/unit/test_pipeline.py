@@ -0,0 +1,209 @@
+import unittest
+import os
+import tempfile
+import shutil
+import threading
+import time
+
+from raintale.storytellers.poststream import PostStream, get_posts
+
+from .standin_apis import FakeClock, StandInTwitterApi, StandInGraphAPI, write_twitter_credentials, \
+    write_facebook_credentials, make_standin_twitter_storyteller, make_standin_facebook_storyteller
+
+story_template = """{# RAINTALE MULTIPART TEMPLATE #}
+{# RAINTALE TITLE PART #}
+{{ title }}
+{# RAINTALE ELEMENT PART #}
+{{ element.surrogate.title }}
+"""
+
+story_data = {
+    "title": "My Story Title",
+    "generated_by": None,
+    "collection_url": None,
+    "metadata": {},
+    "elements": []
+}
+
+def wait_until(condition, timeout=5):
+
+    deadline = time.time() + timeout
+
+    while not condition():
+
+        if time.time() > deadline:
+            raise AssertionError("timed out waiting for the publisher")
+
+        time.sleep(0.01)
+
+class TestPostStream(unittest.TestCase):
+
+    def test_reader_waits_for_posts(self):
+
+        comment_posts = PostStream()
+
+        def generate():
+            for i in range(5):
+                time.sleep(0.01)
+                comment_posts.append({ "text": "story element #{}".format(i) })
+            comment_posts.close()
+
+        threading.Thread(target=generate).start()
+
+        self.assertEqual([ p["text"] for p in comment_posts ], [ "story element #{}".format(i) for i in range(5) ])
+        self.assertEqual(comment_posts.get_count(), 5)
+        self.assertEqual(get_posts(comment_posts, 5, 10), [])
+
+    def test_error_raised_after_generated_posts(self):
+
+        comment_posts = PostStream()
+        comment_posts.append({ "text": "story element #0" })
+        comment_posts.close(error=ValueError("MementoEmbed went away"))
+
+        self.assertEqual(len(get_posts(comment_posts, 0, 10)), 1)
+
+        with self.assertRaises(ValueError):
+            get_posts(comment_posts, 1, 10)
+
+class TestPipelinedPublish(unittest.TestCase):
+
+    def setUp(self):
+
+        self.working_directory = tempfile.mkdtemp(prefix="raintale-test-")
+        self.journal_filename = os.path.join(self.working_directory, "journal.jsonl")
+
+        self.twitter_credentials_filename = os.path.join(self.working_directory, "credentials.yaml")
+        write_twitter_credentials(self.twitter_credentials_filename)
+
+        self.facebook_credentials_filename = os.path.join(self.working_directory, "fbcredentials.yaml")
+        write_facebook_credentials(self.facebook_credentials_filename)
+
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.working_directory)
+
+    def test_publishing_overlaps_generating(self):
+
+        api = StandInTwitterApi(self.clock)
+        tst = make_standin_twitter_storyteller(self.twitter_credentials_filename, self.clock, api,
+            pipelined=True, cache_directory=self.working_directory)
+
+        slow_surrogate = threading.Event()
+
+        def iter_comment_posts(*args, **kwargs):
+            yield { "text": "story element #1", "media": [] }
+            slow_surrogate.wait(5)
+            yield { "text": "story element #2", "media": [] }
+
+        tst.iter_comment_posts = iter_comment_posts
+
+        publisher = threading.Thread(target=tst.tell_story, args=(story_data, None, story_template))
+        publisher.start()
+
+        try:
+            # the title and the first element are published while the second is still being fetched
+            wait_until(lambda: len(api.statuses) == 2)
+            self.assertEqual([ s.text for s in api.statuses ], [ "My Story Title", "story element #1" ])
+        finally:
+            slow_surrogate.set()
+            publisher.join(5)
+
+        self.assertEqual([ s.text for s in api.statuses ], [ "My Story Title", "story element #1", "story element #2" ])
+        self.assertEqual(api.statuses[2].in_reply_to_status_id, api.statuses[1].id)
+
+    def test_resume_after_interrupted_generation(self):
+
+        api = StandInTwitterApi(self.clock)
+        tst = make_standin_twitter_storyteller(self.twitter_credentials_filename, self.clock, api,
+            pipelined=True, journal_filename=self.journal_filename, cache_directory=self.working_directory)
+
+        def failing_comment_posts(*args, **kwargs):
+            yield { "text": "story element #1", "media": [] }
+            yield { "text": "story element #2", "media": [] }
+            raise ConnectionError("MementoEmbed went away")
+
+        tst.iter_comment_posts = failing_comment_posts
+
+        with self.assertRaises(ConnectionError):
+            tst.tell_story(story_data, None, story_template)
+
+        self.assertEqual(len(api.statuses), 3)
+
+        tst = make_standin_twitter_storyteller(self.twitter_credentials_filename, self.clock, api,
+            pipelined=True, journal_filename=self.journal_filename, resume=True, cache_directory=self.working_directory)
+
+        self.assertFalse(tst.journal.is_generated())
+
+        def all_comment_posts(*args, **kwargs):
+            for i in range(1, 5):
+                yield { "text": "story element #{}".format(i), "media": [] }
+
+        tst.iter_comment_posts = all_comment_posts
+
+        location = tst.tell_story(story_data, None, story_template)
+
+        self.assertEqual([ s.text for s in api.statuses ],
+            [ "My Story Title" ] + [ "story element #{}".format(i) for i in range(1, 5) ],
+            "published elements were posted again")
+        self.assertEqual(api.statuses[3].in_reply_to_status_id, api.statuses[2].id)
+        self.assertEqual(location, "https://twitter.com/raintaletest/status/{}".format(api.statuses[0].id))
+        self.assertTrue(tst.journal.is_generated())
+        self.assertTrue(tst.journal.is_complete())
+
+    def test_resume_without_pipelining(self):
+
+        api = StandInTwitterApi(self.clock)
+        tst = make_standin_twitter_storyteller(self.twitter_credentials_filename, self.clock, api,
+            pipelined=True, journal_filename=self.journal_filename, cache_directory=self.working_directory)
+
+        def failing_comment_posts(*args, **kwargs):
+            yield { "text": "story element #1", "media": [] }
+            raise ConnectionError("MementoEmbed went away")
+
+        tst.iter_comment_posts = failing_comment_posts
+
+        with self.assertRaises(ConnectionError):
+            tst.tell_story(story_data, None, story_template)
+
+        self.assertEqual(len(api.statuses), 2)
+
+        tst = make_standin_twitter_storyteller(self.twitter_credentials_filename, self.clock, api,
+            journal_filename=self.journal_filename, resume=True, cache_directory=self.working_directory)
+
+        def all_comment_posts(*args, **kwargs):
+            for i in range(1, 5):
+                yield { "text": "story element #{}".format(i), "media": [] }
+
+        tst.iter_comment_posts = all_comment_posts
+
+        tst.tell_story(story_data, None, story_template)
+
+        self.assertEqual([ s.text for s in api.statuses ],
+            [ "My Story Title" ] + [ "story element #{}".format(i) for i in range(1, 5) ],
+            "published posts were posted again")
+        self.assertEqual(api.statuses[2].in_reply_to_status_id, api.statuses[1].id)
+        self.assertTrue(tst.journal.is_generated())
+        self.assertTrue(tst.journal.is_complete())
+
+    def test_facebook_batches_generated_elements(self):
+
+        graph = StandInGraphAPI(self.clock, limit=500)
+        fst = make_standin_facebook_storyteller(self.facebook_credentials_filename, self.clock, graph, pipelined=True)
+
+        def iter_comment_posts(*args, **kwargs):
+            for i in range(1, 61):
+                yield { "text": "story element #{}".format(i), "media": [] }
+
+        fst.iter_comment_posts = iter_comment_posts
+
+        fst.tell_story(story_data, None, story_template)
+
+        comments = [ o for o in graph.objects if o["connection_name"] == "comments" ]
+
+        self.assertEqual([ c["data"]["message"] for c in comments ],
+            [ "story element #{}".format(i) for i in range(1, 61) ],
+            "comments were not published in story order")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import os
+import json
+import tempfile
+
+import requests_mock
+
+from raintale.httpcache import get_surrogate_session
+from raintale.prefetch import get_surrogate_requests, prefetch_surrogates
+from raintale.storydata import complete_story_data
+from raintale.storytellers.filetemplate import FileTemplateStoryTeller
+
+from .test_surrogatedataset import mementoembed_api, urim1, urim2
+
+urim3 = "http://archive.example/20200101000000/https://example3.com"
+
+story_template = "{% for element in elements %}{% if element.type == 'link' %}" \
+    "<element>{{ element.surrogate.title }} " \
+    "{{ element.surrogate.thumbnail|prefer thumbnail_width=208 }} " \
+    "{{ element.surrogate.thumbnail|prefer thumbnail_width=1024 }}</element>\n" \
+    "{% endif %}{% endfor %}"
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        self.adapter = requests_mock.Adapter()
+        self.session = get_surrogate_session(cache_directory=self.tmpdir.name)
+        self.session.mount('mock', self.adapter)
+
+        for counter, urim in enumerate([ urim1, urim2 ], start=1):
+
+            self.adapter.register_uri(
+                'GET', "{}/services/memento/contentdata/{}".format(mementoembed_api, urim),
+                text=json.dumps({ "urim": urim, "title": "Title of memento #{}".format(counter) })
+            )
+
+            for width in [ 208, 1024 ]:
+                self.adapter.register_uri(
+                    'GET', "{}/services/product/thumbnail/{}".format(mementoembed_api, urim),
+                    request_headers={ "Prefer": "thumbnail_width={}".format(width) },
+                    content="thumbnail of memento #{} at {} pixels".format(counter, width).encode('utf-8')
+                )
+
+        self.adapter.register_uri('GET', "{}/services/memento/contentdata/{}".format(mementoembed_api, urim3),
+            status_code=500)
+        self.adapter.register_uri('GET', "{}/services/product/thumbnail/{}".format(mementoembed_api, urim3),
+            status_code=500)
+
+    def tearDown(self):
+        self.session.close()
+        self.tmpdir.cleanup()
+
+    def test_surrogate_requests(self):
+
+        surrogate_requests = get_surrogate_requests([ urim1, urim2 ], [ story_template, story_template ], mementoembed_api)
+
+        self.assertEqual(len(surrogate_requests), 6)
+        self.assertIn(
+            ("{}/services/product/thumbnail/{}".format(mementoembed_api, urim2), ("thumbnail_width=1024",)),
+            surrogate_requests
+        )
+
+    def test_prefetched_story_is_told_from_cache(self):
+
+        surrogate_requests = get_surrogate_requests([ urim1, urim2, urim3 ], [ story_template ], mementoembed_api)
+
+        report = prefetch_surrogates(surrogate_requests, self.session, max_workers=4, requests_per_second=1000)
+
+        self.assertEqual(report["fetched"], 6)
+        self.assertEqual(report["cached"], 0)
+        self.assertEqual(len(report["failed"]), 3, "failed responses were not reported")
+
+        requests_made = self.adapter.call_count
+
+        report = prefetch_surrogates(surrogate_requests, self.session)
+
+        self.assertEqual(report["cached"], 6)
+        self.assertEqual(self.adapter.call_count, requests_made + 3, "cached surrogates were fetched again")
+
+        requests_made = self.adapter.call_count
+
+        output_filename = os.path.join(self.tmpdir.name, "story.html")
+
+        storyteller = FileTemplateStoryTeller(output_filename)
+        storyteller.mementoembed_session = self.session
+
+        storyteller.tell_story(complete_story_data({
+            "title": "A prefetched story",
+            "elements": [ { "type": "link", "value": urim1 }, { "type": "link", "value": urim2 } ]
+        }), mementoembed_api, story_template)
+
+        self.assertEqual(self.adapter.call_count, requests_made, "the story was not told from the cache")
+
+        with open(output_filename) as f:
+            story = f.read()
+
+        # each preference was cached separately
+        thumbnails = [ word for word in story.split() if word.startswith("data:image/png;base64,") ]
+        self.assertEqual(len(set(thumbnails)), 4)
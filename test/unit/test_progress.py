@@ -0,0 +1,95 @@
+import unittest
+import io
+import json
+
+from raintale.progress import FetchProgress, JSONProgressReporter, TerminalProgressReporter, make_fetch_progress
+from raintale.surrogatedataset import fetch_surrogate_dataset
+
+from .test_surrogatedataset import make_story_data, make_mementoembed_session, mementoembed_api, story_template
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+class TestFetchProgress(unittest.TestCase):
+
+    def test_rate_eta_and_stall(self):
+
+        clock = FakeClock()
+        events = []
+
+        progress = FetchProgress(reporters=[ events.append ], rate_window=10, stall_after=15, clock=clock)
+
+        for i in range(0, 10):
+            progress.add_requests(1, endpoint="http://mementoembed.example/services/memento/contentdata/{}".format(i))
+
+        for i in range(0, 4):
+            clock.now += 1
+            progress.record_completion(endpoint="http://mementoembed.example/services/memento/contentdata/{}".format(i),
+                byte_count=100)
+
+        progress.report()
+
+        self.assertEqual(events[-1]["completed"], 4)
+        self.assertEqual(events[-1]["total"], 10)
+        self.assertEqual(events[-1]["bytes"], 400)
+        self.assertEqual(events[-1]["requests_per_second"], 1.0)
+        self.assertEqual(events[-1]["eta_seconds"], 6.0)
+        self.assertFalse(events[-1]["stalled"])
+
+        clock.now += 20
+
+        with self.assertLogs('raintale.progress', level='WARNING') as logs:
+            progress.report()
+
+        self.assertTrue(events[-1]["stalled"])
+        self.assertEqual(events[-1]["stalled_seconds"], 20)
+        self.assertEqual(events[-1]["waiting_on"], [ "mementoembed.example" ])
+        self.assertIsNone(events[-1]["eta_seconds"], "an ETA was given although nothing completed recently")
+        self.assertIn("mementoembed.example", logs.output[0])
+
+    def test_json_reporter(self):
+
+        stream = io.StringIO()
+
+        progress = FetchProgress(reporters=[ JSONProgressReporter(stream) ], clock=FakeClock())
+        progress.add_requests(2)
+        progress.record_completion(byte_count=10)
+        progress.record_completion(failed=True)
+
+        progress.stop()
+
+        events = [ json.loads(line) for line in stream.getvalue().splitlines() ]
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["event"], "progress")
+        self.assertEqual(events[0]["completed"], 2)
+        self.assertEqual(events[0]["failed"], 1)
+        self.assertTrue(events[0]["final"])
+
+    def test_auto_mode_is_quiet_off_a_terminal(self):
+
+        self.assertEqual(make_fetch_progress("auto", stream=io.StringIO()).reporters, [])
+        self.assertIsInstance(make_fetch_progress("terminal", stream=io.StringIO()).reporters[0], TerminalProgressReporter)
+
+    def test_fetch_counts_mementoembed_requests(self):
+
+        session, adapter = make_mementoembed_session()
+        events = []
+
+        progress = FetchProgress(reporters=[ events.append ])
+
+        fetch_surrogate_dataset(make_story_data(), [ story_template ], mementoembed_api, session=session,
+            progress=progress)
+
+        progress.stop()
+
+        self.assertEqual(events[-1]["total"], adapter.call_count)
+        self.assertEqual(events[-1]["completed"], adapter.call_count)
+        self.assertEqual(events[-1]["failed"], 0)
+        self.assertGreater(events[-1]["bytes"], 0)
+        self.assertEqual(events[-1]["waiting_on"], [])
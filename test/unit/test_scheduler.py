@@ -0,0 +1,152 @@
+import unittest
+
+import twitter
+
+from raintale.storytellers.scheduler import PublishScheduler, PublishSchedulerRateLimitError
+from raintale.storytellers.twitter import is_twitter_rate_limit_error
+
+from .standin_apis import FakeClock, FakeResponse, StandInTwitterApi, StandInGraphAPI, make_story_output_data, \
+    write_twitter_credentials, write_facebook_credentials, make_standin_twitter_storyteller, \
+    make_standin_facebook_storyteller
+
+class TestPublishScheduler(unittest.TestCase):
+
+    def test_bucket_allows_burst_then_paces(self):
+
+        clock = FakeClock()
+        scheduler = PublishScheduler(5, 10, clock=clock.time, sleep=clock.sleep)
+
+        for i in range(0, 5):
+            scheduler.wait()
+
+        self.assertEqual(clock.slept, 0, "scheduler slept during the allowed burst")
+
+        scheduler.wait()
+
+        self.assertAlmostEqual(clock.slept, 2, places=5)
+
+    def test_batch_requests_cost_their_size(self):
+
+        clock = FakeClock()
+        scheduler = PublishScheduler(5, 10, clock=clock.time, sleep=clock.sleep)
+
+        scheduler.wait(cost=3)
+        scheduler.wait(cost=2)
+
+        self.assertEqual(clock.slept, 0, "scheduler slept during the allowed burst")
+
+        scheduler.wait(cost=2)
+
+        self.assertAlmostEqual(clock.slept, 4, places=5)
+
+        # a batch larger than the bucket waits for a full bucket and leaves it in debt
+        scheduler.wait(cost=10)
+
+        self.assertAlmostEqual(clock.slept, 14, places=5)
+
+        scheduler.wait()
+
+        self.assertAlmostEqual(clock.slept, 26, places=5)
+
+    def test_headers_pause_until_reset(self):
+
+        clock = FakeClock()
+        scheduler = PublishScheduler(300, 3 * 60 * 60, clock=clock.time, sleep=clock.sleep)
+
+        scheduler.update_from_headers(FakeResponse({
+            "x-rate-limit-remaining": "0",
+            "x-rate-limit-reset": str(int(clock.time() + 120))
+        }).headers)
+
+        scheduler.wait()
+
+        self.assertAlmostEqual(clock.slept, 120, places=5)
+
+    def test_facebook_usage_headers(self):
+
+        clock = FakeClock()
+        scheduler = PublishScheduler(50, 60, clock=clock.time, sleep=clock.sleep)
+
+        scheduler.update_from_headers(FakeResponse({
+            "x-business-use-case-usage": '{"1234": [{"type": "pages", "call_count": 100, "total_cputime": 5, '
+                '"total_time": 5, "estimated_time_to_regain_access": 3}]}'
+        }).headers)
+
+        scheduler.wait()
+
+        self.assertAlmostEqual(clock.slept, 180, places=5)
+
+    def test_retries_rate_limit_errors(self):
+
+        clock = FakeClock()
+        scheduler = PublishScheduler(100, 1, is_rate_limit_error=is_twitter_rate_limit_error,
+            max_retries=3, clock=clock.time, sleep=clock.sleep)
+
+        failures = [ True, True ]
+
+        def post():
+            if len(failures) > 0:
+                failures.pop()
+                raise twitter.error.TwitterError([ { "code": 88, "message": "Rate limit exceeded" } ])
+            return "posted"
+
+        self.assertEqual(scheduler.call(post), "posted")
+        self.assertGreater(clock.slept, 0, "scheduler did not back off")
+
+        def always_limited():
+            raise twitter.error.TwitterError([ { "code": 88, "message": "Rate limit exceeded" } ])
+
+        with self.assertRaises(PublishSchedulerRateLimitError):
+            scheduler.call(always_limited)
+
+        def other_error():
+            raise twitter.error.TwitterError([ { "code": 187, "message": "Status is a duplicate." } ])
+
+        with self.assertRaises(twitter.error.TwitterError):
+            scheduler.call(other_error)
+
+class TestServicePublishing(unittest.TestCase):
+
+    def test_twitter_thread_resumes_after_rate_limit(self):
+
+        credentials_filename = "/tmp/credentials.yaml"
+        write_twitter_credentials(credentials_filename)
+
+        clock = FakeClock()
+
+        tst = make_standin_twitter_storyteller(credentials_filename, clock,
+            StandInTwitterApi(clock, limit=8, window=15 * 60))
+
+        output = tst.publish_story(make_story_output_data(20))
+
+        statuses = tst.api.statuses
+
+        self.assertEqual(len(statuses), 21, "not every story element was published")
+        self.assertEqual(output, "https://twitter.com/raintaletest/status/{}".format(statuses[0].id))
+
+        for i in range(1, len(statuses)):
+            self.assertEqual(statuses[i].text, "story element #{}".format(i))
+            self.assertEqual(statuses[i].in_reply_to_status_id, statuses[i - 1].id,
+                "thread tweets are not chained in order")
+
+        # 21 tweets at 8 per 15 minutes need two waits for the window to reset
+        self.assertLessEqual(clock.slept, 2 * 15 * 60 + 1)
+
+    def test_facebook_thread_resumes_after_rate_limit(self):
+
+        credentials_filename = "/tmp/fbcredentials.yaml"
+        write_facebook_credentials(credentials_filename)
+
+        clock = FakeClock()
+
+        fst = make_standin_facebook_storyteller(credentials_filename, clock,
+            StandInGraphAPI(clock, limit=10, window=60), scheduler_options={ "initial_backoff": 5 })
+
+        fst.publish_story(make_story_output_data(30))
+
+        comments = [ o for o in fst.graph.objects if o["connection_name"] == "comments" ]
+
+        self.assertEqual(len(comments), 30, "not every story element was published")
+
+        for i in range(0, len(comments)):
+            self.assertEqual(comments[i]["data"]["message"], "story element #{}".format(i + 1))
@@ -0,0 +1,154 @@
+import unittest
+import json
+import time
+import threading
+
+import requests
+
+from raintale.server import StoryService, StoryServer
+
+from .test_surrogatedataset import make_mementoembed_session, mementoembed_api, urim1, urim2
+
+story_template = "<title>{{ title }}</title>\n" \
+    "{% for element in elements %}{% if element.type == 'link' %}<element>{{ element.surrogate.title }}</element>\n" \
+    "{% endif %}{% endfor %}"
+
+class TestStoryServer(unittest.TestCase):
+
+    def setUp(self):
+
+        self.mementoembed_session, self.adapter = make_mementoembed_session()
+
+        self.service = StoryService(mementoembed_api, max_jobs=2, session=self.mementoembed_session)
+        self.server = StoryServer(("127.0.0.1", 0), self.service)
+
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+
+        self.base_uri = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.shutdown()
+
+    def submit(self, job_request):
+        return requests.post("{}/jobs".format(self.base_uri), data=json.dumps(job_request))
+
+    def wait_for_job(self, job_uri, timeout=5):
+
+        deadline = time.time() + timeout
+
+        while True:
+
+            job = requests.get(job_uri).json()
+
+            if job["status"] in ("succeeded", "failed"):
+                return job
+
+            if time.time() > deadline:
+                raise AssertionError("timed out waiting for job {}".format(job["id"]))
+
+            time.sleep(0.02)
+
+    def test_tell_stories_from_warm_cache(self):
+
+        job_request = {
+            "storyteller": "template",
+            "template": story_template,
+            "story": {
+                "title": "A story from the service",
+                "elements": [
+                    { "type": "link", "value": urim1 },
+                    { "type": "text", "value": "Some text between the links" },
+                    { "type": "link", "value": urim2 }
+                ]
+            }
+        }
+
+        r = self.submit(job_request)
+
+        self.assertEqual(r.status_code, 202)
+        job_uri = "{}{}".format(self.base_uri, r.headers["Location"])
+
+        # the output waits for the story to be written
+        r = requests.get("{}/output".format(job_uri))
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.text,
+            "<title>A story from the service</title>\n"
+            "<element>Title of memento #1</element>\n"
+            "<element>Title of memento #2</element>\n")
+
+        self.assertEqual(self.wait_for_job(job_uri)["status"], "succeeded")
+
+        requests_made = self.adapter.call_count
+
+        job_request["story"]["title"] = "The same mementos again"
+        job_request["story"]["elements"].pop(0)
+
+        r = self.submit(job_request)
+        r = requests.get("{}{}/output".format(self.base_uri, r.headers["Location"]))
+
+        self.assertEqual(r.text, "<title>The same mementos again</title>\n<element>Title of memento #2</element>\n")
+        self.assertEqual(self.adapter.call_count, requests_made, "cached surrogates were fetched again")
+
+        jobs = requests.get("{}/jobs".format(self.base_uri)).json()["jobs"]
+        self.assertEqual(len(jobs), 2)
+
+        r = requests.delete(job_uri)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(requests.get(job_uri).status_code, 404)
+
+    def test_story_from_urims(self):
+
+        r = self.submit({
+            "storyteller": "template",
+            "template": story_template,
+            "title": "A list of mementos",
+            "urims": [ urim2, "ftp://example.com/not-a-memento" ]
+        })
+
+        r = requests.get("{}{}/output".format(self.base_uri, r.headers["Location"]))
+
+        self.assertEqual(r.text, "<title>A list of mementos</title>\n<element>Title of memento #2</element>\n")
+
+    def test_invalid_jobs(self):
+
+        for job_request in [
+            { "storyteller": "twitter", "urims": [ urim1 ], "title": "A thread" },
+            { "storyteller": "no-such-storyteller", "urims": [ urim1 ], "title": "A story" },
+            { "storyteller": "html", "preset": "no-such-preset", "urims": [ urim1 ], "title": "A story" },
+            { "storyteller": "html", "urims": [ urim1 ] },
+            { "storyteller": "html", "story": { "elements": [] } },
+            [ urim1 ]
+        ]:
+            r = self.submit(job_request)
+            self.assertEqual(r.status_code, 400, "job request {} was accepted".format(job_request))
+            self.assertIn("error", r.json())
+
+        r = requests.post("{}/jobs".format(self.base_uri), data="{ not json")
+        self.assertEqual(r.status_code, 400)
+
+        self.assertEqual(requests.get("{}/jobs/no-such-job".format(self.base_uri)).status_code, 404)
+
+    def test_failed_job(self):
+
+        r = self.submit({
+            "storyteller": "template",
+            "template": "{{ element.surrogate.title",
+            "title": "A broken template",
+            "urims": [ urim1 ]
+        })
+
+        job_uri = "{}{}".format(self.base_uri, r.headers["Location"])
+
+        r = requests.get("{}/output".format(job_uri))
+        self.assertEqual(r.status_code, 500)
+
+        job = self.wait_for_job(job_uri)
+        self.assertEqual(job["status"], "failed")
+        self.assertIsNotNone(job["error"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+import io
+import os
+import json
+import tempfile
+
+from datetime import datetime
+
+from raintale.storydata import read_story_data, parse_story_input, StoryDataError
+from raintale.storytellers.filetemplate import FileTemplateStoryTeller
+
+from .test_surrogatedataset import make_mementoembed_session, mementoembed_api, urim1, urim2
+
+story_template = "<title>{{ title }}</title>\n" \
+    "{% for element in elements %}{% if element.type == 'link' %}<element>{{ element.surrogate.title }}</element>\n" \
+    "{% else %}<text>{{ element.text }}</text>\n{% endif %}{% endfor %}"
+
+generation_date = datetime(2020, 1, 2, 3, 4, 5)
+
+class TestStoryInput(unittest.TestCase):
+
+    def test_json_story(self):
+
+        f = io.StringIO(json.dumps({
+            "title": "A JSON story",
+            "elements": [ { "type": "link", "value": urim1 } ]
+        }, indent=4))
+
+        story_data = parse_story_input(f, generation_date=generation_date)
+
+        self.assertEqual(story_data["title"], "A JSON story")
+        self.assertEqual(story_data["elements"], [ { "type": "link", "value": urim1 } ])
+        self.assertEqual(story_data["generation_date"], generation_date)
+        self.assertIn("story image", story_data)
+
+    def test_json_lines_story(self):
+
+        f = io.StringIO("\n".join([
+            json.dumps({ "title": "A JSON Lines story", "generated_by": "raintale tests" }),
+            json.dumps({ "type": "link", "value": urim1 }),
+            "",
+            json.dumps({ "type": "text", "value": "Some text between the links" }),
+            json.dumps({ "type": "link", "value": urim2 })
+        ]))
+
+        story_data = parse_story_input(f, streamed=True)
+
+        self.assertEqual(story_data["title"], "A JSON Lines story")
+        self.assertEqual(story_data["generated_by"], "raintale tests")
+        self.assertEqual(story_data["metadata"], {})
+        self.assertNotIsInstance(story_data["elements"], list)
+
+        self.assertEqual([ e["value"] for e in story_data["elements"] ], [ urim1, "Some text between the links", urim2 ])
+
+    def test_json_lines_without_story_line(self):
+
+        f = io.StringIO("\n".join([
+            json.dumps({ "type": "link", "value": urim1 }),
+            json.dumps({ "type": "link", "value": urim2 })
+        ]))
+
+        self.assertRaises(StoryDataError, parse_story_input, io.StringIO(f.getvalue()))
+
+        story_data = parse_story_input(f, title="A titled story")
+
+        self.assertEqual(story_data["title"], "A titled story")
+        self.assertEqual(story_data["elements"], [ { "type": "link", "value": urim1 }, { "type": "link", "value": urim2 } ])
+
+    def test_broken_json_lines_are_reported_when_read(self):
+
+        f = io.StringIO("\n".join([
+            json.dumps({ "title": "A broken story" }),
+            json.dumps({ "type": "link", "value": urim1 }),
+            "{ not json"
+        ]))
+
+        story_data = parse_story_input(f, streamed=True)
+
+        self.assertEqual(next(story_data["elements"])["value"], urim1)
+
+        with self.assertRaises(StoryDataError) as cm:
+            next(story_data["elements"])
+
+        self.assertIn("line 3", cm.exception.message)
+
+    def test_memento_list(self):
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            input_filename = os.path.join(tmpdir, "story.txt")
+
+            with open(input_filename, 'w') as f:
+                f.write("{}\n\nftp://example.com/not-a-memento\n{}\n".format(urim1, urim2))
+
+            self.assertRaises(StoryDataError, read_story_data, input_filename)
+
+            story_data = read_story_data(input_filename, title="A list of mementos")
+            self.assertEqual([ e["value"] for e in story_data["elements"] ], [ urim1, urim2 ])
+
+            story_data = read_story_data(input_filename, title="A list of mementos", streamed=True)
+            self.assertEqual([ e["value"] for e in story_data["elements"] ], [ urim1, urim2 ])
+
+class TestStreamedStory(unittest.TestCase):
+
+    def test_story_written_while_input_is_read(self):
+
+        session, adapter = make_mementoembed_session()
+
+        element_count = 1000
+        elements_read = []
+
+        def iter_elements():
+            for i in range(element_count):
+                elements_read.append(i)
+                yield { "type": "link", "value": urim1 if i % 2 == 0 else urim2 }
+
+        story_data = {
+            "title": "A long story",
+            "generated_by": None,
+            "collection_url": None,
+            "story image": None,
+            "generation_date": generation_date,
+            "elements": iter_elements()
+        }
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            storyteller = FileTemplateStoryTeller(os.path.join(tmpdir, "story.html"), streamed=True)
+
+            story = storyteller.generate_story(story_data, mementoembed_api, story_template, session=session)
+
+            first_parts = ""
+
+            while "<element>" not in first_parts:
+                first_parts += next(story)
+
+            self.assertLess(len(elements_read), element_count, "the whole story was read before any of it was written")
+
+            rendered_story = first_parts + "".join(story)
+
+        self.assertEqual(len(elements_read), element_count)
+        self.assertTrue(rendered_story.startswith("<title>A long story</title>\n<element>Title of memento #1</element>\n"))
+        self.assertEqual(rendered_story.count("<element>Title of memento #2</element>"), element_count // 2)
+
+if __name__ == '__main__':
+    unittest.main()
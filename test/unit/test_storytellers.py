@@ -0,0 +1,66 @@
+import unittest
+import sys
+import subprocess
+
+from raintale.storytellers.storytellers import StorytellerRegistry, storytellers, builtin_storytellers, \
+    get_template_index
+from raintale.storytellers.filetemplate import FileTemplateStoryTeller
+
+class FakeEntryPoint:
+
+    def __init__(self, name, value, loaded):
+        self.name = name
+        self.value = value
+        self.loaded = loaded
+
+    def load(self):
+        return self.loaded
+
+class TestStorytellerRegistry(unittest.TestCase):
+
+    def test_descriptions_match_classes(self):
+
+        for name in builtin_storytellers:
+            self.assertEqual(storytellers.get_description(name), storytellers[name].description,
+                "the description of storyteller {} is out of date".format(name))
+
+    def test_lookup_is_lazy(self):
+
+        # a fresh interpreter, since other tests import the storytellers themselves
+        output = subprocess.check_output([ sys.executable, "-c",
+            "import sys\n"
+            "from raintale.storytellers.storytellers import storytellers\n"
+            "[ storytellers.get_description(name) for name in storytellers ]\n"
+            "before = 'raintale.storytellers.video' in sys.modules\n"
+            "storytellers['video']\n"
+            "print(before, 'raintale.storytellers.video' in sys.modules, 'twitter' in sys.modules)\n"
+        ]).decode('utf-8').split()
+
+        self.assertEqual(output, [ "False", "True", "False" ])
+
+    def test_entry_point_storytellers(self):
+
+        registry = StorytellerRegistry(builtin_storytellers)
+        registry._entry_points = {
+            "custom": FakeEntryPoint("custom", "example:CustomStoryTeller", FileTemplateStoryTeller)
+        }
+
+        self.assertIn("custom", registry)
+        self.assertIn("template", registry)
+        self.assertNotIn("blogger", registry)
+        self.assertIs(registry["custom"], FileTemplateStoryTeller)
+        self.assertEqual(list(registry), list(builtin_storytellers) + [ "custom" ])
+
+        with self.assertRaises(KeyError):
+            registry["blogger"]
+
+    def test_template_index(self):
+
+        template_storytellers, presets = get_template_index()
+
+        self.assertIn("html", template_storytellers)
+        self.assertIn("default", presets)
+        self.assertIs(get_template_index(), get_template_index())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import unittest
+import os
+import json
+import tempfile
+
+from datetime import datetime
+
+import requests
+import requests_mock
+
+from raintale.surrogatedataset import SurrogateDataset, SurrogateDatasetError, \
+    fetch_surrogate_dataset
+from raintale.storytellers.filetemplate import FileTemplateStoryTeller
+from raintale.storytellers.storyteller import tell_stories
+
+mementoembed_api = "mock://127.0.0.1:9899/shouldnotwork" # should go nowhere
+
+urim1 = "http://archive.example/20100424130000/https://example.com"
+urim2 = "http://archive.example/20150714130000/https://example2.com"
+
+story_template = """<title>{{ title }}</title>
+{% for element in elements %}{% if element.type == 'link' %}<element>{{ element.surrogate.title }} {{ element.surrogate.memento_datetime }}</element>
+{% else %}<text>{{ element.text }}</text>
+{% endif %}{% endfor %}"""
+
+def make_story_data():
+
+    return {
+        "title": "A story from a surrogate dataset",
+        "generated_by": "raintale tests",
+        "collection_url": None,
+        "story image": None,
+        "generation_date": datetime(2020, 1, 2, 3, 4, 5),
+        "metadata": {},
+        "elements": [
+            { "type": "link", "value": urim1 },
+            { "type": "text", "value": "Some text between the links" },
+            { "type": "link", "value": urim2 }
+        ]
+    }
+
+def make_mementoembed_session():
+
+    adapter = requests_mock.Adapter()
+    session = requests.Session()
+    session.mount('mock', adapter)
+
+    for counter, urim in enumerate([ urim1, urim2 ], start=1):
+        adapter.register_uri(
+            'GET', "{}/services/memento/contentdata/{}".format(mementoembed_api, urim),
+            text=json.dumps({
+                "urim": urim,
+                "title": "Title of memento #{}".format(counter),
+                "snippet": "Snippet of memento #{}".format(counter),
+                "memento-datetime": "2010-04-24T13:00:0{}Z".format(counter)
+            })
+        )
+
+    return session, adapter
+
+class TestSurrogateDataset(unittest.TestCase):
+
+    def test_write_and_load(self):
+
+        dataset = SurrogateDataset(story_data=make_story_data(), fields=[ "{{ element.surrogate.title }}" ])
+        dataset.add_memento_data(urim1, {
+            "urim": urim1,
+            "title": "Title of memento #1",
+            "memento_datetime": datetime(2010, 4, 24, 13, 0, 0)
+        })
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            for filename in [ "dataset.jsonl", "dataset.jsonl.gz" ]:
+
+                dataset_filename = "{}/{}".format(tmpdir, filename)
+                dataset.write(dataset_filename)
+
+                loaded = SurrogateDataset.load(dataset_filename)
+
+                self.assertEqual(loaded.story_data, dataset.story_data)
+                self.assertEqual(loaded.fields, dataset.fields)
+                self.assertEqual(loaded.urims, [ urim1 ])
+                self.assertEqual(loaded.get_memento_data(urim1)["memento_datetime"], datetime(2010, 4, 24, 13, 0, 0))
+
+                self.assertRaises(KeyError, loaded.get_memento_data, urim2)
+
+    def test_load_rejects_other_files(self):
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            filename = "{}/story.json".format(tmpdir)
+
+            with open(filename, 'w') as f:
+                json.dump(make_story_data()["elements"], f)
+
+            self.assertRaises(SurrogateDatasetError, SurrogateDataset.load, filename)
+
+    def test_fetch_and_render(self):
+
+        session, adapter = make_mementoembed_session()
+
+        dataset = fetch_surrogate_dataset(make_story_data(), [ story_template ], mementoembed_api, session=session)
+
+        self.assertEqual(sorted(dataset.urims), sorted([ urim1, urim2 ]))
+        self.assertEqual(dataset.get_missing_fields(story_template), set())
+        self.assertEqual(
+            dataset.get_missing_fields("{{ element.surrogate.snippet }}"),
+            set([ "{{ element.surrogate.snippet }}" ])
+        )
+
+        requests_made = adapter.call_count
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            dataset_filename = "{}/dataset.jsonl".format(tmpdir)
+            dataset.write(dataset_filename)
+            dataset = SurrogateDataset.load(dataset_filename)
+
+            output_filename = "{}/story.html".format(tmpdir)
+
+            storyteller = FileTemplateStoryTeller(output_filename)
+            storyteller.surrogate_dataset = dataset
+
+            # no MementoEmbed API is given, so the story can only come from the dataset
+            storyteller.tell_story(dataset.story_data, None, story_template)
+
+            with open(output_filename) as f:
+                rendered_story = f.read()
+
+        self.assertEqual(adapter.call_count, requests_made)
+
+        self.assertIn("<title>A story from a surrogate dataset</title>", rendered_story)
+        self.assertIn("<element>Title of memento #1 2010-04-24 13:00:01</element>", rendered_story)
+        self.assertIn("<element>Title of memento #2 2010-04-24 13:00:02</element>", rendered_story)
+        self.assertIn("<text>Some text between the links</text>", rendered_story)
+
+    def test_tell_stories(self):
+
+        session, adapter = make_mementoembed_session()
+
+        other_template = "{% for element in elements %}{% if element.type == 'link' %}{{ element.surrogate.title }}\n{% endif %}{% endfor %}"
+
+        dataset = fetch_surrogate_dataset(make_story_data(), [ story_template, other_template ], mementoembed_api, session=session)
+
+        requests_made = adapter.call_count
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            storytelling = []
+
+            for counter, template in enumerate([ story_template, other_template, "{{ element.surrogate.title" ]):
+
+                storyteller = FileTemplateStoryTeller("{}/story{}.txt".format(tmpdir, counter))
+                storyteller.surrogate_dataset = dataset
+                storytelling.append((storyteller, template))
+
+            locations = tell_stories(storytelling, dataset.story_data, None)
+
+            self.assertEqual(locations[0:2], [ "{}/story0.txt".format(tmpdir), "{}/story1.txt".format(tmpdir) ])
+            self.assertIsNone(locations[2], "the storyteller with a broken template should fail alone")
+
+            with open(locations[1]) as f:
+                self.assertEqual(f.read(), "Title of memento #1\nTitle of memento #2\n")
+
+        self.assertEqual(adapter.call_count, requests_made)
+
+if __name__ == '__main__':
+    unittest.main()
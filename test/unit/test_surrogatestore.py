@@ -0,0 +1,97 @@
+import unittest
+import os
+import tempfile
+import functools
+
+from datetime import datetime
+
+from raintale.surrogatestore import SQLiteSurrogateStore, MemorySurrogateStore, open_surrogate_store
+from raintale.surrogatedataset import SurrogateDataset
+from raintale.storytellers.filetemplate import FileTemplateStoryTeller
+
+from .test_surrogatedataset import make_story_data, make_mementoembed_session, mementoembed_api, story_template, \
+    urim1, urim2
+
+thumbnail = "data:image/png;base64," + "A" * 10000
+
+class TestSQLiteSurrogateStore(unittest.TestCase):
+
+    def test_large_values_stay_on_disk(self):
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            store = SQLiteSurrogateStore(directory=tmpdir)
+
+            self.assertEqual(os.listdir(tmpdir), [], "the temporary database was left behind")
+
+            store.update(urim1, { "title": "Title of memento #1", "memento_datetime": datetime(2010, 4, 24, 13, 0, 1) })
+            store.update(urim1, { "thumbnail": thumbnail })
+            store.update(urim2, { "title": "Title of memento #2" })
+
+            self.assertIn(urim1, store)
+            self.assertNotIn("http://archive.example/nothing", store)
+            self.assertEqual(list(store), [ urim1, urim2 ])
+            self.assertEqual(len(store), 2)
+
+            memento_data = store.get(urim1)
+
+            self.assertEqual(memento_data._values, {
+                "title": "Title of memento #1",
+                "memento_datetime": datetime(2010, 4, 24, 13, 0, 1)
+            })
+            self.assertIn("thumbnail", memento_data)
+            self.assertEqual(memento_data["thumbnail"], thumbnail)
+            self.assertEqual(dict(memento_data)["thumbnail"], thumbnail)
+            self.assertNotIn(thumbnail, repr(memento_data))
+
+            self.assertRaises(KeyError, store.get, "http://archive.example/nothing")
+
+            store.close()
+
+    def test_open_surrogate_store(self):
+
+        self.assertIsInstance(open_surrogate_store("memory"), MemorySurrogateStore)
+        self.assertRaises(ValueError, open_surrogate_store, "floppy")
+
+class TestStoriesFromSQLiteStore(unittest.TestCase):
+
+    def test_story_is_told_from_disk(self):
+
+        session, adapter = make_mementoembed_session()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            rendered_stories = []
+
+            for store_factory in [ None, functools.partial(SQLiteSurrogateStore, directory=tmpdir, spill_size=1) ]:
+
+                output_filename = "{}/story.html".format(tmpdir)
+
+                storyteller = FileTemplateStoryTeller(output_filename)
+                storyteller.mementoembed_session = session
+                storyteller.surrogate_store_factory = store_factory
+
+                storyteller.tell_story(make_story_data(), mementoembed_api, story_template)
+
+                with open(output_filename) as f:
+                    rendered_stories.append(f.read())
+
+        self.assertIn("<element>Title of memento #1 2010-04-24 13:00:01</element>", rendered_stories[0])
+        self.assertEqual(rendered_stories[1], rendered_stories[0])
+
+    def test_dataset_in_sqlite_store(self):
+
+        dataset = SurrogateDataset(story_data=make_story_data(), fields=[ "{{ element.surrogate.thumbnail }}" ],
+            store=SQLiteSurrogateStore())
+        dataset.add_memento_data(urim1, { "urim": urim1, "thumbnail": thumbnail })
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            dataset_filename = "{}/dataset.jsonl.gz".format(tmpdir)
+            dataset.write(dataset_filename)
+
+            loaded = SurrogateDataset.load(dataset_filename, store=SQLiteSurrogateStore())
+
+        self.assertEqual(loaded.urims, [ urim1 ])
+        self.assertEqual(loaded.get_memento_data(urim1)["thumbnail"], thumbnail)
+        self.assertRaises(KeyError, loaded.get_memento_data, urim2)
@@ -0,0 +1,235 @@
+import unittest
+import io
+import os
+import base64
+import tempfile
+import shutil
+import threading
+
+import requests
+import requests_mock
+
+from PIL import Image
+
+from twitter.twitter_utils import parse_media_file
+
+from raintale.storytellers.twitter import MediaBuffer, media_upload_lookahead
+from raintale.storytellers.storyteller import StoryTellerPublishStoppedError
+
+from .standin_apis import FakeClock, StandInTwitterApi, write_twitter_credentials, make_standin_twitter_storyteller, \
+    make_story_output_data
+
+def png_datauri(color):
+
+    ifp = io.BytesIO()
+    Image.new("RGB", (32, 32), color).save(ifp, "PNG")
+
+    return "data:image/png;base64,{}".format(base64.b64encode(ifp.getvalue()).decode('utf-8'))
+
+class TestTwitterPublish(unittest.TestCase):
+
+    def setUp(self):
+
+        self.credentials_filename = "/tmp/credentials.yaml"
+        write_twitter_credentials(self.credentials_filename)
+
+        self.clock = FakeClock()
+
+        self.cache_directory = tempfile.mkdtemp(prefix="raintale-test-")
+
+        self.tst = make_standin_twitter_storyteller(self.credentials_filename, self.clock,
+            StandInTwitterApi(self.clock), cache_directory=self.cache_directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_directory)
+
+    def test_media_uploaded_before_posting(self):
+
+        colors = [ "red", "green", "blue", "yellow", "white", "black" ]
+
+        story_output_data = {
+            "main_post": "My Story Title",
+            "comment_posts": [
+                {
+                    "text": "story element #{}".format(i),
+                    "media": [ png_datauri(color), "" ]
+                } for i, color in enumerate(colors)
+            ]
+        }
+
+        self.tst.publish_story(story_output_data)
+
+        statuses = self.tst.api.statuses
+
+        self.assertEqual(len(statuses), len(colors) + 1)
+
+        for i, color in enumerate(colors):
+
+            status = statuses[i + 1]
+
+            self.assertEqual(status.text, "story element #{}".format(i))
+            self.assertEqual(len(status.media), 1, "tweet was not posted with its uploaded media ID")
+
+            uploaded = Image.open(io.BytesIO(self.tst.api.uploads[status.media[0]]["data"]))
+
+            self.assertEqual(uploaded.getpixel((0, 0)), Image.new("RGB", (1, 1), color).getpixel((0, 0)),
+                "tweet was posted with the media of another story element")
+
+    def test_failed_post_stops_media_uploads(self):
+
+        self.tst.api.fail_after = 2
+
+        story_output_data = {
+            "main_post": "My Story Title",
+            "comment_posts": [
+                {
+                    "text": "story element #{}".format(i),
+                    "media": [ png_datauri((i, 0, 0)) ]
+                } for i in range(0, 60)
+            ]
+        }
+
+        with self.assertRaises(requests.ConnectionError):
+            self.tst.publish_story(story_output_data)
+
+        self.assertEqual(len(self.tst.api.statuses), 2)
+        self.assertLessEqual(len(self.tst.api.uploads), media_upload_lookahead + 2,
+            "media uploads continued after posting failed")
+
+    def test_stopped_publishing(self):
+
+        self.tst.stop_publishing = threading.Event()
+
+        post_update = self.tst.api.PostUpdate
+
+        def stop_after_two_posts(*args, **kwargs):
+
+            status = post_update(*args, **kwargs)
+
+            if len(self.tst.api.statuses) == 2:
+                self.tst.stop_publishing.set()
+
+            return status
+
+        self.tst.api.PostUpdate = stop_after_two_posts
+
+        with self.assertRaises(StoryTellerPublishStoppedError):
+            self.tst.publish_story(make_story_output_data(5))
+
+        self.assertEqual(len(self.tst.api.statuses), 2, "tweets were posted after publishing was stopped")
+
+    def test_media_uploaded_from_memory(self):
+
+        def list_temporary_files():
+            return set( f for f in os.listdir(tempfile.gettempdir()) if f.startswith('raintale-') )
+
+        before = list_temporary_files()
+
+        tweet_media = self.tst.prepare_media([ png_datauri("red") ])
+
+        self.assertIsInstance(tweet_media[0], MediaBuffer)
+
+        _, filename, file_size, media_type = parse_media_file(tweet_media[0])
+
+        self.assertEqual(media_type, "image/png", "python-twitter cannot determine the type of the media")
+        self.assertGreater(file_size, 0)
+
+        tweet_media[0].close()
+
+        story_output_data = {
+            "main_post": "My Story Title",
+            "comment_posts": [ { "text": "story element", "media": [ png_datauri("red") ] } ]
+        }
+
+        self.tst.publish_story(story_output_data)
+
+        self.assertEqual(len(self.tst.api.uploads), 1)
+        self.assertEqual(list_temporary_files(), before, "media was written to temporary files")
+
+    def test_url_media_sized_before_upload(self):
+
+        ifp = io.BytesIO()
+        Image.new("RGB", (256, 256), "red").save(ifp, "JPEG")
+        large_image = ifp.getvalue()
+
+        ifp = io.BytesIO()
+        Image.new("RGB", (8, 8), "red").save(ifp, "JPEG")
+        small_image = ifp.getvalue()
+
+        self.tst.api.chunk_size = len(large_image) - 1
+
+        story_output_data = {
+            "main_post": "My Story Title",
+            "comment_posts": [
+                { "text": "large image", "media": [ "http://example.com/archive/image/large" ] },
+                { "text": "small image", "media": [ "http://example.com/archive/image/small" ] }
+            ]
+        }
+
+        with requests_mock.Mocker() as m:
+            m.get("http://example.com/archive/image/large", content=large_image, headers={ "Content-Type": "image/jpeg" })
+            m.get("http://example.com/archive/image/small", content=small_image, headers={ "Content-Type": "image/jpeg" })
+
+            self.tst.publish_story(story_output_data)
+
+        statuses = self.tst.api.statuses
+        uploads = self.tst.api.uploads
+
+        self.assertTrue(uploads[statuses[1].media[0]]["chunked"], "large media did not use the chunked upload")
+        self.assertFalse(uploads[statuses[2].media[0]]["chunked"], "small media used the chunked upload")
+        self.assertEqual(uploads[statuses[1].media[0]]["data"], large_image)
+
+    def test_identical_media_uploaded_once(self):
+
+        colors = [ "red", "green", "blue" ]
+
+        story_output_data = {
+            "main_post": "My Story Title",
+            "comment_posts": [
+                {
+                    "text": "story element #{}".format(i),
+                    # the same archived logo appears in every element, twice in the first
+                    "media": [ png_datauri("white"), png_datauri(color) ] + ([ png_datauri("white") ] if i == 0 else [])
+                } for i, color in enumerate(colors)
+            ]
+        }
+
+        self.tst.publish_story(story_output_data)
+
+        statuses = self.tst.api.statuses
+
+        self.assertEqual(len(self.tst.api.uploads), len(colors) + 1, "identical media was uploaded more than once")
+
+        logo_ids = set( status.media[0] for status in statuses[1:] )
+
+        self.assertEqual(len(logo_ids), 1)
+        self.assertEqual(len(statuses[1].media), 2, "a tweet attached the same media twice")
+
+        for status in statuses[1:]:
+            self.assertEqual(len(set(status.media)), 2)
+
+    def test_gif_media_converted_by_content(self):
+
+        ifp = io.BytesIO()
+        Image.new("P", (16, 16)).save(ifp, "GIF")
+        gif_image = ifp.getvalue()
+
+        story_output_data = {
+            "main_post": "My Story Title",
+            "comment_posts": [
+                # the extension does not reveal that this is a GIF
+                { "text": "story element #{}".format(i), "media": [ "http://example.com/archive/image/logo" ] }
+                    for i in range(2)
+            ]
+        }
+
+        with requests_mock.Mocker() as m:
+            m.get("http://example.com/archive/image/logo", content=gif_image, headers={ "Content-Type": "image/gif" })
+
+            self.tst.publish_story(story_output_data)
+
+            self.assertEqual(m.call_count, 1, "the same media was downloaded twice")
+
+        for status in self.tst.api.statuses[1:]:
+            self.assertEqual(Image.open(io.BytesIO(self.tst.api.uploads[status.media[0]]["data"])).format, "PNG",
+                "the GIF was not converted")
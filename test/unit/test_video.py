@@ -0,0 +1,235 @@
+import unittest
+import io
+import os
+import time
+import tempfile
+import shutil
+
+from datetime import datetime
+
+import requests_mock
+
+from PIL import Image
+
+from raintale.storytellers.video import get_segment_key, get_output_format, video_profiles, \
+    VideoStoryTeller, decode_image, get_image_size, download_image
+from raintale.storytellers.storyteller import StoryTellerException
+from raintale.httpcache import get_cached_session
+from raintale.mediacache import MediaCache
+from raintale.surrogatedataset import SurrogateDataset
+
+class TestVideo(unittest.TestCase):
+
+    def test_segment_key(self):
+
+        segment = {
+            "kind": "image",
+            "element": {
+                "memento-datetime": "2009-05-22T22:12:51Z",
+                "original-domain": "example.com",
+                "archive-name": "Example Archive"
+            },
+            "media": {
+                "image": b"image data",
+                "archive-favicon": b"archive favicon data",
+                "original-favicon": b"original favicon data"
+            },
+            "title": "This is a test story",
+            "generated_by": "Raintale testing",
+            "profile": video_profiles["standard"],
+            "framesdir": "/tmp/frames000001"
+        }
+
+        key = get_segment_key(segment)
+
+        self.assertEqual(key, get_segment_key(dict(segment, framesdir="/tmp/frames000002")),
+            "the working directory should not change the segment key")
+
+        changed_media = dict(segment["media"], image=b"other image data")
+
+        self.assertNotEqual(key, get_segment_key(dict(segment, media=changed_media)),
+            "different image data should change the segment key")
+
+        self.assertNotEqual(key, get_segment_key(dict(segment, profile=video_profiles["preview"])),
+            "different video settings should change the segment key")
+
+    def test_output_format(self):
+
+        self.assertEqual(get_output_format("story.mp4"), "mp4")
+        self.assertEqual(get_output_format("story.GIF"), "gif")
+        self.assertEqual(get_output_format("story.webp"), "webp")
+        self.assertEqual(get_output_format("story"), "mp4")
+
+    def test_unknown_profile(self):
+
+        with self.assertRaises(StoryTellerException):
+            VideoStoryTeller("/tmp/raintale_testing.mp4", video_profile="doesnotexist")
+
+    def test_video_threads(self):
+
+        vst = VideoStoryTeller("/tmp/raintale_testing.mp4", video_profile="hq", video_threads=2)
+
+        self.assertEqual(vst.profile["threads"], 2)
+        self.assertEqual(vst.profile["width"], video_profiles["hq"]["width"])
+        self.assertEqual(video_profiles["hq"]["threads"], 0, "the shared video profile was modified")
+
+    def test_generate_story_from_dataset(self):
+
+        urim = "http://archive.example/20100424130000/https://example.com"
+
+        story_data = {
+            "title": "This is a test story",
+            "generated_by": "Raintale testing",
+            "collection_url": None,
+            "elements": [
+                { "type": "link", "value": urim },
+                { "type": "text", "value": "Some text" }
+            ]
+        }
+
+        dataset = SurrogateDataset(story_data=story_data, fields=VideoStoryTeller.surrogate_template.split("\n"))
+        dataset.add_memento_data(urim, {
+            "urim": urim,
+            "title": "Example title",
+            "memento_datetime": datetime(2010, 4, 24, 13, 0, 0),
+            "sentence": "The top\tsentence",
+            "image": "http://archive.example/image.png",
+            "original_domain": "example.com",
+            "original_favicon": "http://example.com/favicon.ico",
+            "archive_name": "Example Archive",
+            "archive_favicon": "http://archive.example/favicon.ico"
+        })
+
+        with tempfile.TemporaryDirectory() as cachedir:
+
+            vst = VideoStoryTeller("/tmp/raintale_testing.mp4", cache_directory=cachedir)
+            vst.surrogate_dataset = dataset
+
+            story_output_data = vst.generate_story(story_data, None, None)
+
+        self.assertEqual(len(story_output_data["elements"]), 3)
+        self.assertEqual(story_output_data["elements"][0]["text"], "The top sentence")
+        self.assertEqual(story_output_data["elements"][0]["memento-datetime"], "2010-04-24T13:00:00Z")
+        self.assertEqual(story_output_data["elements"][1]["image"], "http://archive.example/image.png")
+        self.assertEqual(story_output_data["elements"][2], { "text": "Some text", "image": None })
+
+    def test_decode_image(self):
+
+        ifp = io.BytesIO()
+        Image.new("RGB", (4000, 3000), "blue").save(ifp, "JPEG")
+
+        im = decode_image(ifp.getvalue(), (604, 336))
+
+        self.assertEqual(im.mode, "RGBA")
+        self.assertLess(im.size[0], 4000, "image was decoded at full resolution")
+        self.assertGreaterEqual(im.size[0], 604, "image was decoded below the target size")
+        self.assertGreaterEqual(im.size[1], 336, "image was decoded below the target size")
+
+        ifp = io.BytesIO()
+        Image.new("RGB", (3000, 2000), "blue").save(ifp, "PNG")
+
+        im = decode_image(ifp.getvalue(), (600, 336))
+
+        self.assertEqual(im.size, (600, 400))
+
+        self.assertEqual(get_image_size(ifp.getvalue()), (3000, 2000))
+        self.assertIsNone(get_image_size(b"<html><body>not an image</body></html>"))
+
+        for mode, imageformat in [ ("P", "PNG"), ("P", "GIF"), ("1", "PNG"), ("I;16", "PNG") ]:
+
+            ifp = io.BytesIO()
+            Image.new(mode, (3000, 2000)).save(ifp, imageformat)
+
+            im = decode_image(ifp.getvalue(), (600, 336))
+
+            self.assertEqual(im.mode, "RGBA", "{} {} image was not converted".format(mode, imageformat))
+            self.assertEqual(im.size, (600, 400), "{} {} image was not reduced".format(mode, imageformat))
+
+    def test_prune_segment_cache(self):
+
+        cache_directory = tempfile.mkdtemp(prefix="raintale-test-")
+
+        try:
+            vst = VideoStoryTeller("/tmp/raintale_testing.mp4", cache_directory=cache_directory,
+                cache_expire_after=24 * 60 * 60)
+
+            segment_cache_directory = vst.segment_cache_directory
+            old = time.time() - 2 * 24 * 60 * 60
+
+            filenames = {
+                "fresh segment": ("aaaa.mp4", None),
+                "expired segment": ("bbbb.mp4", old),
+                "fresh partial segment": ("cccc.mp4.100.partial", None),
+                "stale partial segment": ("dddd.mp4.101.partial", time.time() - 2 * 60 * 60)
+            }
+
+            for filename, mtime in filenames.values():
+
+                path = os.path.join(segment_cache_directory, filename)
+
+                with open(path, 'wb') as f:
+                    f.write(b"segment data")
+
+                if mtime is not None:
+                    os.utime(path, (mtime, mtime))
+
+            vst.prune_segment_cache()
+
+            remaining = sorted(os.listdir(segment_cache_directory))
+
+            self.assertEqual(remaining, [ "aaaa.mp4", "cccc.mp4.100.partial" ])
+
+        finally:
+            shutil.rmtree(cache_directory)
+
+class TestDownloadImage(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cache_directory = tempfile.mkdtemp(prefix="raintale-test-")
+
+        self.adapter = requests_mock.Adapter()
+        self.session = get_cached_session('test', cache_directory=self.cache_directory)
+        self.session.mount('mock', self.adapter)
+        self.media_cache = MediaCache(session=self.session)
+
+        ifp = io.BytesIO()
+        Image.new("RGB", (64, 48), "blue").save(ifp, "PNG")
+        self.image_data = ifp.getvalue()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_directory)
+
+    def test_download_image_cached(self):
+
+        uri = 'mock://127.0.0.1:9899/image.png'
+        self.adapter.register_uri('GET', uri, content=self.image_data, headers={ "Content-Type": "image/png" })
+
+        self.assertEqual(download_image(self.media_cache, uri), self.image_data)
+        self.assertEqual(download_image(self.media_cache, uri), self.image_data)
+
+        self.assertEqual(self.adapter.call_count, 1, "image was not served from the cache")
+
+    def test_download_image_wrong_content_type(self):
+
+        uri = 'mock://127.0.0.1:9899/page.html'
+        self.adapter.register_uri('GET', uri, content=b"<html><body>not an image</body></html>",
+            headers={ "Content-Type": "text/html" })
+
+        self.assertIsNone(download_image(self.media_cache, uri))
+
+    def test_download_image_size_cap(self):
+
+        uri = 'mock://127.0.0.1:9899/large.png'
+        self.adapter.register_uri('GET', uri, content=self.image_data, headers={ "Content-Type": "image/png" })
+
+        self.assertIsNone(download_image(self.media_cache, uri, max_bytes=len(self.image_data) - 1))
+
+        # without Content-Length, the download stops once the body passes the cap
+        uri = 'mock://127.0.0.1:9899/chunked.png'
+        self.adapter.register_uri('GET', uri, body=io.BytesIO(self.image_data), headers={ "Content-Type": "image/png" })
+
+        self.assertIsNone(download_image(self.media_cache, uri, max_bytes=len(self.image_data) - 1))
+
+        self.assertEqual(self.session.get(uri, only_if_cached=True).status_code, 504,
+            "an oversized image was stored in the cache")
@@ -0,0 +1,112 @@
+import unittest
+import os
+import json
+import tempfile
+import threading
+
+from raintale.storydata import read_story_data
+from raintale.surrogatedataset import SurrogateCache
+from raintale.storytellers.filetemplate import FileTemplateStoryTeller
+from raintale.watch import StoryWatcher
+
+from .test_surrogatedataset import make_mementoembed_session, mementoembed_api, urim1, urim2
+
+story_template = "<title>{{ title }}</title>\n" \
+    "{% for element in elements %}{% if element.type == 'link' %}<element>{{ element.surrogate.title }}</element>\n" \
+    "{% endif %}{% endfor %}"
+
+class TestStoryWatcher(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        self.input_filename = os.path.join(self.tmpdir.name, "story.json")
+        self.template_filename = os.path.join(self.tmpdir.name, "story.template")
+        self.output_filename = os.path.join(self.tmpdir.name, "story.html")
+
+        self.write_story([ urim1 ])
+
+        with open(self.template_filename, 'w') as f:
+            f.write(story_template)
+
+        self.session, self.adapter = make_mementoembed_session()
+
+        self.watcher = StoryWatcher(
+            self.input_filename,
+            lambda: read_story_data(self.input_filename, None, None, None, None),
+            [ (FileTemplateStoryTeller(self.output_filename), self.template_filename, None) ],
+            SurrogateCache(mementoembed_api, session=self.session),
+            poll_interval=0.01, settle_time=0.01
+        )
+
+        self.told = threading.Semaphore(0)
+        self.stop_event = threading.Event()
+
+        self.watch_thread = threading.Thread(target=self.watcher.watch,
+            kwargs={ "stop_event": self.stop_event, "on_told": lambda locations: self.told.release() }, daemon=True)
+
+    def tearDown(self):
+        self.stop_event.set()
+        self.watch_thread.join()
+        self.tmpdir.cleanup()
+
+    def write_story(self, urims, title="A watched story"):
+
+        story_data = {
+            "title": title,
+            "elements": [ { "type": "link", "value": urim } for urim in urims ]
+        }
+
+        with open(self.input_filename, 'w') as f:
+            json.dump(story_data, f)
+
+    def wait_for_story(self):
+
+        self.assertTrue(self.told.acquire(timeout=5), "the story was not told again")
+
+        with open(self.output_filename) as f:
+            return f.read()
+
+    def requested_urims(self):
+        return [ request.url.split('/contentdata/', 1)[1] for request in self.adapter.request_history ]
+
+    def test_retell_changed_story(self):
+
+        self.watch_thread.start()
+
+        self.assertEqual(self.wait_for_story(),
+            "<title>A watched story</title>\n<element>Title of memento #1</element>\n")
+        self.assertEqual(self.requested_urims(), [ urim1 ])
+
+        # the size changes with the new element, so the change is seen even within the mtime resolution
+        self.write_story([ urim1, urim2 ])
+
+        self.assertEqual(self.wait_for_story(),
+            "<title>A watched story</title>\n"
+            "<element>Title of memento #1</element>\n"
+            "<element>Title of memento #2</element>\n")
+        self.assertEqual(self.requested_urims(), [ urim1, urim2 ], "unchanged surrogates were fetched again")
+
+        with open(self.template_filename, 'w') as f:
+            f.write("<h1>{{ title }}</h1>")
+
+        self.assertEqual(self.wait_for_story(), "<h1>A watched story</h1>")
+        self.assertEqual(self.requested_urims(), [ urim1, urim2 ])
+
+    def test_survives_broken_input(self):
+
+        self.watch_thread.start()
+        self.wait_for_story()
+
+        with open(self.input_filename, 'w') as f:
+            f.write('{ "title": "A story saved halfway')
+
+        # the broken story is not told, but the watcher waits for the next change
+        self.assertFalse(self.told.acquire(timeout=0.2))
+        self.assertTrue(self.watch_thread.is_alive())
+
+        self.write_story([ urim2 ], title="A fixed story")
+
+        self.assertEqual(self.wait_for_story(),
+            "<title>A fixed story</title>\n<element>Title of memento #2</element>\n")